@@ -1,14 +1,16 @@
 import boto3
 import botocore
 import os
-from subprocess import Popen
 import json
+import time
 
 ###############################
 ###      AWS FUNCTIONS     ###
 ###############################
 
 import aws
+import s3stream
+import workers
 
 ###############################
 ###     HELPER FUNCTIONS    ###
@@ -38,19 +40,31 @@ def create_local_job_directory(job_directory):
   except:
     print("There was an error creating an internal directory to process the job.")
 
-# call anntools using Popen
-def run_anntools(run_file, key, job_file_path, job_id, job_directory, key_prefix, output_bucket):
+# hand the job to the annotation pool (workers.py): persistent workers, where database
+# connections and loaded annotation tables stay warm from one job to the next, or
+# one run.py process per job; returns True if the pool took the job
+def run_anntools_in_pool(pool, job_file_path, job_id, job_directory, key_prefix, output_bucket, input_args=()):
   try:
-    Popen(['python', run_file, job_file_path, job_id, job_directory, key_prefix, output_bucket], stdin=None, stdout=None, stderr=None, shell=False)
+    pool.submit(job_id, (job_file_path, job_id, job_directory, key_prefix, output_bucket) + tuple(input_args))
+    return True
   except:
-    print("There was an error starting the annotation process on this job when calling run.py.")
+    print("There was an error handing this job to the annotation workers.")
+    return False
+
+# a job that could not be claimed is either RUNNING in another annotator or
+# already done with (COMPLETE, ...); when its status cannot be read it is
+# assumed to be running so that its request is kept
+def is_job_running(job_id):
+  table = aws.get_table(aws.DYNAMODB_ANNOTATIONS_TABLE)
+  annotation_details = aws.get_annotation_details(table, job_id)
+  return annotation_details is None or annotation_details.get('job_status') in ('PENDING', 'RUNNING')
 
 ###############################
 ###         RUN JOB         ###
 ###############################
 
-# run the annotation job
-def run_job(job_data):
+# run the annotation job; returns True if it was started
+def run_job(job_data, pool):
   # get key fields
   job_id = job_data['job_id']
   bucket = job_data['s3_inputs_bucket']
@@ -60,56 +74,125 @@ def run_job(job_data):
   # make sure key fields are defined
   if job_id is None or bucket is None or key is None or filename is None:
     print("Error: did not receive valid job id, bucket, key, or filename.")
+    return False
 
-  # define a directory and file path for the job
+  # define a directory and file path for the job (compressed inputs are annotated under their .vcf name)
   job_directory = "data/jobs/" + job_id + "/"
-  job_file_path = job_directory + filename
+  job_file_path = job_directory + s3stream.uncompressed_name(filename)
 
   # create local directory for job
   create_local_job_directory(job_directory)
 
-  # connect to s3
-  s3 = aws.get_s3()
+  if aws.ANNOTATION_STREAM_INPUT:
+    # the annotation streams the file from s3 itself
+    input_args = (bucket, key)
+  else:
+    # connect to s3
+    s3 = aws.get_s3()
 
-  # download the file from s3
-  aws.download_file_from_s3(s3, bucket, key, job_file_path)
+    # download the file from s3
+    if not aws.download_file_from_s3(s3, bucket, key, job_file_path):
+      return False
+    input_args = ()
 
   # run anntools
-  run_file = 'run.py'
   key_prefix = extract_prefix(key)
   output_bucket = aws.S3_RESULTS_BUCKET
-  run_anntools(run_file, key, job_file_path, job_id, job_directory, key_prefix, output_bucket)
+  started = run_anntools_in_pool(pool, job_file_path, job_id, job_directory, key_prefix, output_bucket, input_args)
 
   # success
-  print("Anntools called successfully for job id: " + str(job_id))
+  if started:
+    print("Anntools called successfully for job id: " + str(job_id))
+  return started
 
 ###############################
 ###          MAIN          ###
 ###############################
 
-def main():
-  # connect to SQS
-  sqs = aws.get_sqs()
-  queue_name = aws.SQS_JOB_REQUESTS_QUEUE
-  queue = aws.get_queue(sqs, queue_name)
+# only take as many job requests as there are free workers, keep their
+# messages hidden while the jobs run and delete them once the jobs are done
+def consume(queue, pool):
+  # job id -> [message, time its visibility was last extended]
+  in_flight = {}
+  timeout = aws.ANNOTATION_VISIBILITY_TIMEOUT
 
-  # loop for SQS messages
   while True:
-    print("Asking SQS for up to 10 messages...")
-    # Get messages
-    messages = queue.receive_messages(WaitTimeSeconds=10)
+    # finished jobs (wait for one when every worker is busy); a failed job's
+    # request becomes visible again so that it is retried
+    for job_id, result in pool.completed(timeout=0 if pool.free_slots() > 0 else 10):
+      print("Annotation worker finished job id: " + str(job_id) + ("" if result == workers.SUCCEEDED else " (" + result + ")"))
+      if job_id in in_flight:
+        message = in_flight.pop(job_id)[0]
+        if result == workers.SUCCEEDED or (result == workers.NOT_CLAIMED and not is_job_running(job_id)):
+          print("Deleting message...")
+          message.delete()
+        elif result == workers.FAILED:
+          aws.release_message(message)
+        else:
+          # another annotator is running the job: the request becomes visible
+          # again once its visibility timeout ends and is checked then
+          print("Job running elsewhere, leaving message...")
+
+    # keep the requests of running jobs hidden from other annotators
+    now = time.time()
+    due = [entry for entry in in_flight.values() if now - entry[1] >= timeout // 2]
+    if len(due) > 0:
+      aws.extend_message_visibility(queue, [entry[0] for entry in due], timeout)
+      for entry in due:
+        entry[1] = now
+
+    # backpressure: no free worker, no new messages
+    free_slots = pool.free_slots()
+    if free_slots == 0:
+      continue
+
+    print("Asking SQS for up to {0} messages...".format(str(min(10, free_slots))))
+    messages = queue.receive_messages(MaxNumberOfMessages=min(10, free_slots), WaitTimeSeconds=10, VisibilityTimeout=timeout)
 
     if len(messages) > 0:
       print("Received {0} messages...".format(str(len(messages))))
-      # Iterate each message
       for message in messages:
-        job_data = json.loads(json.loads(message.body)['Message'])
+        # a request that cannot be read is left alone: it becomes visible again
+        # once its visibility timeout ends (or goes to the queue's dead-letter queue)
+        try:
+          job_data = json.loads(json.loads(message.body)['Message'])
+          job_id = job_data['job_id']
+        except Exception as e:
+          print("There was an error reading the job request:\n" + str(e))
+          continue
         print("Job data received:\n" + str(job_data))
+        if job_id in in_flight:
+          # the same request delivered again while its job runs here: only the
+          # latest receipt handle is sure to work, so keep it for the visibility
+          # extensions and for deleting or releasing the request once the job ends
+          print("Job already running, keeping the latest receipt of its message...")
+          in_flight[job_id] = [message, time.time()]
+          continue
         print("Starting job...")
-        run_job(job_data)
+        in_flight[job_id] = [message, time.time()]
+        try:
+          started = run_job(job_data, pool)
+        except Exception as e:
+          print("There was an error starting job id: " + str(job_id) + "\n" + str(e))
+          started = False
+
+        # the job never reached a worker: make its request visible again so that it is retried
+        if not started:
+          del in_flight[job_id]
+          aws.release_message(message)
+
+def main():
+  # start the annotation workers before connecting to anything, they are forked from this process
+  if aws.ANNOTATION_PERSISTENT_WORKER:
+    pool = workers.WorkerPool(aws.ANNOTATION_WORKER_PROCESSES)
+  else:
+    pool = workers.ProcessPool(aws.ANNOTATION_WORKER_PROCESSES)
+
+  # connect to SQS
+  sqs = aws.get_sqs()
+  queue_name = aws.SQS_JOB_REQUESTS_QUEUE
+  queue = aws.get_queue(sqs, queue_name)
 
-        # Delete the message from the queue
-        print ("Deleting message...")
-        message.delete()
+  consume(queue, pool)
 
 main()
@@ -1,10 +1,16 @@
 import boto3
 import botocore
 from boto3.dynamodb.conditions import Key, Attr
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import json
+import multiprocessing
 import os
+import time
+
+import s3stream
 
 import configparser
 
@@ -29,6 +35,16 @@ REGION_NAME = config['AWS']['REGION_NAME']
 S3_INPUTS_BUCKET = config['AWS']['S3_INPUTS_BUCKET']
 S3_RESULTS_BUCKET = config['AWS']['S3_RESULTS_BUCKET']
 S3_ACL = config['AWS']['S3_ACL']
+S3_UPLOAD_FILES = config['AWS'].getint('S3_UPLOAD_FILES')
+S3_UPLOAD_ATTEMPTS = config['AWS'].getint('S3_UPLOAD_ATTEMPTS')
+
+# multipart uploads: parts of S3_MULTIPART_CHUNKSIZE bytes, S3_MAX_CONCURRENCY parts of a file at once
+S3_TRANSFER_CONFIG = TransferConfig(
+  multipart_threshold=config['AWS'].getint('S3_MULTIPART_THRESHOLD'),
+  multipart_chunksize=config['AWS'].getint('S3_MULTIPART_CHUNKSIZE'),
+  max_concurrency=config['AWS'].getint('S3_MAX_CONCURRENCY'),
+  use_threads=True
+)
 
 # DynamoDB
 DYNAMODB_ANNOTATIONS_TABLE = config['AWS']['DYNAMODB_ANNOTATIONS_TABLE']
@@ -57,39 +73,79 @@ MAIL_DEFAULT_SENDER = config['AWS']['MAIL_DEFAULT_SENDER']
 # Archive
 FREE_USER_DATA_RETENTION = config['ARCHIVE']['FREE_USER_DATA_RETENTION'] # time before free user results are archived (in seconds)
 
+# Annotation
+ANNOTATION_ENGINE = config['ANNOTATION']['ENGINE']
+ANNOTATION_INDEX_REGION_TABLES = config['ANNOTATION'].getboolean('INDEX_REGION_TABLES')
+ANNOTATION_SORTED_SWEEP = config['ANNOTATION'].getboolean('SORTED_SWEEP')
+ANNOTATION_DBSNP_STORE = config['ANNOTATION']['DBSNP_STORE'] or None
+ANNOTATION_SOURCE = config['ANNOTATION']['SOURCE']
+ANNOTATION_SQLITE_DATABASE = config['ANNOTATION']['SQLITE_DATABASE'] or None
+ANNOTATION_PERSISTENT_WORKER = config['ANNOTATION'].getboolean('PERSISTENT_WORKER')
+ANNOTATION_WORKER_PROCESSES = config['ANNOTATION'].getint('WORKER_PROCESSES')
+ANNOTATION_VISIBILITY_TIMEOUT = config['ANNOTATION'].getint('VISIBILITY_TIMEOUT')
+ANNOTATION_STREAM_INPUT = config['ANNOTATION'].getboolean('STREAM_INPUT')
+ANNOTATION_COMPRESS_OUTPUT = config['ANNOTATION'].getboolean('COMPRESS_OUTPUT')
+# processes per job; 0 divides the cores between the WORKER_PROCESSES jobs that run at once
+ANNOTATION_WORKERS = config['ANNOTATION'].getint('WORKERS') or max(1, multiprocessing.cpu_count() // max(1, ANNOTATION_WORKER_PROCESSES))
+ANNOTATION_SHARD_BY = config['ANNOTATION']['SHARD_BY']
+ANNOTATION_GENE_MODEL = config['ANNOTATION'].getboolean('GENE_MODEL')
+ANNOTATION_PROGRESS_INTERVAL = config['ANNOTATION'].getfloat('PROGRESS_INTERVAL')
+
 ###############################
 ###            S3           ###
 ###############################
 
-# get an s3 connection
+# get an s3 connection; its connection pool is large enough for every part of
+# every file uploaded at once by upload_files_to_s3
 def get_s3():
   try:
-    s3 = boto3.resource('s3')
+    s3 = boto3.resource('s3', config=Config(max_pool_connections=S3_UPLOAD_FILES * S3_TRANSFER_CONFIG.max_concurrency))
   except Exception as e:
     print("There was an error connecting to S3:\n" + str(e))
   return s3
 
-# download file from s3
+# download file from s3 (.gz/.bgz files are decompressed on the fly)
 def download_file_from_s3(s3, bucket, key, file_path):
   try:
-    s3.Bucket(bucket).download_file(key, file_path)
+    s3stream.download_file(s3, bucket, key, file_path)
+    return True
   except botocore.exceptions.ClientError as e:
     if e.response['Error']['Code'] == "404":
       print("The requested file could not be found in S3 for processing.")
     else:
       print("There was an error downloading the file for processing:\n" + str(e))
+    return False
 
-# upload files to s3
-def upload_files_to_s3(s3, bucket, prefix, local_folder, local_files):
-  for file in local_files:
-    # define file path and AWS key
-    file_path = local_folder + file
-    key = prefix + file
-    # upload
+# upload one file to s3 (multipart for large files), retrying with exponential backoff
+# returns (bytes, seconds), or None if every attempt failed
+def upload_file_to_s3(s3, bucket, key, file_path):
+  size = os.path.getsize(file_path)
+  for attempt in range(S3_UPLOAD_ATTEMPTS):
     try:
-      s3.meta.client.upload_file(file_path, bucket, key)
-    except:
-      print("There was an error uploading the file: " + str(key))
+      start = time.time()
+      s3.meta.client.upload_file(file_path, bucket, key, Config=S3_TRANSFER_CONFIG)
+      seconds = time.time() - start
+      print("Uploaded {0}: {1} bytes in {2:.2f} seconds ({3:.2f} MB/s)".format(key, size, seconds, size / max(seconds, 1e-6) / 1e6))
+      return size, seconds
+    except Exception as e:
+      print("There was an error uploading the file: {0} (attempt {1} of {2}):\n{3}".format(key, attempt + 1, S3_UPLOAD_ATTEMPTS, str(e)))
+      if attempt < S3_UPLOAD_ATTEMPTS - 1:
+        time.sleep(2 ** attempt)
+  return None
+
+# upload files to s3, S3_UPLOAD_FILES of them at once
+# returns {key: (bytes, seconds)}, with None for the files that could not be uploaded
+def upload_files_to_s3(s3, bucket, prefix, local_folder, local_files):
+  start = time.time()
+  with ThreadPoolExecutor(max_workers=S3_UPLOAD_FILES) as executor:
+    # define file path and AWS key, and upload
+    futures = [(prefix + file, executor.submit(upload_file_to_s3, s3, bucket, prefix + file, local_folder + file)) for file in local_files]
+    results = dict([(key, future.result()) for key, future in futures])
+  seconds = time.time() - start
+  size = sum([result[0] for result in results.values() if result is not None])
+  print("Uploaded {0} of {1} files: {2} bytes in {3:.2f} seconds ({4:.2f} MB/s)".format(
+    len([result for result in results.values() if result is not None]), len(local_files), size, seconds, size / max(seconds, 1e-6) / 1e6))
+  return results
 
 # put data in S3
 def put_data_in_S3(s3, bucket, key, data):
@@ -162,27 +218,70 @@ def claim_annotation_job(table, job_id):
       print("Job not PENDING.")
       return False
 
-# set field for a completed job in the annotations database
-def set_completed_job_details(table, job_id, bucket, key_result_file,
-  key_log_file, complete_time, status, result_file_location):
+# release a RUNNING job whose annotation failed: returns True if job status can be
+# updated from RUNNING back to PENDING, so that the job request can be claimed again
+def release_annotation_job(table, job_id):
+  try:
+    response = table.update_item(
+      Key={'job_id': job_id},
+      UpdateExpression="set job_status=:job_status",
+      ConditionExpression=Attr('job_status').eq('RUNNING'),
+      ReturnValues='UPDATED_NEW',
+      ExpressionAttributeValues={
+        ':job_status' : 'PENDING'
+      }
+    )
+    return response['Attributes']['job_status'] == 'PENDING'
+  except botocore.exceptions.ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      print("There was an error updating the job status in the annotations database.")
+    else:
+      print("Job not RUNNING.")
+    return False
+
+# record the progress of a RUNNING job (a progress.Progress state: stage, records
+# annotated, percent done, estimated seconds left) in its job_progress field
+def set_job_progress(table, job_id, progress):
   try:
     table.update_item(
       Key={'job_id': job_id},
-      UpdateExpression="set s3_results_bucket=:results_bucket, "
-                        "s3_key_result_file=:result_file, "
-                        "s3_key_log_file=:log_file, "
-                        "complete_time=:complete_time, "
-                        "job_status=:job_status, "
-                        "result_file_location=:result_file_location",
+      UpdateExpression="set job_progress=:job_progress",
+      ConditionExpression=Attr('job_status').eq('RUNNING'),
       ExpressionAttributeValues={
-        ':results_bucket' : bucket,
-        ':result_file' : key_result_file,
-        ':log_file' : key_log_file,
-        ':complete_time' : complete_time,
-        ':job_status' : status,
-        ':result_file_location': result_file_location
+        ':job_progress' : progress
       }
     )
+  except botocore.exceptions.ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      print("There was an error updating the progress of job id: " + str(job_id) + "\n" + str(e))
+
+# set field for a completed job in the annotations database
+def set_completed_job_details(table, job_id, bucket, key_result_file,
+  key_log_file, complete_time, status, result_file_location, key_index_file=None):
+  update_expression = ("set s3_results_bucket=:results_bucket, "
+                       "s3_key_result_file=:result_file, "
+                       "s3_key_log_file=:log_file, "
+                       "complete_time=:complete_time, "
+                       "job_status=:job_status, "
+                       "result_file_location=:result_file_location")
+  values = {
+    ':results_bucket' : bucket,
+    ':result_file' : key_result_file,
+    ':log_file' : key_log_file,
+    ':complete_time' : complete_time,
+    ':job_status' : status,
+    ':result_file_location': result_file_location
+  }
+  # the tabix index of a compressed result, only written when its records were sorted
+  if key_index_file is not None:
+    update_expression += ", s3_key_index_file=:index_file"
+    values[':index_file'] = key_index_file
+  try:
+    table.update_item(
+      Key={'job_id': job_id},
+      UpdateExpression=update_expression,
+      ExpressionAttributeValues=values
+    )
   except:
     print("There was an error updating the job database for job id: " + str(job_id))
 
@@ -273,6 +372,26 @@ def get_queue(sqs, queue_name):
   except Exception as e:
     print("There was an error getting the queue by name:\n" + str(e))
 
+# keep received messages hidden from other consumers for another `timeout` seconds
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.change_message_visibility_batch
+def extend_message_visibility(queue, messages, timeout):
+  for i in range(0, len(messages), 10):
+    entries = [{'Id': str(n), 'ReceiptHandle': message.receipt_handle, 'VisibilityTimeout': timeout}
+               for n, message in enumerate(messages[i:i+10])]
+    try:
+      response = queue.change_message_visibility_batch(Entries=entries)
+      for failed in response.get('Failed', []):
+        print("There was an error extending the visibility of a message: " + str(failed.get('Message')))
+    except Exception as e:
+      print("There was an error extending the visibility of messages:\n" + str(e))
+
+# make a received message visible again so that it is delivered to another consumer
+def release_message(message):
+  try:
+    message.change_visibility(VisibilityTimeout=0)
+  except Exception as e:
+    print("There was an error releasing the message:\n" + str(e))
+
 ###############################
 ###          SNS            ###
 ###############################
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+
+""" Reproducible benchmark of the annotation engines
+
+    Generates a synthetic VCF (number of records, chromosome mix, SNV/indel
+    ratio and share of known dbSNP variants are options, and the same seed
+    gives the same file), then annotates it with every configuration of
+    CONFIGURATIONS against a small fixture database in SQLite and collects the
+    per-stage metrics of every run (see metrics.py) into one JSON report.
+
+    Every run starts in a fresh process on a fresh copy of the input, so the
+    process-wide indexes and models of one configuration never warm up the next
+    one. The md5 of every .annot.vcf goes into the report, so a configuration
+    that changes the output shows up next to one that slows down; the
+    benchmark runs with PYTHONHASHSEED=0 unless it is set, so that the md5s
+    also compare from one report to the next.
+
+    The range queries of the annotator database have no ORDER BY, so the order
+    of their rows (the first one is kept by the CNV, miRNA, putativePromoter and
+    genomicSuperDups stages) is the order of the index MySQL scans. The indexed
+    configurations follow the indexes read from the schema (see
+    sources.Source.rangeOrder), which a fixture only reproduces as far as its
+    rows go: run with mysql=true on the annotator database and compare the md5
+    of stream-mysql with the one of stream-memory before trusting them.
+
+    The fixture is generated on first use: every annotation table with the
+    columns the stages read, filled with seeded random rows on the chromosomes
+    of the benchmark (SyntheticSource), so the benchmark needs no database and
+    the same options always give the same fixture. fixture=mysql exports it
+    from the annotator database instead (see sources.export_sqlite).
+    Configurations that read the annotator database itself, including the file
+    to file engine, only run with mysql=true.
+
+    Usage: python benchmark.py <report.json> [option=value ...]
+
+        records=10000         number of variant records
+        chroms=1:2,2:1,X:1    chromosomes with their weights (default: all, weighted by length)
+        indel_ratio=0.1       share of insertions and deletions
+        known_ratio=0.5       share of records taken from the dbSNP rows of the fixture
+        seed=1                seed of the generator
+        database=benchmark.sqlite   fixture database, created if it does not exist
+        fixture=synthetic     synthetic (generated from fixture_seed) or mysql (exported from the annotator database)
+        fixture_rows=20000    rows of every table of the fixture
+        fixture_seed=1        seed of the synthetic fixture
+        dbsnp_store=          also run the configurations with this dbSNP store
+        repeat=3              runs of every configuration
+        mysql=false           also run the configurations that use the annotator database
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import driver
+import intervals
+import metrics
+import pipeline
+import sources
+
+# GRCh37 chromosome lengths, the default chromosome mix
+CHROM_LENGTHS = [('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276), ('5', 180915260),
+                 ('6', 171115067), ('7', 159138663), ('8', 146364022), ('9', 141213431), ('10', 135534747),
+                 ('11', 135006516), ('12', 133851895), ('13', 115169878), ('14', 107349540), ('15', 102531392),
+                 ('16', 90354753), ('17', 81195210), ('18', 78077248), ('19', 59128983), ('20', 63025520),
+                 ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566),
+                 ('MT', 16569)]
+
+# (name, driver.run options, reads the annotator database)
+CONFIGURATIONS = [('files', {'engine': 'files'}, True),
+                  ('stream-mysql', {'engine': 'stream', 'source': 'mysql'}, True),
+                  ('stream-sqlite', {'engine': 'stream', 'source': 'sqlite'}, False),
+                  ('stream-memory', {'engine': 'stream', 'source': 'memory', 'index': True}, False),
+                  ('stream-memory-sweep', {'engine': 'stream', 'source': 'memory', 'index': True, 'sweep': True, 'gene_model': True}, False),
+                  ('stream-memory-parallel', {'engine': 'stream', 'source': 'memory', 'index': True, 'sweep': True, 'gene_model': True,
+                                              'workers': 0}, False)]
+
+DEFAULTS = {'records': '10000',
+            'chroms': ','.join([chrom + ':' + str(length) for chrom, length in CHROM_LENGTHS]),
+            'indel_ratio': '0.1',
+            'known_ratio': '0.5',
+            'seed': '1',
+            'database': 'benchmark.sqlite',
+            'fixture': 'synthetic',
+            'fixture_rows': '20000',
+            'fixture_seed': '1',
+            'dbsnp_store': '',
+            'repeat': '3',
+            'mysql': 'false'}
+
+BASES = 'ACGT'
+
+
+""" Parses 1:2,2:1,X into [(chrom, weight)], weight 1 where it is left out """
+def parseChroms(value):
+    chroms = []
+    for item in value.split(','):
+        item = item.strip()
+        if len(item) == 0:
+            continue
+        if ':' in item:
+            chrom, weight = item.split(':', 1)
+            chroms.append((chrom.strip(), float(weight)))
+        else:
+            chroms.append((item, 1.0))
+    return chroms
+
+
+""" The dbSNP rows of the fixture by chromosome, split into SNVs and indels """
+def knownVariants(database):
+    known = {}
+    if not database:
+        return known
+    source = sources.SQLiteSource(database)
+    columns, rows = source.scan('dbSNP')
+    source.close()
+    chrIndex = intervals.columnIndex(columns, 'CHR')
+    posIndex = intervals.columnIndex(columns, 'POS')
+    refIndex = intervals.columnIndex(columns, 'REF')
+    altIndex = intervals.columnIndex(columns, 'ALT')
+    for row in rows:
+        ref = str(row[refIndex])
+        alt = str(row[altIndex])
+        indel = len(ref) != 1 or len(alt.split(',')[0]) != 1 or '-' in (ref, alt)
+        known.setdefault((sources.bareChrom(row[chrIndex]), indel), []).append((int(row[posIndex]), ref, alt))
+    return known
+
+
+""" A random novel variant: an SNV, or an insertion or deletion of 1 to 10 bases """
+def novelVariant(rng, length, indel):
+    pos = rng.randint(1, length)
+    ref = rng.choice(BASES)
+    if not indel:
+        return pos, ref, rng.choice([b for b in BASES if b != ref])
+    bases = ''.join([rng.choice(BASES) for i in range(rng.randint(1, 10))])
+    if rng.random() < 0.5:
+        return pos, ref, ref + bases
+    return pos, ref + bases, ref
+
+
+""" Writes a coordinate sorted synthetic VCF to path; returns the number of records """
+def generate(path, records=10000, chroms=None, indel_ratio=0.1, known_ratio=0.5, seed=1, database=None):
+    rng = random.Random(seed)
+    if chroms is None:
+        chroms = [(chrom, float(length)) for chrom, length in CHROM_LENGTHS]
+    lengths = dict(CHROM_LENGTHS)
+    known = knownVariants(database) if known_ratio > 0 else {}
+    total = sum([weight for chrom, weight in chroms])
+
+    variants = []
+    for n in range(records):
+        r = rng.random() * total
+        c = 0
+        while c < len(chroms)-1 and r >= chroms[c][1]:
+            r = r - chroms[c][1]
+            c = c+1
+        chrom = chroms[c][0]
+        indel = rng.random() < indel_ratio
+        candidates = known.get((sources.bareChrom(chrom), indel))
+        if candidates and rng.random() < known_ratio:
+            pos, ref, alt = rng.choice(candidates)
+        else:
+            pos, ref, alt = novelVariant(rng, lengths.get(sources.bareChrom(chrom).upper(), 100000000), indel)
+        an = rng.randint(1, 200)
+        variants.append((c, pos, ref, alt, 'AC=' + str(rng.randint(1, an)) + ';AN=' + str(an)))
+    variants.sort()
+
+    fh = open(path, 'w')
+    fh.write('##fileformat=VCFv4.1\n')
+    fh.write('##source=anntools benchmark seed=' + str(seed) + '\n')
+    fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+    for c, pos, ref, alt, info in variants:
+        fh.write('\t'.join([chroms[c][0], str(pos), '.', ref, alt, '.', '.', info]) + '\n')
+    fh.close()
+    return len(variants)
+
+
+# columns of the synthetic tables: the ones the stages read, at the positions they read them
+REFSEQ_COLUMNS = ['id', 'CHR', 'start', 'end', 'haplotypeReference', 'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+                  'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist', 'referenceCodon', 'referenceAA', 'variantCodon',
+                  'variantAA', 'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr', 'inCodingRegion', 'spliceInfo',
+                  'uorfChange']
+COLUMNS = {'dbSNP': ['bin', 'CHR', 'POS', 'RSID', 'REF', 'ALT', 'INFO', 'GMAF'],
+           'chrom_pos_equal_base': REFSEQ_COLUMNS,
+           'chrom_pos_equal_nobase': REFSEQ_COLUMNS,
+           'chrom_pos_unequal': REFSEQ_COLUMNS,
+           'refGene': ['bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts',
+                       'exonEnds', 'score', 'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames'],
+           'cpgIslandExt': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'length', 'cpgNum', 'gcNum', 'perCpg', 'perGc', 'obsExp'],
+           'cytoBand': ['chrom', 'chromStart', 'chromEnd', 'name', 'gieStain'],
+           'gadAll': ['chromosome', 'chromStart', 'chromEnd', 'geneSymbol', 'association'],
+           'gwasCatalog': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'pubMedID', 'author', 'pubDate', 'journal', 'title', 'trait'],
+           'targetScanS': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand'],
+           'hugo': ['chrom', 'chromStart', 'chromEnd', 'hgncId', 'status', 'symbol', 'description'],
+           'genomicSuperDups': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand', 'otherChrom', 'otherStart', 'otherEnd'],
+           'putativePromoter': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand', 'gene']}
+CNV_COLUMNS = ['bin', 'chrom', 'chromStart', 'chromEnd', 'name']
+TFBS_COLUMNS = ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand', 'zScore']
+
+# share of a chromosome covered by the regions of a table
+COVERAGE = {'cpgIslandExt': 0.01, 'gadAll': 0.3, 'targetScanS': 0.001, 'hugo': 0.3, 'dgv_Cnv': 0.05,
+            'abParts_IG_T_CelReceptors': 0.01, 'mcCarroll_Cnv': 0.05, 'conrad_Cnv': 0.05, 'genomicSuperDups': 0.05,
+            'putativePromoter': 0.02, 'tfbsConsSites': 0.01}
+
+
+class SyntheticSource(sources.Source):
+    """ Seeded random annotation tables on the chromosomes of the benchmark, about rows rows each
+
+        Every table gets its own generator seeded from seed and the table name, so
+        a table does not change with the tables generated before it. dbSNP
+        positions are reused by the chrom_pos and gwasCatalog tables, so that the
+        known variants of the VCF (see generate) match them too.
+    """
+
+    def __init__(self, chroms, rows, seed):
+        self.chroms = [(sources.bareChrom(chrom).upper(), weight) for chrom, weight in chroms]
+        self.rows = rows
+        self.seed = seed
+        self.lengths = dict(CHROM_LENGTHS)
+        self.tables = {}
+
+    def columns(self, table):
+        if table in COLUMNS:
+            return COLUMNS[table]
+        if table.startswith('tfbsConsSites'):
+            return TFBS_COLUMNS
+        return CNV_COLUMNS
+
+    def scan(self, table):
+        if table not in self.tables:
+            self.tables[table] = self.generateTable(table, random.Random(str(self.seed) + ':' + table))
+        return self.columns(table), self.tables[table]
+
+    def counts(self):
+        """ (chrom, length, rows) of every chromosome, rows shared by weight """
+        total = sum([weight for chrom, weight in self.chroms])
+        return [(chrom, self.lengths.get(chrom, 100000000), max(1, int(round(self.rows*weight/total)))) for chrom, weight in self.chroms]
+
+    def regions(self, rng, chrom, length, n, coverage, maxLength=None):
+        """ n random (start, end) of about coverage*length/n bases """
+        mean = max(1, int(coverage*length/n))
+        regions = []
+        for i in range(n):
+            size = rng.randint(1, 2*mean if maxLength is None else min(2*mean, maxLength))
+            start = rng.randint(0, max(0, length - size))
+            regions.append((start, start + size))
+        return regions
+
+    def generateTable(self, table, rng):
+        rows = []
+        for chrom, length, n in self.counts():
+            ucsc = 'chr' + chrom
+            if table == 'dbSNP':
+                for i in range(n):
+                    pos = rng.randint(1, length)
+                    ref = rng.choice(BASES)
+                    if rng.random() < 0.1:
+                        alt = ref + ''.join([rng.choice(BASES) for b in range(rng.randint(1, 5))])
+                        info = 'DIV'
+                    else:
+                        alt = rng.choice([b for b in BASES if b != ref])
+                        info = 'SNV'
+                    gmaf = '.' if rng.random() < 0.3 else '0.' + str(rng.randint(1, 499)).zfill(3)
+                    rows.append((0, chrom, pos, 'rs' + str(rng.randint(1, 10**8)), ref, alt, info, gmaf))
+            elif table in ('chrom_pos_equal_base', 'chrom_pos_equal_nobase', 'chrom_pos_unequal'):
+                known = [row for row in self.scan('dbSNP')[1] if row[1] == chrom]
+                for i in range(n):
+                    if table == 'chrom_pos_unequal' or len(known) == 0:
+                        start = rng.randint(1, length)
+                        end = start + rng.randint(1, 50)
+                        ref, alt = rng.choice(BASES), rng.choice(BASES)
+                    else:
+                        snp = rng.choice(known)
+                        start = end = snp[2]
+                        ref, alt = (snp[4], snp[5]) if table == 'chrom_pos_equal_base' else (rng.choice(BASES), rng.choice(BASES))
+                    gene = rng.randint(1, 5000)
+                    rows.append((len(rows), chrom, start, end, ref, alt, 'NM_' + str(gene), 'GENE' + str(gene), rng.choice('+-'),
+                                 rng.choice(['CDS', 'intron', 'utr5', 'utr3', 'non_coding_exon', 'non_coding_intron']), str(rng.randint(0, 2)),
+                                 str(rng.randint(1, 5000)), str(rng.randint(1, 1500)), '0', '', '', '', '', rng.choice(['', 'Y']),
+                                 rng.choice(['silent', 'missense', 'nonsense', '']), '', '', rng.choice(['true', 'false']), '', ''))
+            elif table == 'refGene':
+                for start, end in self.regions(rng, chrom, length, n, 0.4):
+                    exonCount = rng.randint(1, 8)
+                    cuts = sorted(rng.sample(range(start, end + 2*exonCount), 2*exonCount)) if end - start > 4*exonCount else [start, end]
+                    exonStarts, exonEnds = cuts[0::2], cuts[1::2]
+                    start, end = exonStarts[0], exonEnds[-1]
+                    if rng.random() < 0.2:
+                        cdsStart = cdsEnd = end
+                    else:
+                        cdsStart = rng.randint(start, start + (end - start)//3)
+                        cdsEnd = rng.randint(end - (end - start)//3, end)
+                    gene = rng.randint(1, 20000)
+                    rows.append((0, 'NM_' + str(gene), ucsc, rng.choice('+-'), start, end, cdsStart, cdsEnd, len(exonStarts),
+                                 (','.join([str(s) for s in exonStarts]) + ',').encode('utf-8'),
+                                 (','.join([str(e) for e in exonEnds]) + ',').encode('utf-8'),
+                                 0, 'GENE' + str(gene), 'cmpl', 'cmpl', b''))
+            elif table == 'cytoBand':
+                bounds = sorted(rng.sample(range(1, length), n - 1)) if n > 1 else []
+                for i, (start, end) in enumerate(zip([0] + bounds, bounds + [length])):
+                    rows.append((ucsc, start, end, rng.choice('pq') + str(i//10 + 1) + '.' + str(i % 10 + 1), rng.choice(['gneg', 'gpos25', 'gpos50', 'acen'])))
+            elif table == 'gwasCatalog':
+                known = [row for row in self.scan('dbSNP')[1] if row[1] == chrom]
+                for snp in rng.sample(known, min(n, len(known))):
+                    rows.append((0, ucsc, snp[2] - 1, snp[2], snp[3], rng.randint(10**6, 3*10**7), 'Author', '2010-01-01', 'Journal', 'Title',
+                                 'trait ' + str(rng.randint(1, 200))))
+            elif table.startswith('tfbsConsSites'):
+                if sources.bareChrom(table[len('tfbsConsSites'):]).upper() == chrom:
+                    for start, end in self.regions(rng, chrom, length, n, COVERAGE['tfbsConsSites'], maxLength=100):
+                        rows.append((0, ucsc, start, end, 'V$TF' + str(rng.randint(1, 500)), 800, rng.choice('+-'), 2.5))
+            else:
+                for i, (start, end) in enumerate(self.regions(rng, chrom, length, n, COVERAGE.get(table, 0.05))):
+                    name = table + str(i)
+                    if table == 'cpgIslandExt':
+                        rows.append((0, ucsc, start, end, 'CpG: ' + str(rng.randint(20, 200)), end - start, 50, 300, 20.0, 60.0, 0.8))
+                    elif table == 'gadAll':
+                        rows.append((chrom, start, end, 'GENE' + str(rng.randint(1, 2000)), rng.choice(['Y', 'N'])))
+                    elif table == 'targetScanS':
+                        rows.append((0, ucsc, start, end, 'MIR' + str(rng.randint(1, 800)), rng.randint(50, 100), rng.choice('+-')))
+                    elif table == 'hugo':
+                        rows.append((ucsc, start, end, 'HGNC:' + str(i), 'Approved', 'GENE' + str(rng.randint(1, 2000)), 'gene ' + str(i)))
+                    elif table == 'genomicSuperDups':
+                        rows.append((0, ucsc, start, end, name, 1000, rng.choice('+-'), 'chr' + rng.choice(self.chroms)[0], start + 7, end + 7))
+                    elif table == 'putativePromoter':
+                        rows.append((0, ucsc, start, end, name, 0, rng.choice('+-'), 'GENE' + str(rng.randint(1, 2000))))
+                    else:
+                        rows.append((0, ucsc, start, end, name))
+        return rows
+
+
+""" Creates the fixture database unless it exists: generated (kind synthetic) or exported from the annotator database (mysql) """
+def fixture(database, chroms, rows, kind='synthetic', seed=1):
+    if os.path.exists(database):
+        return
+    if kind == 'mysql':
+        print("Exporting fixture database " + database)
+        sources.export_sqlite(database, chroms=[chrom for chrom, weight in chroms], limit=rows)
+    elif kind == 'synthetic':
+        print("Generating fixture database " + database)
+        sources.export_sqlite(database, source=SyntheticSource(chroms, rows, seed))
+    else:
+        raise ValueError('Unknown fixture: ' + str(kind))
+
+
+""" md5 of a file """
+def md5(path):
+    digest = hashlib.md5()
+    fh = open(path, 'rb')
+    for chunk in iter(lambda: fh.read(1 << 20), b''):
+        digest.update(chunk)
+    fh.close()
+    return digest.hexdigest()
+
+
+""" Annotates a copy of vcf in a new directory, in a fresh process; returns its metrics with the md5 of the output """
+def runOnce(vcf, options):
+    directory = tempfile.mkdtemp(prefix='.benchmark')
+    try:
+        infile = os.path.join(directory, os.path.basename(vcf))
+        shutil.copyfile(vcf, infile)
+        process = multiprocessing.get_context('fork').Process(target=driver.run, args=(infile, 'vcf'), kwargs=options)
+        started = time.time()
+        process.start()
+        process.join()
+        seconds = time.time() - started
+        if process.exitcode != 0:
+            return {'error': 'exit code ' + str(process.exitcode), 'seconds': seconds}
+
+        fh = open(metrics.metricsName(infile))
+        values = json.load(fh)
+        fh.close()
+        values['process_seconds'] = seconds
+        values['output_md5'] = md5(pipeline.outputNames(infile)[0])
+        return values
+    finally:
+        shutil.rmtree(directory)
+
+
+""" Runs every configuration repeat times on vcf; returns the run entries of the report """
+def benchmark(vcf, records, database, configurations=CONFIGURATIONS, repeat=3, mysql=False, dbsnp_store=None):
+    variants = []
+    for name, options, usesMysql in configurations:
+        if usesMysql and not mysql:
+            continue
+        options = dict(options)
+        if options.get('source') in ('sqlite', 'memory'):
+            options['sqlite_database'] = database
+        variants.append((name, options))
+        if dbsnp_store and options['engine'] == 'stream':
+            variants.append((name + '-store', dict(options, dbsnp_store=dbsnp_store)))
+
+    runs = []
+    for name, options in variants:
+        results = []
+        for i in range(repeat):
+            print("Benchmark " + name + " run " + str(i+1) + " of " + str(repeat))
+            results.append(runOnce(vcf, options))
+
+        times = sorted([result['seconds'] for result in results if 'error' not in result])
+        entry = {'name': name, 'options': options, 'runs': results}
+        if len(times) > 0:
+            entry['median_seconds'] = times[len(times)//2]
+            entry['records_per_second'] = records/entry['median_seconds'] if entry['median_seconds'] > 0 else None
+            entry['output_md5'] = sorted(set([result['output_md5'] for result in results if 'output_md5' in result]))
+        runs.append(entry)
+    return runs
+
+
+def main(report, values):
+    chroms = parseChroms(values['chroms'])
+    database = os.path.abspath(values['database'])
+    mysql = values['mysql'].lower() in ('1', 'true', 'yes', 'on')
+    fixture(database, chroms, int(values['fixture_rows']), kind=values['fixture'], seed=int(values['fixture_seed']))
+
+    directory = tempfile.mkdtemp(prefix='.benchmark')
+    try:
+        vcf = os.path.join(directory, 'benchmark.vcf')
+        records = generate(vcf, records=int(values['records']), chroms=chroms, indel_ratio=float(values['indel_ratio']),
+                           known_ratio=float(values['known_ratio']), seed=int(values['seed']), database=database)
+        runs = benchmark(vcf, records, database, repeat=int(values['repeat']), mysql=mysql, dbsnp_store=values['dbsnp_store'] or None)
+        input_bytes = os.path.getsize(vcf)
+    finally:
+        shutil.rmtree(directory)
+
+    values = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(),
+              'input': {'records': records, 'bytes': input_bytes, 'chroms': values['chroms'], 'indel_ratio': float(values['indel_ratio']),
+                        'known_ratio': float(values['known_ratio']), 'seed': int(values['seed'])},
+              'database': database,
+              'fixture': {'kind': values['fixture'], 'rows': int(values['fixture_rows']), 'seed': int(values['fixture_seed'])},
+              'runs': runs}
+    fh = open(report, 'w')
+    json.dump(values, fh, indent=2)
+    fh.close()
+
+    for run in runs:
+        if 'median_seconds' in run:
+            print(run['name'] + ": " + str(round(run['median_seconds'], 2)) + " s, " + str(int(run['records_per_second'] or 0)) + " records/s")
+        else:
+            print(run['name'] + ": failed")
+
+
+if __name__ == '__main__':
+    # the original stages join sets of strings, whose order follows the string hash seed:
+    # fix it so the md5 of an output is the same from one benchmark to the next
+    if os.environ.get('PYTHONHASHSEED') is None:
+        os.environ['PYTHONHASHSEED'] = '0'
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    if len(sys.argv) > 1:
+        values = dict(DEFAULTS)
+        for arg in sys.argv[2:]:
+            name, value = arg.split('=', 1)
+            if name not in values:
+                raise ValueError('Unknown option: ' + name)
+            values[name] = value
+        main(sys.argv[1], values)
+    else:
+        print("Usage: python benchmark.py <report.json> [records=10000] [chroms=1:2,2:1,X:1] [indel_ratio=0.1] [known_ratio=0.5] [seed=1]")
+        print("       [database=benchmark.sqlite] [fixture=synthetic] [fixture_rows=20000] [fixture_seed=1] [dbsnp_store=<store directory>]")
+        print("       [repeat=3] [mysql=false]")
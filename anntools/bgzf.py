@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+""" Block gzip (BGZF) output with a tabix index
+
+    compress_vcf turns an annotated VCF into <name>.vcf.gz, a series of gzip
+    members of at most 64 KB each (the format of bgzip, readable by gzip and
+    zcat), and <name>.vcf.gz.tbi, a tabix index of it (the format of tabix -p
+    vcf). A region of the result can then be read with a couple of ranged reads
+    instead of the whole file: the index gives the compressed offsets of the
+    blocks holding the records of the region.
+
+    The index is only written for coordinate sorted files (every chromosome in
+    one run, positions not decreasing); for others the .vcf.gz is written alone.
+"""
+
+import os
+import struct
+import zlib
+
+# uncompressed bytes per block, so that a compressed block always fits in 64 KB
+BLOCK_SIZE = 0xff00
+
+# the empty block bgzip ends files with
+EOF_BLOCK = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# tabix: 16 kb windows of the linear index, bins of the UCSC binning scheme
+LINEAR_SHIFT = 14
+TBI_FORMAT_VCF = 2
+
+
+""" One BGZF block holding data """
+def compressBlock(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    """ Writes BGZF blocks to a binary file; tell() is the virtual offset of the next byte written """
+
+    def __init__(self, fh, level=6):
+        self.fh = fh
+        self.level = level
+        self.buffer = bytearray()
+        self.coffset = 0
+
+    def tell(self):
+        return (self.coffset << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.flushBlock(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def flushBlock(self, data):
+        block = compressBlock(data, self.level)
+        self.fh.write(block)
+        self.coffset = self.coffset + len(block)
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.flushBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(EOF_BLOCK)
+
+
+""" Bin of the UCSC binning scheme holding the 0-based, end exclusive region beg..end """
+def reg2bin(beg, end):
+    end = end-1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15)-1)//7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12)-1)//7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9)-1)//7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6)-1)//7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3)-1)//7 + (beg >> 26)
+    return 0
+
+
+""" Bins that may hold records overlapping the 0-based, end exclusive region beg..end """
+def reg2bins(beg, end):
+    end = end-1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+class TabixIndex(object):
+    """ Bins with their chunks and the linear index of every chromosome, in file order """
+
+    def __init__(self):
+        self.names = []
+        self.bins = []
+        self.linear = []
+
+    def add(self, chrom, beg, end, vstart, vend):
+        """ Adds a record at 0-based beg..end (end exclusive) stored at virtual offsets vstart..vend """
+        if len(self.names) == 0 or self.names[-1] != chrom:
+            self.names.append(chrom)
+            self.bins.append({})
+            self.linear.append([])
+        chunks = self.bins[-1].setdefault(reg2bin(beg, end), [])
+        # records of a bin that start in the block where its last chunk ends join that
+        # chunk: the block is read anyway and readers skip the records in between
+        if len(chunks) > 0 and chunks[-1][1] >> 16 == vstart >> 16:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+        linear = self.linear[-1]
+        last = (max(end, beg+1)-1) >> LINEAR_SHIFT
+        while len(linear) <= last:
+            linear.append(None)
+        for window in range(beg >> LINEAR_SHIFT, last+1):
+            if linear[window] is None or vstart < linear[window]:
+                linear[window] = vstart
+
+    def serialize(self):
+        names = b''.join([name.encode('utf-8') + b'\x00' for name in self.names])
+        out = [b'TBI\x01', struct.pack('<8i', len(self.names), TBI_FORMAT_VCF, 1, 2, 0, ord('#'), 0, len(names)), names]
+        for bins, linear in zip(self.bins, self.linear):
+            out.append(struct.pack('<i', len(bins)))
+            for bin in sorted(bins):
+                out.append(struct.pack('<Ii', bin, len(bins[bin])))
+                for vstart, vend in bins[bin]:
+                    out.append(struct.pack('<QQ', vstart, vend))
+            # windows without records take the offset of the window before, as in tabix
+            filled = list(linear)
+            previous = 0
+            for window in range(len(filled)):
+                if filled[window] is None:
+                    filled[window] = previous
+                previous = filled[window]
+            out.append(struct.pack('<i', len(filled)))
+            out.append(struct.pack('<' + str(len(filled)) + 'Q', *filled))
+        return b''.join(out)
+
+    def write(self, path):
+        fh = open(path, 'wb')
+        writer = BgzfWriter(fh)
+        writer.write(self.serialize())
+        writer.close()
+        fh.close()
+
+
+""" Names of the compressed file and of its index for infile """
+def outputNames(infile):
+    return infile + '.gz', infile + '.gz.tbi'
+
+
+""" Compresses the VCF infile into infile.gz with a tabix index infile.gz.tbi
+
+    Returns the names of the compressed file and of the index; the index is left
+    out (and None returned for it) if infile is not coordinate sorted. infile is
+    removed unless keep is set.
+"""
+def compress_vcf(infile, keep=False, sep='\t'):
+    outfile, indexfile = outputNames(infile)
+    index = TabixIndex()
+    done = set()
+    last = None
+    sortedInput = True
+
+    fh = open(infile, 'rb')
+    fh_out = open(outfile, 'wb')
+    writer = BgzfWriter(fh_out)
+    for line in fh:
+        vstart = writer.tell()
+        writer.write(line)
+        if not sortedInput or line.startswith(b'#') or len(line.strip()) == 0:
+            continue
+
+        fields = line.rstrip(b'\r\n').decode('utf-8').split(sep)
+        try:
+            chrom = fields[0]
+            beg = int(fields[1])-1
+            end = beg + max(len(fields[3]), 1)
+        except (IndexError, ValueError):
+            sortedInput = False
+            continue
+        if last is not None and (chrom != last[0] and chrom in done or chrom == last[0] and beg < last[1]):
+            sortedInput = False
+            continue
+        if last is not None and chrom != last[0]:
+            done.add(last[0])
+        last = (chrom, beg)
+        index.add(chrom, beg, end, vstart, writer.tell())
+    writer.close()
+    fh_out.close()
+    fh.close()
+
+    if sortedInput:
+        index.write(indexfile)
+    else:
+        print("Not coordinate sorted, no index written for " + outfile)
+        if os.path.exists(indexfile):
+            os.remove(indexfile)
+        indexfile = None
+    if not keep:
+        os.remove(infile)
+    return outfile, indexfile
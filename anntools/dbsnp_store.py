@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+""" Local columnar copy of the dbSNP table
+
+    Build it once per annotator box from the shared MySQL database:
+
+        python dbsnp_store.py /path/to/dbsnp_store
+
+    Every chromosome gets a sorted int32 array of positions (c<N>.pos) and, for
+    each other column of the table, an offset array (c<N>.<column>.off, uint64,
+    one entry per row plus one) into the concatenated utf-8 values
+    (c<N>.<column>.dat). meta.json lists the columns and chromosomes. Arrays are
+    written in the machine's native byte order.
+
+    sources.DbSnpStoreSource opens the store with mmap and binary searches the
+    position arrays, so annotator processes on the same box share the page
+    cache and need no database connection for dbSNP.
+"""
+
+import array
+import bisect
+import json
+import mmap
+import os
+import sys
+
+import intervals
+
+# stands in for SQL NULL in the string columns
+NULL = '\x00'
+
+
+################################################################################
+###                                READ                                      ###
+################################################################################
+
+""" mmap of a whole file; empty files cannot be mapped """
+def mapFile(path):
+    if os.path.getsize(path) == 0:
+        return b''
+    fh = open(path, 'rb')
+    mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    fh.close()
+    return mm
+
+
+class StringColumn(object):
+    """ Offset indexed utf-8 values of one column of one chromosome """
+
+    def __init__(self, prefix):
+        self.offsets = memoryview(mapFile(prefix + '.off')).cast('Q')
+        self.data = mapFile(prefix + '.dat')
+
+    def __getitem__(self, i):
+        value = self.data[self.offsets[i]:self.offsets[i+1]].decode('utf-8')
+        if value == NULL:
+            return None
+        return value
+
+
+class Chromosome(object):
+    """ Position array and string columns of one chromosome """
+
+    def __init__(self, path, prefix, name, columns, posColumn, chrColumn):
+        self.name = name
+        self.positions = memoryview(mapFile(os.path.join(path, prefix + '.pos'))).cast('i')
+        self.columns = []
+        for column in columns:
+            if column == posColumn or column == chrColumn:
+                self.columns.append(None)
+            else:
+                self.columns.append(StringColumn(os.path.join(path, prefix + '.' + column)))
+        self.posIndex = columns.index(posColumn)
+        self.chrIndex = columns.index(chrColumn)
+
+    def row(self, i):
+        values = []
+        for index, column in enumerate(self.columns):
+            if index == self.posIndex:
+                values.append(self.positions[i])
+            elif index == self.chrIndex:
+                values.append(self.name)
+            else:
+                values.append(column[i])
+        return tuple(values)
+
+    def rows(self, pos):
+        """ All rows at pos, in the order they were exported """
+        first = bisect.bisect_left(self.positions, pos)
+        last = bisect.bisect_right(self.positions, pos, first)
+        return [self.row(i) for i in range(first, last)]
+
+
+class DbSnpStore(object):
+    """ Read side of the store; rows look like the rows of "select * from dbSNP" """
+
+    def __init__(self, path):
+        fh = open(os.path.join(path, 'meta.json'))
+        meta = json.load(fh)
+        fh.close()
+        self.table = meta['table']
+        self.columns = meta['columns']
+        self.chrIndex = self.columns.index(meta['chr_column'])
+        self.posIndex = self.columns.index(meta['pos_column'])
+        self.refIndex = self.columns.index(meta['ref_column'])
+        self.infoIndex = self.columns.index(meta['info_column'])
+        self.chroms = {}
+        for prefix, name in meta['chroms']:
+            chrom = Chromosome(path, prefix, name, self.columns, meta['pos_column'], meta['chr_column'])
+            self.chroms[intervals.chromKey(name)] = chrom
+
+    def rows(self, chrom, pos):
+        data = self.chroms.get(intervals.chromKey(chrom))
+        if data is None:
+            return []
+        return data.rows(pos)
+
+
+# stores stay mapped for the life of the process
+_stores = {}
+
+""" Returns the store at path, opening it on first use """
+def getStore(path):
+    if path not in _stores:
+        _stores[path] = DbSnpStore(path)
+    return _stores[path]
+
+
+################################################################################
+###                                BUILD                                     ###
+################################################################################
+
+class ChromosomeWriter(object):
+    """ Appends the rows of one chromosome to its column files """
+
+    def __init__(self, path, prefix, columns, posIndex, chrIndex):
+        self.posIndex = posIndex
+        self.positions = array.array('i')
+        self.fh_pos = open(os.path.join(path, prefix + '.pos'), 'wb')
+        self.indices = [i for i in range(len(columns)) if i != posIndex and i != chrIndex]
+        self.offsets = {}
+        self.data = {}
+        self.size = {}
+        self.fh_off = {}
+        self.fh_dat = {}
+        for index in self.indices:
+            self.offsets[index] = array.array('Q', [0])
+            self.data[index] = []
+            self.size[index] = 0
+            self.fh_off[index] = open(os.path.join(path, prefix + '.' + columns[index] + '.off'), 'wb')
+            self.fh_dat[index] = open(os.path.join(path, prefix + '.' + columns[index] + '.dat'), 'wb')
+        self.lastPos = None
+
+    def write(self, row):
+        pos = int(row[self.posIndex])
+        if self.lastPos is not None and pos < self.lastPos:
+            raise ValueError('dbSNP rows must be exported sorted by position')
+        self.lastPos = pos
+        self.positions.append(pos)
+        for index in self.indices:
+            value = NULL if row[index] is None else str(row[index])
+            data = value.encode('utf-8')
+            self.data[index].append(data)
+            self.size[index] = self.size[index] + len(data)
+            self.offsets[index].append(self.size[index])
+        if len(self.positions) >= 100000:
+            self.flush()
+
+    def flush(self):
+        self.positions.tofile(self.fh_pos)
+        self.positions = array.array('i')
+        for index in self.indices:
+            self.offsets[index].tofile(self.fh_off[index])
+            self.fh_dat[index].write(b''.join(self.data[index]))
+            self.offsets[index] = array.array('Q')
+            self.data[index] = []
+
+    def close(self):
+        self.flush()
+        self.fh_pos.close()
+        for index in self.indices:
+            self.fh_off[index].close()
+            self.fh_dat[index].close()
+
+
+""" Exports the dbSNP table of the annotator database into a store at path """
+def build(path, table='dbSNP', chrColumn='CHR', posColumn='POS', refColumn='REF', infoColumn='INFO'):
+    import pymysql
+    import sql_config
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    conn = sql_config.conn2annotator()
+    # unbuffered cursor: rows are streamed instead of loaded all at once
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute('select * from ' + table + ' order by ' + chrColumn + ', ' + posColumn + ';')
+    columns = [str(d[0]) for d in cursor.description]
+    chrIndex = intervals.columnIndex(columns, chrColumn)
+    posIndex = intervals.columnIndex(columns, posColumn)
+    refIndex = intervals.columnIndex(columns, refColumn)
+    infoIndex = intervals.columnIndex(columns, infoColumn)
+
+    # rows are grouped by the collated chromosome (intervals.chromKey, how the store
+    # is looked up): MySQL sorts values that differ only in case or trailing spaces
+    # together, interleaving their positions, and they are one chromosome to a query
+    chroms = []
+    keys = set()
+    writer = None
+    total = 0
+    for row in cursor:
+        key = intervals.chromKey(row[chrIndex])
+        if writer is None or key != intervals.chromKey(chroms[-1][1]):
+            if key in keys:
+                raise ValueError('dbSNP rows must be exported sorted by chromosome')
+            keys.add(key)
+            if writer is not None:
+                writer.close()
+            prefix = 'c' + str(len(chroms))
+            chroms.append([prefix, str(row[chrIndex])])
+            writer = ChromosomeWriter(path, prefix, columns, posIndex, chrIndex)
+        writer.write(row)
+        total = total+1
+    if writer is not None:
+        writer.close()
+
+    cursor.close()
+    conn.close()
+
+    meta = {'table': table,
+            'columns': columns,
+            'chr_column': columns[chrIndex],
+            'pos_column': columns[posIndex],
+            'ref_column': columns[refIndex],
+            'info_column': columns[infoIndex],
+            'chroms': chroms,
+            'rows': total}
+    fh = open(os.path.join(path, 'meta.json'), 'w')
+    json.dump(meta, fh, indent=2)
+    fh.close()
+    print("Exported " + str(total) + " rows of " + table + " in " + str(len(chroms)) + " chromosomes to " + path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        build(sys.argv[1])
+    else:
+        print("Usage: python dbsnp_store.py <store directory>")
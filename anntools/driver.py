@@ -36,78 +36,153 @@ import sys
 import os
 import file_utils as fu
 import annotate as ann
-
-def run(infile, format):
+import bgzf
+import metrics
+import parallel
+import pipeline
+
+# stages of the file to file engine, one annotate.* function each
+FILES_STAGES = 14
+
+""" engine='stream' annotates in a single pass (see pipeline.py), engine='files' runs the annotate.* functions one after another
+    index=True lets the stream engine answer the region tables from in-memory interval indexes (see intervals.py)
+    sweep=True merge-joins coordinate sorted input against those indexes, falling back to lookups if it is not sorted
+    gene_model=True classifies variants against refGene preloaded into NumPy arrays (see genes.py)
+    source picks where the stream engine reads the tables from: mysql, sqlite (sqlite_database) or memory (see sources.py)
+    dbsnp_store points the stream engine at a local dbSNP store (see dbsnp_store.py) instead of the dbSNP table
+    workers != 1 splits the records into shards (by chrom or in equal chunks) annotated in parallel (see parallel.py)
+    Both engines write per-stage timings and query counts to <infile>.metrics.json (see metrics.py)
+    lines, if given, are the lines of the input (e.g. streamed from S3 by s3stream.py): the single process stream
+    engine annotates them as they come, the others need a file and write them to infile first
+    compress=True replaces the .annot.vcf by a bgzip compressed .annot.vcf.gz with a tabix index .annot.vcf.gz.tbi (see bgzf.py)
+    progress, a progress.Progress, is told the current stage, the records annotated and how much of the input is done (see progress.py)
+"""
+def run(infile, format, engine='files', index=False, sweep=False, dbsnp_store=None, source='mysql', sqlite_database=None,
+        workers=1, shard='chrom', gene_model=False, lines=None, compress=False, progress=None):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', tmpextout='.1' )
+    annotate(infile, format, engine=engine, index=index, sweep=sweep, dbsnp_store=dbsnp_store, source=source, sqlite_database=sqlite_database,
+             workers=workers, shard=shard, gene_model=gene_model, lines=lines, progress=progress)
+
+    if compress:
+        if progress is not None:
+            progress.setStage('compressing')
+        bgzf.compress_vcf(pipeline.outputNames(infile)[0])
+
+    if progress is not None:
+        progress.finish()
+
+
+""" Annotates infile with the selected engine into <name>.annot.vcf; see run for the options """
+def annotate(infile, format, engine='files', index=False, sweep=False, dbsnp_store=None, source='mysql', sqlite_database=None,
+             workers=1, shard='chrom', gene_model=False, lines=None, progress=None):
+
+    if lines is not None and not (engine == 'stream' and workers == 1):
+        if progress is not None:
+            progress.setStage('reading input')
+        fh = open(infile, 'w')
+        for line in lines:
+            fh.write(line)
+        fh.close()
+        lines = None
+
+    if engine == 'stream' and workers != 1:
+        parallel.run(infile, format=format, workers=workers, shard=shard, index=index, sweep=sweep, gene_model=gene_model,
+                     source=source, sqlite_database=sqlite_database, dbsnp_store=dbsnp_store, progress=progress)
+        return
+
+    if engine == 'stream':
+        pipeline.run(infile, format=format, index=index, sweep=sweep, gene_model=gene_model,
+                     source=source, sqlite_database=sqlite_database, dbsnp_store=dbsnp_store, lines=lines, progress=progress)
+        return
+
+    runMetrics = metrics.RunMetrics(infile, 'files', progress=progress, stages=FILES_STAGES)
+    records = parallel.countRecords(infile)
+    if progress is not None:
+        progress.recordsTotal = records
+
+    with runMetrics.timed('getSnpsFromDbSnp', infile+'.1', records):
+        ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', tmpextout='.1' )
     #print("Done dbSNP")
     # Set numbering
     tmpextin=1
     tmpextout=2
 
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('getBigRefGene', infile+'.'+str(tmpextout), records):
+        ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("Done BigRefGene ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', promoter_offset=500, tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('getGenes(refGene)', infile+'.'+str(tmpextout), records):
+        ann.getGenes(vcf=infile, format='vcf', table='refGene', promoter_offset=500, tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("Done RefGene")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithCytoband(cytoBand)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("cytoband ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithGadAll(gadAll)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("gadAll ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', table='gwasCatalog', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithGwasCatalog(gwasCatalog)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', table='gwasCatalog', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("GwasCatalog ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithMiRNA(targetScanS)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("miRNA")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', table='hugo', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWitHUGOGeneNomenclature(hugo)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', table='hugo', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("HUGO Gene Nomenclature Committee (HGNC) ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithCnvDatabase(dgv_Cnv)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("dgv_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='abParts_IG_T_CelReceptors', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithCnvDatabase(abParts_IG_T_CelReceptors)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='abParts_IG_T_CelReceptors', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("abParts_IG_T_CelReceptors")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='mcCarroll_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithCnvDatabase(mcCarroll_Cnv)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='mcCarroll_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("mcCarroll_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='conrad_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithCnvDatabase(conrad_Cnv)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='conrad_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("conrad_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', table='genomicSuperDups', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithGenomicSuperDups(genomicSuperDups)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', table='genomicSuperDups', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("genomicSuperDups")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    with runMetrics.timed('addOverlapWithTfbsConsSites(tfbsConsSites)', infile+'.'+str(tmpextout), records):
+        ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("addOverlapWithTfbsConsSites")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
@@ -119,3 +194,4 @@ def run(infile, format):
     os.rename(infile+'.'+str(tmpextin), infile+'.annot')
     finalout=(infile+'.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile+'.annot', finalout)
+    runMetrics.write(finalout)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+""" refGene preloaded into NumPy arrays for the gene stage of pipeline.py
+
+    annotate.getGenes decodes and splits the exonStarts/exonEnds blobs of every
+    overlapping transcript and loops over its exons in Python, for every variant.
+    A GeneModel parses the table once into arrays of transcript bounds, CDS
+    bounds and a flattened exon table with per-transcript offsets, so that the
+    exon, CDS and promoter tests of a whole block of (position, transcript)
+    pairs are a handful of vectorized comparisons and one searchsorted.
+
+    Transcripts the arrays cannot describe exactly (unparsable or unsorted exon
+    lists, overlapping exons, an exonCount that does not match the lists) are
+    flagged irregular and classified by the original per-row code instead.
+    NumPy is optional: without it GeneStage keeps querying refGene per variant.
+"""
+
+import threading
+
+import intervals
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# exons of transcript t are keyed by t*EXON_KEY + exonStart, so a single
+# searchsorted finds the exon of every (position, transcript) pair
+EXON_KEY = 1 << 32
+
+
+class GeneModel(object):
+    """ Transcripts of a refGene-like table as arrays, in table order
+
+        Column positions are the ones GeneStage.region reads: strand 3, txStart 4,
+        txEnd 5, cdsStart 6, cdsEnd 7, exonCount 8, exonStarts 9, exonEnds 10.
+    """
+
+    def __init__(self, columns, rows, chromName='chrom', startName='txStart', endName='txEnd', orderNames=None):
+        self.rows = rows
+        orderIndexes = None if orderNames is None else [intervals.columnIndex(columns, name) for name in orderNames]
+        self.index = intervals.IntervalIndex(rows, intervals.columnIndex(columns, chromName),
+                                             intervals.columnIndex(columns, startName), intervals.columnIndex(columns, endName),
+                                             orderIndexes=orderIndexes)
+        n = len(rows)
+        bounds = np.zeros((n, 4), dtype=np.int64)
+        exonCount = np.zeros(n, dtype=np.int64)
+        plus = np.zeros(n, dtype=bool)
+        minus = np.zeros(n, dtype=bool)
+        regular = np.zeros(n, dtype=bool)
+        offsets = np.zeros(n+1, dtype=np.int64)
+        exonKeys = []
+        exonEnds = []
+
+        for t, row in enumerate(rows):
+            exons = self.parse(row)
+            if exons is not None:
+                bounds[t] = [int(row[4]), int(row[5]), int(row[6]), int(row[7])]
+                exonCount[t] = len(exons)
+                plus[t] = str(row[3]) == '+'
+                minus[t] = str(row[3]) == '-'
+                regular[t] = True
+                for start, end in exons:
+                    exonKeys.append(t*EXON_KEY + start)
+                    exonEnds.append(end)
+            offsets[t+1] = len(exonKeys)
+
+        self.txStart = bounds[:, 0]
+        self.txEnd = bounds[:, 1]
+        self.cdsStart = bounds[:, 2]
+        self.cdsEnd = bounds[:, 3]
+        self.exonCount = exonCount
+        self.plus = plus
+        self.minus = minus
+        self.regular = regular
+        self.offsets = offsets
+        self.exonKeys = np.array(exonKeys, dtype=np.int64)
+        self.exonEnds = np.array(exonEnds, dtype=np.int64)
+
+    def parse(self, row):
+        """ The (start, end) exons of a transcript, or None if it is irregular """
+        try:
+            for i in (4, 5, 6, 7):
+                int(row[i])
+            exonCount = int(row[8])
+            exonsSt = str(row[9].decode('utf-8')).split(',')
+            exonsEn = str(row[10].decode('utf-8')).split(',')
+            exons = [(int(exonsSt[e]), int(exonsEn[e])) for e in range(0, exonCount)]
+        except Exception:
+            return None
+
+        # at most one exon may contain a position, and keys must stay within their transcript
+        for e in range(0, len(exons)):
+            if exons[e][0] < 0 or exons[e][0] >= EXON_KEY:
+                return None
+            if e > 0 and (exons[e][0] <= exons[e-1][0] or exons[e-1][1] >= exons[e][0]):
+                return None
+        return exons
+
+    @classmethod
+    def load(cls, source, table='refGene'):
+        columns, rows = source.scan(table)
+        return cls(columns, rows, orderNames=source.rangeOrder(table, 'chrom', 'txStart'))
+
+    def transcripts(self, chrom, start, end):
+        """ Ordinals of the transcripts overlapping start..end, in the order of the refGene query """
+        return [e[2] for e in self.index.entriesInRange(chrom, start, end)]
+
+    def classify(self, positions, transcripts, promoter_offset):
+        """ Vectorized GeneStage.region tests for (position, transcript) pairs
+
+            Returns boolean arrays nonCoding, inCds, inPromoter, inExon and the
+            exon number reported for the exon containing the position.
+        """
+        P = np.asarray(positions, dtype=np.int64)
+        T = np.asarray(transcripts, dtype=np.int64)
+        txStart = self.txStart[T]
+        txEnd = self.txEnd[T]
+        cdsStart = self.cdsStart[T]
+        cdsEnd = self.cdsEnd[T]
+
+        nonCoding = cdsStart == cdsEnd
+        inCds = ~nonCoding & (cdsStart <= P) & (P <= cdsEnd)
+        inPromoter = ~nonCoding & ~inCds & \
+                     ((self.plus[T] & (txStart - promoter_offset <= P) & (P <= txStart)) |
+                      (self.minus[T] & (txEnd <= P) & (P <= txEnd + promoter_offset)))
+
+        first = self.offsets[T]
+        if len(self.exonKeys) == 0:
+            inExon = np.zeros(len(P), dtype=bool)
+            exon = first
+        else:
+            exon = np.searchsorted(self.exonKeys, T*EXON_KEY + P, side='right') - 1
+            inExon = (P >= 0) & (P < EXON_KEY) & (exon >= first) & (self.exonEnds[np.maximum(exon, 0)] >= P)
+        exnum = np.where(self.minus[T], self.exonCount[T] - (exon - first), exon - first + 1)
+        return nonCoding, inCds, inPromoter, inExon, exnum
+
+
+# models stay loaded for the life of the process, per source (see sources.Source.identity)
+_models = {}
+_modelsLock = threading.Lock()
+
+""" Returns the model of a refGene-like table, loading it from source on first use """
+def getModel(source, table='refGene'):
+    key = (source.identity(), table)
+    model = _models.get(key)
+    if model is None:
+        with _modelsLock:
+            model = _models.get(key)
+            if model is None:
+                model = GeneModel.load(source, table)
+                _models[key] = model
+    return model
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+""" In-memory interval index for the region tables (cytoBand, gadAll, hugo, dgv_Cnv, ...)
+
+    The overlap stages used to send one "chromStart <= pos AND pos <= chromEnd"
+    query per variant. An IntervalIndex loads the table once and answers the same
+    point-overlap question in process.
+"""
+
+import bisect
+import threading
+
+
+""" MySQL compares chromosome names case-insensitively and ignores trailing spaces
+    Tables without a chromosome column (one table per chromosome) use chrom=None
+"""
+def chromKey(chrom):
+    if chrom is None:
+        return ''
+    return str(chrom).rstrip().lower()
+
+
+""" Position of a column in the rows of a table, given its column names """
+def columnIndex(columns, name):
+    names = [str(c).lower() for c in columns]
+    return names.index(name.lower())
+
+
+""" Sort key of a column value in a MySQL index: NULL comes first """
+def indexKey(value):
+    return (value is not None, value)
+
+
+class IntervalIndex(object):
+    """ Point-overlap index over the rows of one region table
+
+        Per chromosome the rows are sorted by start and maxEnds[i] holds the largest
+        end among the first i+1 rows, so a lookup walks back from the last row that
+        starts at or before the position and stops as soon as no earlier row can
+        still reach it. Overlapping rows come back in the order of the query they
+        replace: ordered by the columns of orderIndexes (the index MySQL scans for
+        the query, see sources.Source.rangeOrder) and then by table order, or in
+        table order if orderIndexes is None. Entries are (start, end, ordinal in
+        the table, row, rank in that order).
+    """
+
+    def __init__(self, rows, chromIndex, startIndex, endIndex, orderIndexes=None):
+        byChrom = {}
+        kept = []
+        ordinal = 0
+        for row in rows:
+            chrom = None if chromIndex is None else row[chromIndex]
+            # NULL values never satisfy the SQL comparison either
+            if row[startIndex] is not None and row[endIndex] is not None and (chromIndex is None or chrom is not None):
+                kept.append((ordinal, row))
+            ordinal = ordinal+1
+
+        ranks = None
+        if orderIndexes:
+            ranked = sorted(kept, key=lambda k: (tuple([indexKey(k[1][i]) for i in orderIndexes]), k[0]))
+            ranks = dict([(k[0], rank) for rank, k in enumerate(ranked)])
+        for ordinal, row in kept:
+            chrom = None if chromIndex is None else row[chromIndex]
+            entry = (int(row[startIndex]), int(row[endIndex]), ordinal, row, ordinal if ranks is None else ranks[ordinal])
+            byChrom.setdefault(chromKey(chrom), []).append(entry)
+
+        self.chroms = {}
+        for key, entries in byChrom.items():
+            entries.sort(key=lambda e: (e[0], e[2]))
+            maxEnds = []
+            maxEnd = entries[0][1]
+            for e in entries:
+                if e[1] > maxEnd:
+                    maxEnd = e[1]
+                maxEnds.append(maxEnd)
+            self.chroms[key] = ([e[0] for e in entries], maxEnds, entries)
+        self.size = ordinal
+
+    @classmethod
+    def load(cls, source, table, chromName='chrom', startName='chromStart', endName='chromEnd'):
+        """ Reads the whole table once from a sources.Source; chromName=None for tables without one """
+        columns, rows = source.scan(table)
+        chromIndex = None if chromName is None else columnIndex(columns, chromName)
+        orderNames = source.rangeOrder(table, chromName, startName)
+        orderIndexes = None if orderNames is None else [columnIndex(columns, name) for name in orderNames]
+        return cls(rows, chromIndex, columnIndex(columns, startName), columnIndex(columns, endName), orderIndexes=orderIndexes)
+
+    def overlapping(self, chrom, pos):
+        """ Rows with start <= pos <= end on chrom """
+        return self.overlappingRange(chrom, pos, pos)
+
+    def overlappingRange(self, chrom, start, end):
+        """ Rows with rowStart <= end and start <= rowEnd on chrom """
+        return [e[3] for e in self.entriesInRange(chrom, start, end)]
+
+    def entriesInRange(self, chrom, start, end):
+        """ Entries of the rows overlapping start..end, in the order of the query """
+        data = self.chroms.get(chromKey(chrom))
+        if data is None:
+            return []
+        starts, maxEnds, entries = data
+
+        hits = []
+        i = bisect.bisect_right(starts, end) - 1
+        while i >= 0 and maxEnds[i] >= start:
+            if entries[i][1] >= start:
+                hits.append(entries[i])
+            i = i-1
+
+        if len(hits) > 1:
+            hits.sort(key=lambda e: e[4])
+        return hits
+
+
+class Sweep(object):
+    """ Merge-join of coordinate sorted variants against an IntervalIndex
+
+        The rows of a chromosome are walked in start order alongside the variants,
+        keeping the window of rows that are still active (end >= position), so a
+        sorted input costs one linear pass over both. As soon as a position goes
+        backwards, or a chromosome comes back after another one, the input is not
+        sorted and every further lookup falls back to IntervalIndex.overlapping.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.sorted = True
+        self.chrom = None
+        self.pos = None
+        self.seen = set()
+        self.starts = []
+        self.entries = []
+        self.next = 0
+        self.active = []
+
+    def overlapping(self, chrom, pos):
+        if not self.sorted:
+            return self.index.overlapping(chrom, pos)
+
+        key = chromKey(chrom)
+        if key != self.chrom:
+            if key in self.seen:
+                self.sorted = False
+                return self.index.overlapping(chrom, pos)
+            self.seen.add(key)
+            self.chrom = key
+            self.starts, maxEnds, self.entries = self.index.chroms.get(key, ([], [], []))
+            self.next = 0
+            self.active = []
+        elif pos < self.pos:
+            self.sorted = False
+            return self.index.overlapping(chrom, pos)
+        self.pos = pos
+
+        while self.next < len(self.starts) and self.starts[self.next] <= pos:
+            self.active.append(self.entries[self.next])
+            self.next = self.next+1
+        self.active = [e for e in self.active if e[1] >= pos]
+
+        if len(self.active) > 1:
+            return [e[3] for e in sorted(self.active, key=lambda e: e[4])]
+        return [e[3] for e in self.active]
+
+
+# indexes stay loaded for the life of the process, per source (see sources.Source.identity)
+_indexes = {}
+_indexesLock = threading.Lock()
+
+""" Returns the index of a region table, loading it from source on first use """
+def getIndex(source, table, chromName='chrom', startName='chromStart', endName='chromEnd'):
+    key = (source.identity(), table, chromName, startName, endName)
+    index = _indexes.get(key)
+    if index is None:
+        with _indexesLock:
+            index = _indexes.get(key)
+            if index is None:
+                index = IntervalIndex.load(source, table, chromName=chromName, startName=startName, endName=endName)
+                _indexes[key] = index
+    return index
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+""" Per-stage metrics of an annotation run
+
+    For every stage of driver.run the run records the wall time, the records it
+    read, the database queries it issued, the rows those queries returned and
+    the bytes it wrote, and saves them as <infile>.metrics.json next to the
+    .count.log, so run.py uploads them with the results.
+
+    Queries and rows are counted where they happen (the pooled connections of
+    sql_config and sources.SQLiteSource) in per-thread counters, so concurrent
+    jobs of a persistent worker do not mix up their numbers.
+
+    "bytes_written" is the size of the stage's output file for the file to file
+    engine. In the stream engine, stages write nothing themselves, so it is the
+    number of bytes the stage added to the records. The size of the final
+    .annot.vcf is recorded separately.
+"""
+
+import json
+import os
+import threading
+import time
+
+_counters = threading.local()
+
+
+""" The query and row counters of the calling thread """
+def counters():
+    if not hasattr(_counters, 'queries'):
+        _counters.queries = 0
+        _counters.rows = 0
+    return _counters
+
+
+def countQuery():
+    c = counters()
+    c.queries = c.queries+1
+
+
+def countRows(rows):
+    c = counters()
+    c.rows = c.rows+rows
+
+
+""" Size in bytes of the records of a block, as written to the output """
+def blockSize(block, sep='\t'):
+    return sum([len(sep.join(fields))+1 for fields in block])
+
+
+class StageMetrics(object):
+    """ Totals of one stage; start() and stop() bracket every piece of work it does """
+
+    fields = ('seconds', 'open_seconds', 'records', 'queries', 'rows_fetched', 'bytes_written')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.open_seconds = 0.0
+        self.records = 0
+        self.queries = 0
+        self.rows_fetched = 0
+        self.bytes_written = 0
+
+    def start(self):
+        c = counters()
+        self.started = (time.time(), c.queries, c.rows)
+
+    def stop(self, records=0, bytes_written=0, opening=False):
+        c = counters()
+        seconds = time.time() - self.started[0]
+        if opening:
+            self.open_seconds = self.open_seconds+seconds
+        else:
+            self.seconds = self.seconds+seconds
+        self.records = self.records+records
+        self.queries = self.queries + c.queries - self.started[1]
+        self.rows_fetched = self.rows_fetched + c.rows - self.started[2]
+        self.bytes_written = self.bytes_written+bytes_written
+
+    def asDict(self):
+        values = dict([(name, getattr(self, name)) for name in self.fields])
+        values['stage'] = self.name
+        values['records_per_second'] = self.records/self.seconds if self.seconds > 0 else None
+        return values
+
+    def merge(self, values):
+        """ Adds the asDict() of the same stage run in another process """
+        for name in self.fields:
+            setattr(self, name, getattr(self, name) + values[name])
+
+
+class RunMetrics(object):
+    """ Metrics of one annotation run
+
+        With a progress.Progress, every stage started with timed() is reported
+        as the current stage of the run, out of `stages` stages.
+    """
+
+    def __init__(self, infile, engine, options=None, progress=None, stages=0):
+        self.infile = infile
+        self.engine = engine
+        self.options = options or {}
+        self.stages = []
+        self.started = time.time()
+        self.progress = progress
+        self.expectedStages = stages
+
+    def stage(self, name):
+        metrics = StageMetrics(name)
+        self.stages.append(metrics)
+        return metrics
+
+    def timed(self, name, outfile, records):
+        """ Context manager for a file to file stage writing outfile """
+        if self.progress is not None:
+            number = len(self.stages)+1
+            self.progress.setStage(name, number, self.expectedStages,
+                                   fraction=(number-1)/float(self.expectedStages) if self.expectedStages > 0 else None)
+        return TimedStage(self.stage(name), outfile, records)
+
+    def write(self, outfile):
+        values = {'input_file': os.path.basename(self.infile),
+                  'engine': self.engine,
+                  'options': self.options,
+                  'seconds': time.time() - self.started,
+                  'input_bytes': os.path.getsize(self.infile) if os.path.exists(self.infile) else None,
+                  'output_bytes': os.path.getsize(outfile) if os.path.exists(outfile) else None,
+                  'stages': [stage.asDict() for stage in self.stages]}
+        fh = open(metricsName(self.infile), 'w')
+        json.dump(values, fh, indent=2)
+        fh.close()
+
+
+class TimedStage(object):
+
+    def __init__(self, metrics, outfile, records):
+        self.metrics = metrics
+        self.outfile = outfile
+        self.records = records
+
+    def __enter__(self):
+        self.metrics.start()
+        return self.metrics
+
+    def __exit__(self, *args):
+        size = os.path.getsize(self.outfile) if os.path.exists(self.outfile) else 0
+        self.metrics.stop(records=self.records, bytes_written=size)
+
+
+""" Name of the metrics file written for infile """
+def metricsName(infile):
+    return infile+'.metrics.json'
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+""" Parallel annotation of a single VCF
+
+    The records are split into shards, one per chromosome (shard='chrom') or
+    contiguous chunks of about the same number of records (shard='chunk'), and
+    every shard is annotated by the stream engine in a process of a
+    multiprocessing pool. The annotated shards are then merged back in the order
+    of the input with the header lines where they were, and the counts of every
+    stage are added up into a single .count.log, so the output is the same as
+    pipeline.run on the whole file.
+
+    The parent opens the stages before the pool is forked, so interval indexes,
+    the gene model and the dbSNP store are loaded once and shared by all workers.
+"""
+
+import array
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import metrics
+import pipeline
+import sources
+
+# more chromosomes than this (unplaced contigs, ...) share shard files
+MAX_SHARDS = 256
+
+
+""" Number of records (non-header, non-empty lines) in infile """
+def countRecords(infile):
+    total = 0
+    fh = open(infile)
+    for line in fh:
+        line = line.strip()
+        if len(line) > 0 and not line.startswith('#'):
+            total = total+1
+    fh.close()
+    return total
+
+
+""" Writes the records of infile to shard files in directory
+
+    Returns the shard files with their number of records, the header lines, and
+    the layout of the input: for every line the shard its record went to, or -1
+    for the next header line.
+"""
+def split(infile, directory, workers, shard='chrom', sep='\t'):
+    if shard not in ('chrom', 'chunk'):
+        raise ValueError('Unknown shard mode: ' + str(shard))
+    total = countRecords(infile) if shard == 'chunk' else 0
+
+    layout = array.array('i')
+    headers = []
+    shards = []
+    handles = []
+    keys = {}
+    n = 0
+
+    fh = open(infile)
+    for line in fh:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line.startswith('#'):
+            headers.append(line)
+            layout.append(-1)
+            continue
+
+        if shard == 'chunk':
+            key = n*workers//total
+        else:
+            key = line.split(sep, 1)[0].strip()
+        n = n+1
+
+        if key not in keys:
+            if len(shards) < MAX_SHARDS:
+                keys[key] = len(shards)
+                shards.append([os.path.join(directory, 'shard' + str(len(shards)) + '.vcf'), 0])
+                handles.append(open(shards[-1][0], 'w'))
+            else:
+                keys[key] = len(keys) % MAX_SHARDS
+        index = keys[key]
+        handles[index].write(line+'\n')
+        shards[index][1] = shards[index][1]+1
+        layout.append(index)
+
+    fh.close()
+    for handle in handles:
+        handle.close()
+    return shards, headers, layout
+
+
+""" Annotates one shard in a worker process; returns the counts() and the metrics of every stage """
+def annotateShard(task):
+    shardfile, outfile, options = task
+    stages = pipeline.default_stages(format=options['format'], index=options['index'], sweep=options['sweep'], gene_model=options['gene_model'])
+    stageMetrics = [metrics.StageMetrics(stage.name()) for stage in stages]
+    tables = sources.openSource(options['source'], sqlite_database=options['sqlite_database'], dbsnp_store=options['dbsnp_store'])
+    fh = fh_out = None
+    try:
+        pipeline.open_stages(stages, tables, stageMetrics)
+
+        fh = open(shardfile)
+        fh_out = open(outfile, 'w')
+        pipeline.annotate_lines(stages, fh, fh_out, block_size=options['block_size'], sep=options['sep'], stageMetrics=stageMetrics)
+    finally:
+        if fh is not None:
+            fh.close()
+        if fh_out is not None:
+            fh_out.close()
+        tables.close()
+    return [(stage.counts(), stageMetric.asDict()) for stage, stageMetric in zip(stages, stageMetrics)]
+
+
+""" Writes the annotated shards back in the order of the input """
+def merge(outfile, shardOutfiles, headers, layout):
+    handles = [open(name) for name in shardOutfiles]
+    fh_out = open(outfile, 'w')
+    h = 0
+    for index in layout:
+        if index < 0:
+            fh_out.write(headers[h]+'\n')
+            h = h+1
+        else:
+            fh_out.write(handles[index].readline())
+    fh_out.close()
+    for handle in handles:
+        handle.close()
+
+
+""" Same as pipeline.run, with the records annotated by a pool of worker processes (workers=0 starts one per core)
+    progress, a progress.Progress, is told about every annotated shard
+"""
+def run(infile, format='vcf', workers=0, shard='chrom', block_size=pipeline.BLOCK_SIZE, sep='\t', index=False, sweep=False, gene_model=False,
+        source='mysql', sqlite_database=None, dbsnp_store=None, progress=None):
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    outfile, logcountfile = pipeline.outputNames(infile)
+    options = {'format': format, 'index': index, 'sweep': sweep, 'gene_model': gene_model, 'block_size': block_size, 'sep': sep,
+               'source': source, 'sqlite_database': sqlite_database, 'dbsnp_store': dbsnp_store}
+
+    runMetrics = metrics.RunMetrics(infile, 'stream', dict([(name, options[name]) for name in ('index', 'sweep', 'gene_model', 'source', 'block_size')] +
+                                                          [('dbsnp_store', bool(dbsnp_store)), ('workers', workers), ('shard', shard)]))
+
+    # the stages of the parent load the shared tables and collect the counts of the workers
+    stages = pipeline.default_stages(format=format, index=index, sweep=sweep, gene_model=gene_model)
+    stageMetrics = [runMetrics.stage(stage.name()) for stage in stages]
+    tables = sources.openSource(source, sqlite_database=sqlite_database, dbsnp_store=dbsnp_store)
+    pipeline.open_stages(stages, tables, stageMetrics)
+    tables.close()
+
+    directory = tempfile.mkdtemp(prefix='.shards', dir=os.path.dirname(os.path.abspath(infile)))
+    try:
+        if progress is not None:
+            progress.setStage('splitting', 1, 3)
+        shards, headers, layout = split(infile, directory, workers, shard=shard, sep=sep)
+        shardOutfiles = [shardfile + '.annot' for shardfile, size in shards]
+
+        # biggest shards first so that no worker is left with a big one at the end
+        order = sorted(range(len(shards)), key=lambda i: -shards[i][1])
+        tasks = [(shards[i][0], shardOutfiles[i], options) for i in order]
+        print("Annotating " + str(len(layout) - len(headers)) + " records in " + str(len(shards)) + " shards with " + str(workers) + " workers")
+
+        if progress is not None:
+            progress.recordsTotal = len(layout) - len(headers)
+            progress.setStage('annotating', 2, 3, fraction=0.0)
+        if len(tasks) > 0:
+            pool = multiprocessing.get_context('fork').Pool(processes=min(workers, len(tasks)))
+            try:
+                # shards as they are done; the counts and metrics add up in any order
+                results = []
+                for result in pool.imap_unordered(annotateShard, tasks, chunksize=1):
+                    results.append(result)
+                    if progress is not None:
+                        # the first stage saw every record of the shard
+                        records = result[0][1]['records'] if len(result) > 0 else 0
+                        progress.advance(records=records, fraction=progress.records/float(max(progress.recordsTotal, 1)))
+            finally:
+                pool.close()
+                pool.join()
+            for result in results:
+                for stage, stageMetric, (counts, values) in zip(stages, stageMetrics, result):
+                    stage.merge(counts)
+                    stageMetric.merge(values)
+
+        if progress is not None:
+            progress.setStage('merging', 3, 3)
+        merge(outfile, shardOutfiles, headers, layout)
+    finally:
+        shutil.rmtree(directory)
+
+    fh_log = open(logcountfile, 'w')
+    for stage in stages:
+        stage.write_log(fh_log)
+    fh_log.close()
+    runMetrics.write(outfile)
+    return outfile
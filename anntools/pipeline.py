@@ -0,0 +1,774 @@
+#!/usr/bin/env python
+
+""" Single pass annotation engine
+
+    driver.run used to call every annotate.* function in turn, and each of them
+    re-read the whole VCF written by the previous one, re-split every line and
+    wrote yet another temporary file. The engine below parses every record once,
+    hands it through a chain of in-memory stages and writes the .annot.vcf and
+    .count.log a single time. Every stage reproduces the record formatting and
+    the log counts of the annotate.* function it replaces, so the output is the
+    same as the file to file pipeline.
+
+    Stages read the annotation tables through a sources.Source, so the same
+    chain runs against MySQL, a local SQLite copy, in-memory tables or the
+    dbSNP store.
+"""
+
+import os
+
+import annotate as ann
+import genes
+import intervals
+import metrics
+import sources
+import utils as u
+
+# number of records handed through the chain of stages at a time
+BLOCK_SIZE = 5000
+
+
+""" Reproduces the strip() every file based stage applied when it re-read the output of the previous stage """
+def restrip(fields, sep='\t'):
+    first = fields[0]
+    last = fields[-1]
+    if first and last and not first[0].isspace() and not last[-1].isspace():
+        return fields
+    return sep.join(fields).strip().split(sep)
+
+
+""" Appends to the INFO field the way the overlap functions in annotate.py do """
+def appendInfo(fields, text):
+    if str(fields[7]).endswith(';'):
+        fields[7] = fields[7] + text
+    else:
+        fields[7] = fields[7] + ';' + text
+
+
+################################################################################
+###                              STAGES                                      ###
+################################################################################
+
+class Stage(object):
+    """ One annotation stage; annotate() updates the fields of a single record in place
+
+        counters names the attributes write_log reports, so the counts of stages
+        that ran on different parts of a file can be added up (see parallel.py).
+    """
+
+    counters = ()
+
+    def __init__(self, format='vcf'):
+        self.inds = ann.getFormatSpecificIndices(format=format)
+        self.source = None
+
+    def open(self, source):
+        """ Called once before the first record with the sources.Source shared by all stages """
+        self.source = source
+
+    def annotate(self, fields):
+        raise NotImplementedError
+
+    def annotate_block(self, block):
+        """ Annotates a list of records; stages able to batch their lookups override this """
+        for fields in block:
+            self.annotate(fields)
+
+    def name(self):
+        """ Name of the stage in the metrics file """
+        if getattr(self, 'table', None):
+            return self.__class__.__name__ + '(' + str(self.table) + ')'
+        return self.__class__.__name__
+
+    def counts(self):
+        return dict([(name, getattr(self, name)) for name in self.counters])
+
+    def merge(self, counts):
+        """ Adds the counts() of the same stage run on another part of the file """
+        for name in self.counters:
+            setattr(self, name, getattr(self, name) + counts[name])
+
+    def write_log(self, fh_log):
+        """ Writes the lines the replaced annotate.* function adds to .count.log """
+        pass
+
+
+class DbSnpStage(Stage):
+    """ Same as annotate.getSnpsFromDbSnp
+
+        annotate_block resolves a whole block of records with one lookup per
+        chromosome for all of its positions and matches INFO and REF in process,
+        instead of sending one query per record.
+    """
+
+    counters = ('var_count', 'linenum')
+
+    def __init__(self, format='vcf', varclass='SNV'):
+        Stage.__init__(self, format=format)
+        self.varclass = varclass
+        self.var_count = 0
+        self.linenum = 1
+
+    def open(self, source):
+        Stage.open(self, source)
+        self.refIndex = source.columnIndex('dbSNP', 'REF')
+        self.infoIndex = source.columnIndex('dbSNP', 'INFO')
+
+    def chrom(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith('chr'):
+            chr = chr.replace('chr', '')
+        return chr
+
+    def infoMatches(self, info):
+        """ The INFO condition of the replaced query """
+        return info is not None and sources.sqlEqual(info, self.varclass)
+
+    def annotate(self, fields):
+        self.annotate_block([fields])
+
+    def annotate_block(self, block):
+        positions = {}
+        for fields in block:
+            positions.setdefault(self.chrom(fields), set()).add(int(fields[self.inds[1]].strip()))
+
+        found = {}
+        posIndex = self.source.columnIndex('dbSNP', 'POS')
+        for chr, chrPositions in positions.items():
+            for row in self.source.lookup_exact('dbSNP', {'CHR': chr, 'POS': sorted(chrPositions)}):
+                if self.infoMatches(row[self.infoIndex]):
+                    found.setdefault((chr, int(row[posIndex])), []).append(row)
+
+        for fields in block:
+            rows = found.get((self.chrom(fields), int(fields[self.inds[1]].strip())), [])
+            self.apply(fields, self.matching(fields, rows))
+
+    def matching(self, fields, rows):
+        """ The rows the per-record query would have returned """
+        if len(rows) == 0:
+            return rows
+        ref = ann.clean_shit(fields[self.inds[2]]).strip()
+        compRef = ann.getComplementary(ref)
+        return [row for row in rows if sources.sqlEqual(row[self.refIndex], ref) or sources.sqlEqual(row[self.refIndex], compRef)]
+
+    def apply(self, fields, rows):
+        fields[2] = '.'
+        if len(rows) > 0:
+            rsids = []
+            mafs = []
+            for row in rows:
+                rsids.append(str(row[3]))
+                if str(row[7]) != '.':
+                    mafs.append('GMAF='+str(row[7]))
+
+            maf_str = ''
+            if len(mafs) > 0:
+                maf_str = ';'+';'.join(mafs)
+
+            self.var_count = self.var_count+1
+            if str(fields[7]) == '.':
+                fields[7] = 'DB'+maf_str
+            else:
+                fields[7] = fields[7]+';DB;VC='+self.varclass + maf_str
+            fields[2] = ';'.join(rsids)
+        self.linenum = self.linenum+1
+
+    def merge(self, counts):
+        # linenum starts at 1 in every part
+        Stage.merge(self, counts)
+        self.linenum = self.linenum-1
+
+    def write_log(self, fh_log):
+        ratioInDbSnp = (self.var_count/float(self.linenum))*100
+        fh_log.write("## Please notice that all Isoforms were counted "+'\n')
+        fh_log.write("## Numbers may exceed number of variants in the annotated file"+'\n')
+        fh_log.write("Total: " +str(self.linenum) +'\n')
+        fh_log.write("In dbSNP: " +str(self.var_count) + " (" + str(ratioInDbSnp) + "%)" +'\n')
+
+
+class DbSnpIndelStage(DbSnpStage):
+    """ Same as annotate.getIndelsFromDbSnp """
+
+    def infoMatches(self, info):
+        return info is not None and not sources.sqlEqual(info, self.varclass)
+
+    def matching(self, fields, rows):
+        return rows
+
+    def apply(self, fields, rows):
+        fields[2] = '.'
+        if len(rows) > 0:
+            rsids = []
+            vcs = []
+            for row in rows:
+                rsids.append(str(row[3]))
+                vcs.append(str(row[6]))
+
+            self.var_count = self.var_count+1
+            if str(fields[7]) == '.':
+                fields[7] = 'DB;VC='+';'.join(u.dedup(vcs))
+            else:
+                fields[7] = fields[7]+';DB;VC='+';'.join(u.dedup(vcs))
+            fields[2] = ';'.join(rsids)
+        self.linenum = self.linenum+1
+
+
+class BigRefGeneStage(Stage):
+    """ Same as annotate.getBigRefGene """
+
+    def annotate(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith('chr'):
+            chr = chr.replace('chr', '')
+        pos = fields[self.inds[1]].strip()
+        ref = ann.clean_shit(fields[self.inds[2]]).strip()
+        alt = ann.clean_shit(fields[self.inds[3]]).strip()
+        compRef = ann.getComplementary(ref)
+        compAlt = ann.getComplementary(alt)
+
+        rows = self.source.lookup_exact('chrom_pos_equal_base', {'CHR': chr, 'start': int(pos)})
+        rows = [row for row in rows if self.haplotypeMatches(row, ref, alt) or self.haplotypeMatches(row, compRef, compAlt)]
+        if len(rows) == 0:
+            rows = self.source.lookup_exact('chrom_pos_equal_nobase', {'CHR': chr, 'start': int(pos)})
+        if len(rows) == 0:
+            rows = self.source.lookup_point('chrom_pos_unequal', chr, int(pos), chromName='CHR', startName='start', endName='end')
+        if len(rows) > 0:
+            self.apply(fields, rows)
+
+    def haplotypeMatches(self, row, ref, alt):
+        refIndex = self.source.columnIndex('chrom_pos_equal_base', 'haplotypeReference')
+        altIndex = self.source.columnIndex('chrom_pos_equal_base', 'haplotypeAlternate')
+        return row[refIndex] is not None and row[altIndex] is not None and \
+               sources.sqlEqual(row[refIndex], ref) and sources.sqlEqual(row[altIndex], alt)
+
+    def apply(self, fields, rows):
+        m = set([])
+        for row in rows:
+            m.add(ann.collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+        fields[7] = fields[7]+';'+';'.join(m)
+        if str(fields[7]).startswith('.;'):
+            fields[7] = str(fields[7]).replace('.;', '', 1)
+
+
+class GeneStage(Stage):
+    """ Same as annotate.getGenes
+
+        With model=True (and NumPy installed) refGene is preloaded into a
+        genes.GeneModel and annotate_block classifies all the (variant, transcript)
+        pairs of a block with vectorized array operations.
+    """
+
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count', 'intronic_count',
+                'non_coding_intronic_count', 'exonic_count', 'non_coding_exonic_count', 'promoter_count')
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500, model=False):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.use_model = model
+        self.model = None
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+    def open(self, source):
+        Stage.open(self, source)
+        if self.use_model and genes.np is not None:
+            self.model = genes.getModel(source, self.table)
+
+    def chrom(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith('chr'):
+            chr = 'chr' + chr
+        return chr
+
+    def annotate(self, fields):
+        chr = self.chrom(fields)
+        pos = int(fields[self.inds[1]].strip())
+
+        # txStart - promoter_offset <= pos <= txEnd + promoter_offset
+        rows = self.source.lookup_range(self.table, chr, pos - int(self.promoter_offset), pos + int(self.promoter_offset), startName='txStart', endName='txEnd')
+        self.apply(fields, chr, pos, rows)
+
+    def annotate_block(self, block):
+        if self.model is None:
+            Stage.annotate_block(self, block)
+            return
+
+        offset = int(self.promoter_offset)
+        records = []
+        positions = []
+        transcripts = []
+        for fields in block:
+            chr = self.chrom(fields)
+            pos = int(fields[self.inds[1]].strip())
+            found = self.model.transcripts(chr, pos - offset, pos + offset)
+            records.append((fields, chr, pos, found))
+            positions.extend([pos]*len(found))
+            transcripts.extend(found)
+
+        if len(transcripts) > 0:
+            nonCoding, inCds, inPromoter, inExon, exnum = self.model.classify(positions, transcripts, offset)
+        k = 0
+        for fields, chr, pos, found in records:
+            regions = []
+            for t in found:
+                if self.model.regular[t]:
+                    regions.append(self.classified(chr, pos, int(self.model.exonCount[t]), nonCoding[k], inCds[k], inPromoter[k], inExon[k], int(exnum[k])))
+                else:
+                    regions.append(self.region(chr, pos, self.model.rows[t]))
+                k = k+1
+            self.apply(fields, chr, pos, [self.model.rows[t] for t in found], regions)
+
+    def classified(self, chr, pos, exonCount, nonCoding, inCds, inPromoter, inExon, exnum):
+        """ Same as region(), from the results of GeneModel.classify """
+        exons = []
+        if inExon:
+            exons.append('ex'+str(exnum) +'/'+str(exonCount))
+        if nonCoding:
+            return ';'.join(['non_coding_exon=' + e for e in exons])
+        if inCds:
+            self.exonic_count = self.exonic_count+len(exons)
+            return ';'.join(['exon=' + e for e in exons])
+        if inPromoter:
+            return self.promoter(chr, pos)
+        return ''
+
+    def apply(self, fields, chr, pos, rows, regions=None):
+        if len(rows) == 0:
+            fields[7] = fields[7]+';positionType=interGenic'
+            self.interGenic_count = self.interGenic_count+1
+            return
+
+        info_field = ann.clean_shit(fields[7]).strip()
+        positionType = str(u.parse_field(info_field, 'positionType', ';', '='))
+        info = []
+        for i, row in enumerate(rows):
+            self.countPositionType(positionType)
+            if regions is None:
+                region = self.region(chr, pos, row)
+            else:
+                region = regions[i]
+            if region != '':
+                info.append(ann.collapseGeneNames(row=row, indices=ann.indicesKnownGenes, region=region, cnt=0))
+        fields[7] = fields[7]+';'+';'.join(info)
+
+    def countPositionType(self, positionType):
+        if positionType == 'intron':
+            self.intronic_count = self.intronic_count+1
+        elif positionType == 'non_coding_intron':
+            self.non_coding_intronic_count = self.non_coding_intronic_count+1
+        elif positionType == 'CDS':
+            self.cds_count = self.cds_count+1
+        elif positionType == 'non_coding_exon':
+            self.non_coding_exonic_count = self.non_coding_exonic_count+1
+        elif positionType == 'utr5':
+            self.utr5_count = self.utr5_count+1
+        elif positionType == 'utr3':
+            self.utr3_count = self.utr3_count+1
+
+    def region(self, chr, pos, row):
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        exonCount = int(row[8])
+        exonsSt = str(row[9].decode('utf-8')).split(',')
+        exonsEn = str(row[10].decode('utf-8')).split(',')
+        strand = str(row[3])
+
+        if cdsStart == cdsEnd:
+            exons = self.exons(pos, exonCount, exonsSt, exonsEn, strand, 'non_coding_exon=')
+            return ';'.join(exons)
+
+        if u.isBetween(pos, cdsStart, cdsEnd):
+            exons = self.exons(pos, exonCount, exonsSt, exonsEn, strand, 'exon=')
+            self.exonic_count = self.exonic_count+len(exons)
+            return ';'.join(exons)
+
+        if (u.isBetween(pos, txtStart - int(self.promoter_offset), txtStart) and strand == '+') or \
+           (u.isBetween(pos, txtEnd, txtEnd + int(self.promoter_offset)) and strand == '-'):
+            return self.promoter(chr, pos)
+
+        return ''
+
+    def exons(self, pos, exonCount, exonsSt, exonsEn, strand, label):
+        exons = []
+        for e in range(0, exonCount):
+            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                exnum = e+1
+                if strand == '-':
+                    exnum = exonCount - e
+                exons.append(label + 'ex'+str(exnum) +'/'+str(exonCount))
+        return exons
+
+    def promoter(self, chr, pos):
+        rows = self.source.lookup_point('cpgIslandExt', chr, pos, columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+        if len(rows) == 0:
+            return ''
+        row = rows[0]
+        self.promoter_count = self.promoter_count+1
+        return 'putativePromoterRegion='+ ''.join(str(row[3]).split())
+
+    def write_log(self, fh_log):
+        counts = [("Variants located: ", ''),
+                  ("In interGenic ", self.interGenic_count),
+                  ("In CDS ", self.cds_count),
+                  ("In \'3 UTR ", self.utr3_count),
+                  ("In \'5 UTR ", self.utr5_count),
+                  ("In Intronic ", self.intronic_count),
+                  ("In Non_coding_intronic ", self.non_coding_intronic_count),
+                  ("In Exonic ", self.exonic_count),
+                  ("In Non_coding_exonic ", self.non_coding_exonic_count),
+                  ("In Putative Promoter Region ", self.promoter_count)]
+        for label, count in counts:
+            print(label + str(count))
+            fh_log.write(label + str(count) +'\n')
+
+
+class OverlapStage(Stage):
+    """ Base class for the addOverlapWith* functions: one region table, one line in .count.log
+
+        With index=True the table is loaded once into an intervals.IntervalIndex
+        instead of being queried for every variant; sweep=True additionally walks
+        coordinate sorted input against the index in one pass (intervals.Sweep).
+    """
+
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+    counters = ('var_count', 'line_count')
+
+    def __init__(self, format='vcf', table=None, index=False, sweep=False):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.use_index = index or sweep
+        self.sweep = sweep
+        self.index = None
+        self.var_count = 0
+        self.line_count = 0
+
+    def open(self, source):
+        Stage.open(self, source)
+        if self.use_index:
+            self.index = intervals.getIndex(source, self.table, chromName=self.chromName, startName=self.startName, endName=self.endName)
+            if self.sweep:
+                self.index = intervals.Sweep(self.index)
+
+    def chrom(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith('chr'):
+            chr = 'chr' + chr
+        return chr
+
+    def lookup(self, chr, pos):
+        """ Rows of the region table overlapping the position """
+        if self.index is not None:
+            return self.index.overlapping(chr, int(pos))
+        return self.query(chr, pos)
+
+    def query(self, chr, pos):
+        return self.source.lookup_point(self.table, chr, int(pos), chromName=self.chromName, startName=self.startName, endName=self.endName)
+
+    def annotate(self, fields):
+        pos = fields[self.inds[1]].strip()
+        self.apply(fields, self.lookup(self.chrom(fields), pos))
+
+    def apply(self, fields, rows):
+        raise NotImplementedError
+
+    def write_log(self, fh_log):
+        fh_log.write("In "+ str(self.table) + ": " +str(self.var_count) +' in ' + str(self.line_count) + ' variants\n')
+
+
+class CytobandStage(OverlapStage):
+    """ Same as annotate.addOverlapWithCytoband """
+
+    def __init__(self, format='vcf', table='cytoBand', index=False, sweep=False):
+        OverlapStage.__init__(self, format=format, table=table, index=index, sweep=sweep)
+        self.colindex = 3 if table == 'cytoBand' else 12
+        self.startName = 'chromStart' if table == 'cytoBand' else 'txStart'
+        self.endName = 'chromEnd' if table == 'cytoBand' else 'txEnd'
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count+1
+            self.var_count = self.var_count+len(rows)
+            overlapsWith = u.dedup([str(row[self.colindex]) for row in rows])
+            appendInfo(fields, str(self.table)+'='+';'.join(overlapsWith))
+
+
+class GadAllStage(OverlapStage):
+    """ Same as annotate.addOverlapWithGadAll """
+
+    chromName = 'chromosome'
+
+    def __init__(self, format='vcf', table='gadAll', index=False, sweep=False):
+        OverlapStage.__init__(self, format=format, table=table, index=index, sweep=sweep)
+
+    def chrom(self, fields):
+        # gadAll has no "chr" preceeding the chromosome number
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith('chr'):
+            chr = str(chr).replace('chr', '')
+        return chr
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count+1
+            self.var_count = self.var_count+len(rows)
+            records = [str(self.table)+'='+name for name in u.dedup([str(row[3]) for row in rows])]
+            appendInfo(fields, ';'.join(records))
+
+
+class GwasCatalogStage(OverlapStage):
+    """ Same as annotate.addOverlapWithGwasCatalog """
+
+    def __init__(self, format='vcf', table='gwasCatalog'):
+        OverlapStage.__init__(self, format=format, table=table)
+
+    def query(self, chr, pos):
+        return self.source.lookup_exact(self.table, {'chrom': chr, 'chromEnd': int(pos)})
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count+1
+            self.var_count = self.var_count+len(rows)
+            records = [str(self.table)+'='+str('pubMedID')+'='+str(row[5]) + ',trait='+str(row[10]) for row in rows]
+            appendInfo(fields, ';'.join(records))
+
+
+class HugoStage(OverlapStage):
+    """ Same as annotate.addOverlapWitHUGOGeneNomenclature """
+
+    def __init__(self, format='vcf', table='hugo', index=False, sweep=False):
+        OverlapStage.__init__(self, format=format, table=table, index=index, sweep=sweep)
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count+1
+            self.var_count = self.var_count+len(rows)
+            t = u.dedup([str(str(row[5]) +','+ str(row[6])).strip() for row in rows])
+            records = ['HGNC_GeneAnnotation'+'='+x for x in t]
+            appendInfo(fields, ','.join(records).replace(';', ','))
+
+
+class FirstOverlapStage(OverlapStage):
+    """ Base class for the overlap functions that only look at the first overlapping row """
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count+1
+            self.var_count = self.var_count+1
+            self.annotateWith(fields, rows[0])
+
+    def annotateWith(self, fields, row):
+        raise NotImplementedError
+
+
+class MiRNAStage(FirstOverlapStage):
+    """ Same as annotate.addOverlapWithMiRNA """
+
+    def __init__(self, format='vcf', table='targetScanS', index=False, sweep=False):
+        FirstOverlapStage.__init__(self, format=format, table=table, index=index, sweep=sweep)
+
+    def annotateWith(self, fields, row):
+        t = str(row[4])+','+ str(row[1]) + '_'+ str(row[2])+ '_'+ str(row[3])
+        appendInfo(fields, 'miRNAsites='+t.strip())
+
+    def write_log(self, fh_log):
+        fh_log.write("In miRNAsites: " +str(self.var_count) +' in ' + str(self.line_count) + ' variants\n')
+
+
+class CnvStage(FirstOverlapStage):
+    """ Same as annotate.addOverlapWithCnvDatabase """
+
+    def __init__(self, format='vcf', table='dgv_Cnv', index=False, sweep=False):
+        FirstOverlapStage.__init__(self, format=format, table=table, index=index, sweep=sweep)
+
+    def annotateWith(self, fields, row):
+        appendInfo(fields, str(self.table)+'='+str(True))
+
+
+class GenomicSuperDupsStage(FirstOverlapStage):
+    """ Same as annotate.addOverlapWithGenomicSuperDups """
+
+    def __init__(self, format='vcf', table='genomicSuperDups', index=False, sweep=False):
+        FirstOverlapStage.__init__(self, format=format, table=table, index=index, sweep=sweep)
+
+    def annotateWith(self, fields, row):
+        fields[7] = fields[7]+';'+str(self.table)+'='+str(True)+';'+'otherChrom='+str(row[7])+';otherStart='+str(row[8])+';otherEnd='+str(row[9])
+
+
+class PutativePromoterStage(FirstOverlapStage):
+    """ Same as annotate.addOverlapWithPutativePromoter """
+
+    def __init__(self, format='vcf', table='putativePromoter', index=False, sweep=False):
+        FirstOverlapStage.__init__(self, format=format, table=table, index=index, sweep=sweep)
+
+    def annotateWith(self, fields, row):
+        t = str(row[2]) +','+ str(row[1])+','+ str(row[4]) + ','+ str(row[7])
+        appendInfo(fields, 'putativePromoterRegion='+t.strip())
+
+
+class TfbsConsSitesStage(OverlapStage):
+    """ Same as annotate.addOverlapWithTfbsConsSites; one table per chromosome """
+
+    allowed_chrom = ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','17','18','19','20','21','22','X','Y']
+
+    def __init__(self, format='vcf', table='tfbsConsSites'):
+        OverlapStage.__init__(self, format=format, table=table)
+
+    def query(self, chr, pos):
+        chrIndex = chr.replace('chr', '')
+        if chrIndex not in self.allowed_chrom:
+            return []
+        return self.source.lookup_point('tfbsConsSites' + chrIndex, None, int(pos), chromName=None, columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count+1
+            self.var_count = self.var_count+len(rows)
+            records = ['tfbsRegion'+'='+(str(row[3])+'.'+str(row[0])+'.'+str(row[1])+'.'+str(row[2])).strip() for row in rows]
+            appendInfo(fields, ';'.join(records))
+
+
+""" The stages of driver.run, in the same order
+    index=True answers the region tables from in-memory interval indexes, sweep=True merge-joins sorted input against them
+    gene_model=True classifies refGene transcripts from a preloaded genes.GeneModel
+"""
+def default_stages(format='vcf', index=False, sweep=False, gene_model=False):
+    return [DbSnpStage(format=format),
+            BigRefGeneStage(format=format),
+            GeneStage(format=format, table='refGene', promoter_offset=500, model=gene_model),
+            CytobandStage(format=format, table='cytoBand', index=index, sweep=sweep),
+            GadAllStage(format=format, table='gadAll', index=index, sweep=sweep),
+            GwasCatalogStage(format=format, table='gwasCatalog'),
+            MiRNAStage(format=format, table='targetScanS', index=index, sweep=sweep),
+            HugoStage(format=format, table='hugo', index=index, sweep=sweep),
+            CnvStage(format=format, table='dgv_Cnv', index=index, sweep=sweep),
+            CnvStage(format=format, table='abParts_IG_T_CelReceptors', index=index, sweep=sweep),
+            CnvStage(format=format, table='mcCarroll_Cnv', index=index, sweep=sweep),
+            CnvStage(format=format, table='conrad_Cnv', index=index, sweep=sweep),
+            GenomicSuperDupsStage(format=format, table='genomicSuperDups', index=index, sweep=sweep),
+            TfbsConsSitesStage(format=format, table='tfbsConsSites')]
+
+
+################################################################################
+###                              ENGINE                                      ###
+################################################################################
+
+""" Hands a block of records through every stage, adding to the metrics.StageMetrics of each and to the progress.Progress if given """
+def annotate_block(stages, block, sep='\t', stageMetrics=None, progress=None):
+    if stageMetrics is not None:
+        size = metrics.blockSize(block, sep=sep)
+    for s, stage in enumerate(stages):
+        if stageMetrics is not None:
+            stageMetrics[s].start()
+        stage.annotate_block(block)
+        for i in range(len(block)):
+            block[i] = restrip(block[i], sep=sep)
+        if stageMetrics is not None:
+            stageMetrics[s].stop(records=len(block))
+            # measured outside the timed part
+            before = size
+            size = metrics.blockSize(block, sep=sep)
+            stageMetrics[s].bytes_written = stageMetrics[s].bytes_written + size-before
+    if progress is not None:
+        progress.advance(records=len(block))
+
+
+""" Annotates the lines of a VCF and writes them to fh_out, block_size records at a time """
+def annotate_lines(stages, lines, fh_out, block_size=BLOCK_SIZE, sep='\t', stageMetrics=None, progress=None):
+    block = []
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line.startswith('#'):
+            # keep headers in place relative to the records around them
+            if len(block) > 0:
+                annotate_block(stages, block, sep=sep, stageMetrics=stageMetrics, progress=progress)
+                fh_out.write(''.join([sep.join(fields)+'\n' for fields in block]))
+                block = []
+            fh_out.write(line+'\n')
+            continue
+
+        block.append(line.split(sep))
+        if len(block) >= block_size:
+            annotate_block(stages, block, sep=sep, stageMetrics=stageMetrics, progress=progress)
+            fh_out.write(''.join([sep.join(fields)+'\n' for fields in block]))
+            block = []
+
+    if len(block) > 0:
+        annotate_block(stages, block, sep=sep, stageMetrics=stageMetrics, progress=progress)
+        fh_out.write(''.join([sep.join(fields)+'\n' for fields in block]))
+
+
+""" Opens every stage on the source, timing it (loading indexes and models can dominate short jobs) """
+def open_stages(stages, source, stageMetrics):
+    for stage, stageMetric in zip(stages, stageMetrics):
+        stageMetric.start()
+        stage.open(source)
+        stageMetric.stop(opening=True)
+
+
+""" Names of the .annot.vcf and .count.log written for infile """
+def outputNames(infile):
+    return (infile+'.annot').replace('.vcf.annot', '.annot.vcf'), infile+'.count.log'
+
+
+""" Annotates infile in a single pass; writes <name>.annot.vcf and <infile>.count.log
+    source, sqlite_database and dbsnp_store select where the tables are read from (see sources.openSource)
+    lines, if given, are the lines of the input (e.g. streamed from S3), read instead of infile
+    progress, a progress.Progress, is told about every annotated block
+"""
+def run(infile, format='vcf', stages=None, block_size=BLOCK_SIZE, sep='\t', index=False, sweep=False, gene_model=False,
+        source='mysql', sqlite_database=None, dbsnp_store=None, lines=None, progress=None):
+    if stages is None:
+        stages = default_stages(format=format, index=index, sweep=sweep, gene_model=gene_model)
+
+    outfile, logcountfile = outputNames(infile)
+
+    runMetrics = metrics.RunMetrics(infile, 'stream', {'index': index, 'sweep': sweep, 'gene_model': gene_model, 'source': source,
+                                                       'dbsnp_store': bool(dbsnp_store), 'block_size': block_size})
+    stageMetrics = [runMetrics.stage(stage.name()) for stage in stages]
+
+    # the source (a pooled connection in persistent workers) and every file are
+    # closed even when the run fails, e.g. on an error reading a streamed input
+    tables = sources.openSource(source, sqlite_database=sqlite_database, dbsnp_store=dbsnp_store)
+    fh = fh_out = None
+    try:
+        open_stages(stages, tables, stageMetrics)
+
+        fh = open(infile) if lines is None else None
+        fh_out = open(outfile, 'w')
+        records = fh if lines is None else lines
+        if progress is not None:
+            progress.setStage('annotating', 1, 1)
+            if lines is None:
+                records = progress.reading(fh, os.path.getsize(infile))
+        annotate_lines(stages, records, fh_out, block_size=block_size, sep=sep, stageMetrics=stageMetrics, progress=progress)
+
+        fh_log = open(logcountfile, 'w')
+        try:
+            for stage in stages:
+                stage.write_log(fh_log)
+        finally:
+            fh_log.close()
+    finally:
+        tables.close()
+        if fh is not None:
+            fh.close()
+        if fh_out is not None:
+            fh_out.close()
+        if lines is not None and hasattr(lines, 'close'):
+            lines.close()
+    runMetrics.write(outfile)
+    return outfile
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+""" Progress of an annotation run
+
+    driver.run reports the stage it is in, the records annotated so far and,
+    once it can tell how much of the input it has been through, the share done
+    and an estimate of the seconds left. Reports go to a callback (run.py writes
+    them to the job's item in the annotations table), at most one every
+    `interval` seconds, so a run costs a handful of writes however many blocks
+    it annotates.
+
+    How much of the input was read is known from the bytes handed out by
+    reading() (the input file, or the S3 chunks of a streamed input) or from an
+    explicit fraction (the file to file engine counts finished stages, parallel
+    runs count annotated shards).
+"""
+
+import time
+import traceback
+
+
+class Progress(object):
+    """ Progress of one run; report(state) is called with the dict of state() """
+
+    def __init__(self, report=None, interval=5.0):
+        self.report = report
+        self.interval = interval
+        self.started = time.time()
+        self.reported = None
+        self.stage = None
+        self.stageNumber = 0
+        self.stages = 0
+        self.records = 0
+        self.recordsTotal = None
+        self.fraction = None
+        self.bytesRead = 0
+        self.bytesTotal = None
+
+    def setStage(self, name, number=0, stages=0, fraction=None):
+        """ Starts a stage (number of stages, when the run has a fixed series of them) """
+        self.stage = name
+        self.stageNumber = number
+        self.stages = stages
+        if fraction is not None:
+            self.fraction = fraction
+        self.update()
+
+    def advance(self, records=0, fraction=None):
+        """ Adds annotated records and, if given, sets the share of the run done """
+        self.records = self.records+records
+        if fraction is not None:
+            self.fraction = fraction
+        self.update()
+
+    def reading(self, items, size):
+        """ Hands out items (lines or chunks) of an input of size bytes, counting the bytes read
+            (text lines are counted by their utf-8 length, so non-ASCII input does not skew the share done) """
+        self.bytesTotal = size
+        for item in items:
+            if isinstance(item, str):
+                self.bytesRead = self.bytesRead+len(item.encode('utf-8'))
+            else:
+                self.bytesRead = self.bytesRead+len(item)
+            yield item
+
+    def done(self):
+        """ Share of the run done (0 to 1), or None if it cannot be told """
+        if self.fraction is not None:
+            return self.fraction
+        if self.bytesTotal:
+            return min(self.bytesRead/float(self.bytesTotal), 1.0)
+        if self.recordsTotal:
+            return min(self.records/float(self.recordsTotal), 1.0)
+        return None
+
+    def state(self):
+        elapsed = time.time() - self.started
+        done = self.done()
+        eta = None
+        if done is not None and done > 0:
+            eta = int(elapsed*(1-done)/done)
+        return {'stage': self.stage,
+                'stage_number': self.stageNumber,
+                'stages': self.stages,
+                'records': self.records,
+                'records_total': self.recordsTotal,
+                'percent': int(done*100) if done is not None else None,
+                'elapsed_seconds': int(elapsed),
+                'eta_seconds': eta,
+                'updated': int(time.time())}
+
+    def update(self, force=False):
+        """ Reports the state if the last report is older than interval (or if forced) """
+        if self.report is None:
+            return
+        now = time.time()
+        if not force and self.reported is not None and now - self.reported < self.interval:
+            return
+        self.reported = now
+        try:
+            self.report(self.state())
+        except Exception:
+            # progress is informative only, never a reason to fail the run
+            traceback.print_exc()
+
+    def finish(self):
+        """ Reports the end of the run, whenever the last report was """
+        self.stage = 'done'
+        self.fraction = 1.0
+        self.update(force=True)
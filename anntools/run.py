@@ -8,6 +8,8 @@ import sys
 import time
 import driver
 import json
+import progress
+import s3stream
 
 ###############################
 ###      AWS FUNCTIONS     ###
@@ -34,11 +36,18 @@ def get_key_log_file(prefix, files):
     if key.endswith('.count.log'):
       return key
 
-# get result file
+# get result file (plain or bgzip compressed)
 def get_key_result_file(prefix, files):
   for file in files:
     key = prefix + file
-    if key.endswith('.annot.vcf'):
+    if key.endswith('.annot.vcf') or key.endswith('.annot.vcf.gz'):
+      return key
+
+# get tabix index of a compressed result file (None when none was written)
+def get_key_index_file(prefix, files):
+  for file in files:
+    key = prefix + file
+    if key.endswith('.annot.vcf.gz.tbi'):
       return key
 
 # check user role associated with this annotation request
@@ -76,69 +85,119 @@ class Timer(object):
 ###        ANNOTATOR        ###
 ###############################
 
+# exit code of __main__ when the job could not be claimed, so that the caller
+# can tell it apart from a job that was annotated (0) or failed (1)
+NOT_CLAIMED_EXIT_CODE = 2
+
+# annotate one job and publish the results; called by __main__ below or, in
+# persistent worker mode, from a worker of annotator.py (workers.py)
+# with input_bucket and input_key the input is streamed from S3 as it is annotated
+# instead of being read from file_path (which still names the results)
+# returns True once the job is annotated and False if it could not be claimed
+# (it is not PENDING); on_claim, if given, is called as soon as the job is claimed
+def run_annotation(file_path, job_id, folder, prefix, bucket, input_bucket=None, input_key=None, on_claim=None):
+  # connect to the database
+  table_name = aws.DYNAMODB_ANNOTATIONS_TABLE
+  table = aws.get_table(table_name)
+
+  # claim job: returns true if can update status from PENDING to RUNNING
+  if not aws.claim_annotation_job(table, job_id):
+    print("Could not claim job id: " + str(job_id))
+    return False
+
+  if on_claim is not None:
+    on_claim()
+
+  # report the progress of the job to its item, at most once every PROGRESS_INTERVAL seconds
+  job_progress = progress.Progress(report=lambda state: aws.set_job_progress(table, job_id, state),
+                                   interval=aws.ANNOTATION_PROGRESS_INTERVAL)
+
+  # run the job; if it fails, put it back to PENDING so the job request can be claimed again
+  try:
+    # stream the input from S3 (decompressing .vcf.gz/bgzip inputs on the fly)
+    lines = None
+    if input_key is not None:
+      lines = s3stream.open_lines(aws.get_s3(), input_bucket, input_key, progress=job_progress)
+
+    driver.run(file_path, 'vcf', engine=aws.ANNOTATION_ENGINE, index=aws.ANNOTATION_INDEX_REGION_TABLES, sweep=aws.ANNOTATION_SORTED_SWEEP, dbsnp_store=aws.ANNOTATION_DBSNP_STORE,
+               source=aws.ANNOTATION_SOURCE, sqlite_database=aws.ANNOTATION_SQLITE_DATABASE,
+               workers=aws.ANNOTATION_WORKERS, shard=aws.ANNOTATION_SHARD_BY, gene_model=aws.ANNOTATION_GENE_MODEL,
+               lines=lines, compress=aws.ANNOTATION_COMPRESS_OUTPUT, progress=job_progress)
+  except:
+    aws.release_annotation_job(table, job_id)
+    delete_local_job_files(folder)
+    raise
+
+  # record complete time
+  complete_time = int(time.time())
+
+  # get the local files created from the job
+  files = get_local_job_files(folder)
+
+  # connect to s3
+  s3 = aws.get_s3()
+
+  # upload files; if one of them did not make it, put the job back to PENDING to be retried
+  uploads = aws.upload_files_to_s3(s3, bucket, prefix, folder, files)
+  if None in uploads.values():
+    aws.release_annotation_job(table, job_id)
+    delete_local_job_files(folder)
+    raise RuntimeError("Could not upload the results of job id: " + str(job_id))
+
+  # update annotations database
+  key_result_file = get_key_result_file(prefix, files)
+  key_log_file = get_key_log_file(prefix, files)
+  key_index_file = get_key_index_file(prefix, files)
+  job_status = 'COMPLETE'
+  result_file_location = 'S3'
+  aws.set_completed_job_details(table, job_id, bucket, key_result_file, key_log_file, complete_time, job_status, result_file_location, key_index_file)
+
+  # get SNS service
+  sns = aws.get_sns()
+
+  # publish message to SNS job results topic
+  job_results_topic = aws.SNS_JOB_RESULTS_TOPIC
+  aws.publish_message(sns, job_results_topic, job_id)
+
+  # if free user: publish to SNS archive requests topic
+  annotation_details = aws.get_annotation_details(table, job_id)
+  if is_free_user(annotation_details):
+    archive_requests_topic = aws.SNS_ARCHIVE_REQUESTS_TOPIC
+    aws.publish_message(sns, archive_requests_topic, job_id)
+
+  # clean up local job files
+  delete_local_job_files(folder)
+
+  # print status to console
+  print("Annotation run complete. S3 and DynamoDB updated for job id: " + str(job_id))
+  return True
+
+###############################
+###          MAIN          ###
+###############################
+
 if __name__ == '__main__':
   # Call the AnnTools pipeline
   if len(sys.argv) > 1:
     with Timer():
 
-      # get the args: file, folder, key prefix, upload bucket
+      # get the args: file, folder, key prefix, upload bucket (and optionally the input bucket and key to stream from)
       file_path = sys.argv[1]
       job_id = sys.argv[2]
       folder = sys.argv[3]
       prefix = sys.argv[4]
       bucket = sys.argv[5]
+      input_bucket = sys.argv[6] if len(sys.argv) > 7 else None
+      input_key = sys.argv[7] if len(sys.argv) > 7 else None
 
       # make sure args were passed correctly
       if file_path is None or job_id is None or folder is None or prefix is None or bucket is None:
         print("Check args passed: file path, folder, prefix, bucket.")
 
-      # connect to the database
-      table_name = aws.DYNAMODB_ANNOTATIONS_TABLE
-      table = aws.get_table(table_name)
-
-      # claim job: returns true if can update status from PENDING to RUNNING
-      if aws.claim_annotation_job(table, job_id):
-
-        # run the job
-        driver.run(file_path, 'vcf')
-
-        # record complete time
-        complete_time = int(time.time())
-
-        # get the local files created from the job
-        files = get_local_job_files(folder)
-
-        # connect to s3
-        s3 = aws.get_s3()
-
-        # upload files
-        aws.upload_files_to_s3(s3, bucket, prefix, folder, files)
-
-        # update annotations database
-        key_result_file = get_key_result_file(prefix, files)
-        key_log_file = get_key_log_file(prefix, files)
-        job_status = 'COMPLETE'
-        result_file_location = 'S3'
-        aws.set_completed_job_details(table, job_id, bucket, key_result_file, key_log_file, complete_time, job_status, result_file_location)
-
-        # get SNS service
-        sns = aws.get_sns()
-
-        # publish message to SNS job results topic
-        job_results_topic = aws.SNS_JOB_RESULTS_TOPIC
-        aws.publish_message(sns, job_results_topic, job_id)
-
-        # if free user: publish to SNS archive requests topic
-        annotation_details = aws.get_annotation_details(table, job_id)
-        if is_free_user(annotation_details):
-          archive_requests_topic = aws.SNS_ARCHIVE_REQUESTS_TOPIC
-          aws.publish_message(sns, archive_requests_topic, job_id)
-
-        # clean up local job files
-        delete_local_job_files(folder)
+      annotated = run_annotation(file_path, job_id, folder, prefix, bucket, input_bucket, input_key)
 
-        # print status to console
-        print("Annotation run complete. S3 and DynamoDB updated for job id: " + str(job_id))
+    if not annotated:
+      sys.exit(NOT_CLAIMED_EXIT_CODE)
 
   else:
     print("A valid .vcf file must be provided as input to this program.")
@@ -0,0 +1,167 @@
+import codecs
+import queue
+import threading
+import time
+import zlib
+
+###############################
+###       CONSTANTS         ###
+###############################
+
+# bytes asked for by every ranged GET
+CHUNK_SIZE = 8 * 1024 * 1024
+# chunks downloaded ahead of the annotation
+PREFETCH_CHUNKS = 4
+# attempts of a ranged GET before giving up
+ATTEMPTS = 3
+
+GZIP_MAGIC = b'\x1f\x8b'
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz')
+
+###############################
+###     HELPER FUNCTIONS    ###
+###############################
+
+# is the key a gzip/bgzip compressed file
+def is_compressed(key):
+  return key.lower().endswith(COMPRESSED_EXTENSIONS)
+
+# name of the annotated input once decompressed: x.vcf.gz -> x.vcf
+def uncompressed_name(filename):
+  for extension in COMPRESSED_EXTENSIONS:
+    if filename.lower().endswith(extension):
+      return filename[:-len(extension)]
+  return filename
+
+###############################
+###      RANGED READER      ###
+###############################
+
+# reads an S3 object chunk by chunk with ranged GETs; a background thread keeps
+# up to PREFETCH_CHUNKS chunks downloaded ahead, so download and annotation overlap
+class RangedReader(object):
+  def __init__(self, s3, bucket, key, chunk_size=CHUNK_SIZE, prefetch=PREFETCH_CHUNKS):
+    self.client = s3.meta.client
+    self.bucket = bucket
+    self.key = key
+    self.chunk_size = chunk_size
+    self.size = self.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    self.chunks = queue.Queue(maxsize=prefetch)
+    self.closed = False
+    self.thread = threading.Thread(target=self.prefetch)
+    self.thread.daemon = True
+    self.thread.start()
+
+  # GET bytes start..end (inclusive), retrying with a growing delay
+  def get_range(self, start, end):
+    for attempt in range(ATTEMPTS):
+      try:
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes={0}-{1}'.format(start, end))
+        return response['Body'].read()
+      except Exception as e:
+        if attempt == ATTEMPTS - 1:
+          raise
+        print("There was an error reading bytes {0}-{1} of {2}, retrying:\n{3}".format(start, end, self.key, str(e)))
+        time.sleep(2 ** attempt)
+
+  def put(self, item):
+    while not self.closed:
+      try:
+        self.chunks.put(item, timeout=1)
+        return
+      except queue.Full:
+        pass
+
+  def prefetch(self):
+    try:
+      for start in range(0, self.size, self.chunk_size):
+        if self.closed:
+          return
+        self.put(self.get_range(start, min(start + self.chunk_size, self.size) - 1))
+      self.put(None)
+    except Exception as e:
+      # handed to the reading side, which raises it
+      self.put(e)
+
+  # yields the chunks of the object in order
+  def __iter__(self):
+    while True:
+      chunk = self.chunks.get()
+      if chunk is None:
+        return
+      if isinstance(chunk, Exception):
+        raise chunk
+      yield chunk
+
+  def close(self):
+    self.closed = True
+
+###############################
+###      DECOMPRESSION      ###
+###############################
+
+# incremental gzip decompression of concatenated members; bgzip files are a
+# series of small gzip members, so a new decompressor starts at every member
+class Gunzip(object):
+  def __init__(self):
+    self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+  def decompress(self, data):
+    out = []
+    while len(data) > 0:
+      out.append(self.decompressor.decompress(data))
+      if not self.decompressor.eof:
+        break
+      data = self.decompressor.unused_data
+      self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    return b''.join(out)
+
+# yields the text lines of a stream of byte chunks, decompressing them first
+# if the stream starts with the gzip magic bytes
+def lines(chunks):
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  gunzip = None
+  first = True
+  pending = ''
+  for chunk in chunks:
+    if first:
+      if chunk[:2] == GZIP_MAGIC:
+        gunzip = Gunzip()
+      first = False
+    if gunzip is not None:
+      chunk = gunzip.decompress(chunk)
+    text = pending + decoder.decode(chunk)
+    parts = text.split('\n')
+    pending = parts.pop()
+    for line in parts:
+      yield line + '\n'
+  pending = pending + decoder.decode(b'', True)
+  if len(pending) > 0:
+    yield pending
+
+###############################
+###          S3             ###
+###############################
+
+# the lines of an S3 object (plain, gzip or bgzip), read as they are downloaded
+# progress (a progress.Progress) counts the bytes of the object read so far
+def open_lines(s3, bucket, key, progress=None):
+  reader = RangedReader(s3, bucket, key)
+  chunks = reader if progress is None else progress.reading(reader, reader.size)
+  try:
+    for line in lines(chunks):
+      yield line
+  finally:
+    reader.close()
+
+# download an S3 object to file_path, decompressing gzip/bgzip objects on the fly
+def download_file(s3, bucket, key, file_path):
+  if not is_compressed(key):
+    s3.Bucket(bucket).download_file(key, file_path)
+    return
+  fh = open(file_path, 'w')
+  try:
+    for line in open_lines(s3, bucket, key):
+      fh.write(line)
+  finally:
+    fh.close()
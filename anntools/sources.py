@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+
+""" Annotation sources: where the stages of pipeline.py read the annotation tables from
+
+    A stage only ever asks its source one of three questions:
+
+        lookup_point(table, chrom, pos)         rows with start <= pos <= end
+        lookup_range(table, chrom, start, end)  rows with rowStart <= end and start <= rowEnd
+        lookup_exact(table, match)              rows whose columns equal the values in match;
+                                                a list of values means any of them
+
+    MySQLSource sends the same queries the annotate.* functions send to the
+    annotator database. SQLiteSource reads a local copy of the tables (see
+    export_sqlite), MemorySource loads every table once and answers in process,
+    and DbSnpStoreSource answers dbSNP from the mmap store of dbsnp_store.py.
+    All of them return rows shaped like "select * from <table>" and follow the
+    comparison rules of MySQL: strings compare case-insensitively, trailing
+    spaces are ignored and NULL never matches.
+
+    openSource builds the source selected in config.ini.
+"""
+
+import itertools
+import os
+import sys
+import threading
+
+import dbsnp_store
+import intervals
+import metrics
+import sql_config
+
+# the annotation tables with the columns they are looked up by: (table, chromosome column, start column)
+TABLES = [('dbSNP', 'CHR', 'POS'),
+          ('chrom_pos_equal_base', 'CHR', 'start'),
+          ('chrom_pos_equal_nobase', 'CHR', 'start'),
+          ('chrom_pos_unequal', 'CHR', 'start'),
+          ('refGene', 'chrom', 'txStart'),
+          ('cpgIslandExt', 'chrom', 'chromStart'),
+          ('cytoBand', 'chrom', 'chromStart'),
+          ('gadAll', 'chromosome', 'chromStart'),
+          ('gwasCatalog', 'chrom', 'chromEnd'),
+          ('targetScanS', 'chrom', 'chromStart'),
+          ('hugo', 'chrom', 'chromStart'),
+          ('dgv_Cnv', 'chrom', 'chromStart'),
+          ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart'),
+          ('mcCarroll_Cnv', 'chrom', 'chromStart'),
+          ('conrad_Cnv', 'chrom', 'chromStart'),
+          ('genomicSuperDups', 'chrom', 'chromStart'),
+          ('putativePromoter', 'chrom', 'chromStart')] + \
+         [('tfbsConsSites' + c, None, 'chromStart') for c in ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','17','18','19','20','21','22','X','Y']]
+
+
+""" MySQL compares strings case-insensitively and ignores trailing spaces """
+def sqlEqual(a, b):
+    return str(a).rstrip(' ').lower() == str(b).rstrip(' ').lower()
+
+
+""" The values of a lookup_exact condition, as a list """
+def matchValues(value):
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+# numbers the sources that cannot tell where their data lives
+_sourceNumbers = itertools.count()
+
+
+class Source(object):
+    """ Base class of the annotation sources
+
+        Subclasses implement columns, scan, findRange and findExact; the lookup_*
+        methods the stages call are built on top of them.
+    """
+
+    def identity(self):
+        """ Key of the data the source reads, shared by every source reading the same data
+
+            The process-wide caches built from a source (interval indexes, gene
+            models, hash indexes) are kept per identity, so a process that reads
+            another database never answers from the tables of the first one.
+            Subclasses that know where their data lives return kind and location.
+        """
+        if not hasattr(self, '_identity'):
+            self._identity = ('source', next(_sourceNumbers))
+        return self._identity
+
+    def columns(self, table):
+        """ Column names of the table, in "select *" order """
+        raise NotImplementedError
+
+    def columnIndex(self, table, name):
+        return intervals.columnIndex(self.columns(table), name)
+
+    def scan(self, table):
+        """ (columns, rows) of the whole table, rows in table order """
+        raise NotImplementedError
+
+    def indexes(self, table):
+        """ Column lists of the indexes of the table in the annotator database, [] if not known """
+        return []
+
+    def rangeOrder(self, table, chromName, startName):
+        """ Columns the rows of a range lookup come back ordered by (then in table order), or None for table order
+
+            The range queries have no ORDER BY: MySQL returns the rows in the order
+            of the access path, which for a range scan of the first index on
+            (chrom, start, ...), or (start, ...) for tables without a chromosome
+            column, is the order of that index and then of the primary key. The
+            in-memory indexes return their overlaps in the same order (see
+            intervals.IntervalIndex); without such an index it is table order.
+        """
+        leading = [startName] if chromName is None else [chromName, startName]
+        for columns in self.indexes(table):
+            if [c.lower() for c in columns[:len(leading)]] == [c.lower() for c in leading]:
+                return columns[len(leading)-1:]
+        return None
+
+    def findRange(self, table, chrom, start, end, chromName, startName, endName):
+        raise NotImplementedError
+
+    def findExact(self, table, match):
+        raise NotImplementedError
+
+    def project(self, table, rows, columns):
+        """ Keeps only the given columns of the rows, like "select <columns> from" """
+        if columns is None:
+            return rows
+        indices = [self.columnIndex(table, name) for name in columns]
+        return [tuple([row[i] for i in indices]) for row in rows]
+
+    def lookup_point(self, table, chrom, pos, chromName='chrom', startName='chromStart', endName='chromEnd', columns=None):
+        return self.lookup_range(table, chrom, pos, pos, chromName=chromName, startName=startName, endName=endName, columns=columns)
+
+    def lookup_range(self, table, chrom, start, end, chromName='chrom', startName='chromStart', endName='chromEnd', columns=None):
+        """ chromName=None for the tables that hold a single chromosome """
+        rows = self.findRange(table, chrom, int(start), int(end), chromName, startName, endName)
+        return self.project(table, rows, columns)
+
+    def lookup_exact(self, table, match):
+        """ match is a dict of column name to value (or list of values) """
+        for value in match.values():
+            if len(matchValues(value)) == 0:
+                return []
+        return self.findExact(table, match)
+
+    def close(self):
+        pass
+
+
+################################################################################
+###                                MYSQL                                     ###
+################################################################################
+
+""" Literal for a value in the SQL strings built below """
+def sqlLiteral(value):
+    if isinstance(value, int):
+        return str(value)
+    return '"' + str(value) + '"'
+
+
+class MySQLSource(Source):
+    """ The annotator database, queried the way annotate.py does """
+
+    def __init__(self, conn=None):
+        if conn is None:
+            conn = sql_config.conn2annotator()
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.tableColumns = {}
+        self.tableIndexes = {}
+
+    def identity(self):
+        db = getattr(self.conn, 'db', None)
+        if isinstance(db, bytes):
+            db = db.decode('utf-8')
+        return ('mysql', getattr(self.conn, 'host', sql_config.host), getattr(self.conn, 'port', sql_config.port), db or sql_config.db)
+
+    def fetch(self, sql):
+        self.cursor.execute(sql)
+        return self.cursor.fetchall()
+
+    def columns(self, table):
+        if table not in self.tableColumns:
+            self.fetch('select * from ' + table + ' limit 0;')
+            self.tableColumns[table] = [str(d[0]) for d in self.cursor.description]
+        return self.tableColumns[table]
+
+    def scan(self, table):
+        rows = self.fetch('select * from ' + table + ';')
+        self.tableColumns[table] = [str(d[0]) for d in self.cursor.description]
+        return self.tableColumns[table], rows
+
+    def indexes(self, table):
+        """ Read from the schema with SHOW INDEX, in the order MySQL lists the indexes """
+        if table not in self.tableIndexes:
+            rows = self.fetch('show index from ' + table + ';')
+            names = [str(d[0]).lower() for d in self.cursor.description]
+            keyName, seq, columnName = names.index('key_name'), names.index('seq_in_index'), names.index('column_name')
+            keys = []
+            keyColumns = {}
+            for row in rows:
+                if row[keyName] not in keyColumns:
+                    keys.append(row[keyName])
+                    keyColumns[row[keyName]] = []
+                keyColumns[row[keyName]].append((int(row[seq]), str(row[columnName])))
+            self.tableIndexes[table] = [[c[1] for c in sorted(keyColumns[key])] for key in keys]
+        return self.tableIndexes[table]
+
+    def findRange(self, table, chrom, start, end, chromName, startName, endName):
+        sql = 'select * from ' + table + ' where '
+        if chromName is not None:
+            sql = sql + chromName + '="' + str(chrom) + '" AND '
+        sql = sql + '(' + startName + ' <= ' + str(end) + ' AND ' + str(start) + ' <= ' + endName + ');'
+        return self.fetch(sql)
+
+    def findExact(self, table, match):
+        conditions = []
+        for column, value in match.items():
+            if isinstance(value, (list, tuple, set)):
+                conditions.append(column + ' IN (' + ','.join([sqlLiteral(v) for v in value]) + ')')
+            else:
+                conditions.append(column + '=' + sqlLiteral(value))
+        return self.fetch('select * from ' + table + ' where ' + ' AND '.join(conditions) + ';')
+
+    def close(self):
+        self.conn.close()
+
+
+################################################################################
+###                                SQLITE                                    ###
+################################################################################
+
+# table of an exported database listing the indexes of the annotator database (see Source.rangeOrder)
+INDEXES_TABLE = 'mysql_indexes'
+
+""" Identifier quoting for SQLite; some column names (end) are keywords """
+def quote(name):
+    return '"' + name + '"'
+
+
+""" Condition on one column; strings compare like MySQL does """
+def sqliteCondition(column, values):
+    if all([isinstance(v, int) for v in values]):
+        params = [v for v in values]
+        target = quote(column)
+    else:
+        params = [str(v).rstrip(' ') for v in values]
+        target = quote(column) + ' COLLATE NOCASE'
+    if len(params) == 1:
+        return target + ' = ?', params
+    return target + ' IN (' + ','.join(['?'] * len(params)) + ')', params
+
+
+class SQLiteSource(Source):
+    """ Local SQLite copy of the annotation tables, written by export_sqlite
+
+        export_sqlite strips trailing spaces from the chromosome columns and
+        indexes them with COLLATE NOCASE, which gives the same matches as the
+        MySQL comparisons while still using the index.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        if not os.path.exists(path):
+            raise IOError('No SQLite annotation database at ' + path)
+        self.path = os.path.abspath(path)
+        self.conn = sqlite3.connect(path)
+        self.cursor = self.conn.cursor()
+        self.tableColumns = {}
+        self.tableIndexes = None
+
+    def identity(self):
+        # a file written again (e.g. a new fixture at the same path) is another database
+        stat = os.stat(self.path)
+        return ('sqlite', self.path, stat.st_mtime, stat.st_size)
+
+    def fetch(self, sql, params=()):
+        self.cursor.execute(sql, params)
+        rows = self.cursor.fetchall()
+        metrics.countQuery()
+        metrics.countRows(len(rows))
+        return rows
+
+    def columns(self, table):
+        if table not in self.tableColumns:
+            self.fetch('select * from ' + quote(table) + ' limit 0;')
+            self.tableColumns[table] = [str(d[0]) for d in self.cursor.description]
+        return self.tableColumns[table]
+
+    def scan(self, table):
+        rows = self.fetch('select * from ' + quote(table) + ' order by rowid;')
+        self.tableColumns[table] = [str(d[0]) for d in self.cursor.description]
+        return self.tableColumns[table], rows
+
+    def indexes(self, table):
+        """ The indexes of the annotator database, as export_sqlite recorded them """
+        if self.tableIndexes is None:
+            self.tableIndexes = {}
+            self.cursor.execute("select name from sqlite_master where type = 'table' and name = ?;", (INDEXES_TABLE,))
+            if self.cursor.fetchone() is not None:
+                self.cursor.execute('select "table", columns from ' + quote(INDEXES_TABLE) + ' order by rowid;')
+                for table_name, columns in self.cursor.fetchall():
+                    self.tableIndexes.setdefault(table_name, []).append(columns.split(','))
+        return self.tableIndexes.get(table, [])
+
+    def findRange(self, table, chrom, start, end, chromName, startName, endName):
+        conditions = [quote(startName) + ' <= ?', '? <= ' + quote(endName)]
+        params = [end, start]
+        if chromName is not None:
+            condition, chromParams = sqliteCondition(chromName, [chrom])
+            conditions.insert(0, condition)
+            params = chromParams + params
+        order = [quote(name) for name in (self.rangeOrder(table, chromName, startName) or [])] + ['rowid']
+        return self.fetch('select * from ' + quote(table) + ' where ' + ' AND '.join(conditions) + ' order by ' + ', '.join(order) + ';', params)
+
+    def findExact(self, table, match):
+        conditions = []
+        params = []
+        for column, value in match.items():
+            condition, valueParams = sqliteCondition(column, matchValues(value))
+            conditions.append(condition)
+            params = params + valueParams
+        return self.fetch('select * from ' + quote(table) + ' where ' + ' AND '.join(conditions) + ' order by rowid;', params)
+
+    def close(self):
+        self.conn.close()
+
+
+""" Value of a MySQL row as stored in SQLite """
+def sqliteValue(value):
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    return str(value)
+
+
+""" Chromosome of a row or table name without the chr prefix, so that '1', 'chr1' and 'Chr1' compare equal """
+def bareChrom(chrom):
+    key = intervals.chromKey(chrom)
+    return key[3:] if key.startswith('chr') else key
+
+
+""" Copies the annotation tables of the annotator database into the SQLite file at path
+
+    source reads the tables from somewhere else than the annotator database.
+    chroms keeps only the rows of those chromosomes and limit at most that many
+    rows of every table, for a small fixture database (see benchmark.py).
+"""
+def export_sqlite(path, tables=TABLES, source=None, chroms=None, limit=None):
+    import sqlite3
+
+    ownSource = source is None
+    if ownSource:
+        source = MySQLSource()
+    keep = None if chroms is None else set([bareChrom(c) for c in chroms])
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    # the indexes of the tables, so that range lookups on the copy return rows in the same order
+    cursor.execute('drop table if exists ' + quote(INDEXES_TABLE) + ';')
+    cursor.execute('create table ' + quote(INDEXES_TABLE) + ' ("table", columns);')
+    for table, chromName, startName in tables:
+        columns, rows = source.scan(table)
+        chromIndex = None if chromName is None else intervals.columnIndex(columns, chromName)
+        if keep is not None:
+            if chromIndex is not None:
+                rows = [row for row in rows if bareChrom(row[chromIndex]) in keep]
+            elif table.startswith('tfbsConsSites') and bareChrom(table[len('tfbsConsSites'):]) not in keep:
+                rows = []
+        if limit is not None:
+            rows = rows[:limit]
+        if chromIndex is not None:
+            rows = [row[:chromIndex] + (row[chromIndex] if row[chromIndex] is None else str(row[chromIndex]).rstrip(' '),) + row[chromIndex+1:] for row in rows]
+
+        cursor.executemany('insert into ' + quote(INDEXES_TABLE) + ' values (?, ?);',
+                           [(table, ','.join(columns)) for columns in source.indexes(table)])
+        cursor.execute('drop table if exists ' + quote(table) + ';')
+        cursor.execute('create table ' + quote(table) + ' (' + ', '.join([quote(c) for c in columns]) + ');')
+        cursor.executemany('insert into ' + quote(table) + ' values (' + ','.join(['?'] * len(columns)) + ');',
+                           [[sqliteValue(v) for v in row] for row in rows])
+        if chromName is None:
+            cursor.execute('create index ' + quote(table + '_start') + ' on ' + quote(table) + ' (' + quote(startName) + ');')
+        else:
+            cursor.execute('create index ' + quote(table + '_chrom_start') + ' on ' + quote(table) + ' (' + quote(chromName) + ' COLLATE NOCASE, ' + quote(startName) + ');')
+        conn.commit()
+        print("Exported " + str(len(rows)) + " rows of " + table)
+    conn.close()
+    if ownSource:
+        source.close()
+
+
+################################################################################
+###                                MEMORY                                    ###
+################################################################################
+
+# hash indexes stay loaded for the life of the process, per source like the interval indexes
+_exactIndexes = {}
+_exactIndexesLock = threading.Lock()
+
+""" Hash key of a value under the MySQL comparison rules """
+def matchKey(value):
+    return str(value).rstrip(' ').lower()
+
+
+class MemorySource(Source):
+    """ Loads every table from another source on first use and answers in process
+
+        Range lookups go through the interval indexes of intervals.py (shared with
+        the index=True option of the overlap stages); exact lookups through a hash
+        index per table and set of columns. Both are kept for the life of the
+        process, so a persistent worker loads every table once.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def identity(self):
+        return self.loader.identity()
+
+    def columns(self, table):
+        return self.loader.columns(table)
+
+    def indexes(self, table):
+        return self.loader.indexes(table)
+
+    def scan(self, table):
+        return self.loader.scan(table)
+
+    def findRange(self, table, chrom, start, end, chromName, startName, endName):
+        index = intervals.getIndex(self.loader, table, chromName=chromName, startName=startName, endName=endName)
+        return index.overlappingRange(chrom, start, end)
+
+    def exactIndex(self, table, names):
+        key = (self.loader.identity(), table, tuple(names))
+        index = _exactIndexes.get(key)
+        if index is None:
+            with _exactIndexesLock:
+                index = _exactIndexes.get(key)
+                if index is None:
+                    columns, rows = self.loader.scan(table)
+                    indices = [intervals.columnIndex(columns, name) for name in names]
+                    index = {}
+                    for row in rows:
+                        values = [row[i] for i in indices]
+                        if None not in values:
+                            index.setdefault(tuple([matchKey(v) for v in values]), []).append(row)
+                    _exactIndexes[key] = index
+        return index
+
+    def findExact(self, table, match):
+        names = list(match.keys())
+        index = self.exactIndex(table, names)
+        keys = [[]]
+        for name in names:
+            keys = [k + [matchKey(v)] for k in keys for v in matchValues(match[name])]
+
+        rows = []
+        for k in keys:
+            rows.extend(index.get(tuple(k), []))
+        return rows
+
+    def close(self):
+        self.loader.close()
+
+
+################################################################################
+###                                MMAP                                      ###
+################################################################################
+
+class DbSnpStoreSource(Source):
+    """ Answers the dbSNP table from a dbsnp_store.DbSnpStore, everything else from fallback """
+
+    def __init__(self, path, fallback):
+        self.store = dbsnp_store.getStore(path)
+        self.fallback = fallback
+
+    def identity(self):
+        # everything but findExact on dbSNP comes from the fallback, and so do the caches
+        return self.fallback.identity()
+
+    def columns(self, table):
+        if table == self.store.table:
+            return self.store.columns
+        return self.fallback.columns(table)
+
+    def scan(self, table):
+        return self.fallback.scan(table)
+
+    def indexes(self, table):
+        return self.fallback.indexes(table)
+
+    def findRange(self, table, chrom, start, end, chromName, startName, endName):
+        return self.fallback.findRange(table, chrom, start, end, chromName, startName, endName)
+
+    def findExact(self, table, match):
+        chrColumn = self.store.columns[self.store.chrIndex].lower()
+        posColumn = self.store.columns[self.store.posIndex].lower()
+        names = [name.lower() for name in match.keys()]
+        if table != self.store.table or chrColumn not in names or posColumn not in names:
+            return self.fallback.findExact(table, match)
+
+        rows = []
+        values = dict([(name.lower(), matchValues(value)) for name, value in match.items()])
+        for chrom in values[chrColumn]:
+            for pos in sorted(set([int(p) for p in values[posColumn]])):
+                rows.extend(self.store.rows(chrom, pos))
+
+        for name, wanted in values.items():
+            if name == chrColumn or name == posColumn:
+                continue
+            index = intervals.columnIndex(self.store.columns, name)
+            rows = [row for row in rows if row[index] is not None and any([sqlEqual(row[index], v) for v in wanted])]
+        return rows
+
+    def close(self):
+        self.fallback.close()
+
+
+################################################################################
+###                                CONFIG                                    ###
+################################################################################
+
+""" The source selected in config.ini
+    kind is mysql, sqlite (reads sqlite_database) or memory (loads from sqlite_database if set, else from MySQL)
+    dbsnp_store answers dbSNP from a local store on top of any of them
+"""
+def openSource(kind='mysql', sqlite_database=None, dbsnp_store=None):
+    if kind == 'mysql':
+        source = MySQLSource()
+    elif kind == 'sqlite':
+        source = SQLiteSource(sqlite_database)
+    elif kind == 'memory':
+        if sqlite_database:
+            source = MemorySource(SQLiteSource(sqlite_database))
+        else:
+            source = MemorySource(MySQLSource())
+    else:
+        raise ValueError('Unknown annotation source: ' + str(kind))
+
+    if dbsnp_store:
+        source = DbSnpStoreSource(dbsnp_store, source)
+    return source
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        export_sqlite(sys.argv[1])
+    else:
+        print("Usage: python sources.py <sqlite database>")
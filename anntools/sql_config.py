@@ -33,10 +33,20 @@
 ################################################################################
 
 #import MySQLdb
+import os
+import threading
+import time
 import pymysql
 import file_utils as fu
+import metrics
 import file_utils as fu
 
+# idle connections kept open per process
+POOL_SIZE = 4
+# attempts to open a connection before giving up, and the pause between them (in seconds)
+RECONNECT_ATTEMPTS = 3
+RECONNECT_DELAY = 1
+
 def load_config(filename='config.txt'):
     fh = open(filename, "r")
     lines = []
@@ -55,7 +65,147 @@ passwd = config[2]
 db = config[3]
 port = int(config[4])
 
-def conn2annotator():
+def connect():
     #conn = MySQLdb.connect (host = host, user = user, passwd = passwd, db = db, port = port)
     conn = pymysql.connect (host = host, user = user, passwd = passwd, db = db, port = port)
     return conn
+
+
+class CountingCursor(object):
+    """ Cursor that counts its queries and fetched rows (see metrics.py) """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        for row in self.cursor:
+            metrics.countRows(1)
+            yield row
+
+    def execute(self, *args):
+        metrics.countQuery()
+        return self.cursor.execute(*args)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            metrics.countRows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        metrics.countRows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        metrics.countRows(len(rows))
+        return rows
+
+
+class PooledConnection(object):
+    """ Connection borrowed from the pool; close() hands it back instead of closing it """
+
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+        self.pid = os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def cursor(self, *args):
+        return CountingCursor(self.conn.cursor(*args))
+
+    def close(self):
+        if self.conn is not None:
+            # a forked child must not touch the socket of its parent
+            if self.pid == os.getpid():
+                self.pool.release(self.conn)
+            self.conn = None
+
+
+class ConnectionPool(object):
+    """ Process-wide pool of connections to the annotator database
+
+        Every annotate.* function and every annotation source asks for a connection
+        and closes it when done, so a process that runs several stages or several
+        jobs reuses the same few connections. A connection is pinged before it is
+        handed out again; one that fails the check is dropped and replaced, and
+        opening a new connection is retried RECONNECT_ATTEMPTS times. Connections
+        inherited from a parent process are never reused by the child.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def healthy(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except pymysql.err.Error:
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+    def open(self):
+        for attempt in range(1, RECONNECT_ATTEMPTS+1):
+            try:
+                return connect()
+            except pymysql.err.OperationalError as e:
+                print("Could not connect to the annotator database (attempt " + str(attempt) + " of " + str(RECONNECT_ATTEMPTS) + "): " + str(e))
+                if attempt == RECONNECT_ATTEMPTS:
+                    raise
+                time.sleep(RECONNECT_DELAY*attempt)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.pid != os.getpid():
+                    # the sockets belong to the parent process
+                    self.idle = []
+                    self.pid = os.getpid()
+                if len(self.idle) == 0:
+                    break
+                conn = self.idle.pop()
+            if self.healthy(conn):
+                return conn
+            self.discard(conn)
+        return self.open()
+
+    def release(self, conn):
+        # end the read transaction so the next user sees current data
+        try:
+            conn.rollback()
+        except pymysql.err.Error:
+            self.discard(conn)
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        self.discard(conn)
+
+    def clear(self):
+        """ Closes the idle connections """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self.discard(conn)
+
+
+pool = ConnectionPool()
+
+def conn2annotator():
+    return PooledConnection(pool, pool.acquire())
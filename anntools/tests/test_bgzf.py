@@ -0,0 +1,137 @@
+""" Round trip of bgzf.py results through the region reader of the web app
+
+    A VCF is compressed with its tabix index by compress_vcf and read back
+    with gas/regions.py RegionReader from an in-memory stand-in for S3, so the
+    writer and the (separate) reader of the index are checked against each
+    other and against a plain scan of the records.
+"""
+
+import gzip
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'gas'))
+
+from botocore.exceptions import ClientError
+
+import bgzf
+import regions
+
+
+class MemoryS3(object):
+    """ get_object of an S3 client over a dict of keys to bytes """
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        data = self.objects[Key]
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end)+1]
+        return {'Body': io.BytesIO(data)}
+
+
+HEADER = ['##fileformat=VCFv4.1',
+          '##INFO=<ID=DB,Number=0,Type=Flag,Description="dbSNP membership">',
+          '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+
+""" Sorted VCF records on a few chromosomes, long enough to span many BGZF blocks """
+def records(seed=1, count=20000):
+    rng = random.Random(seed)
+    lines = []
+    for chrom in ['1', '2', '10', 'X']:
+        pos = 1
+        for i in range(count // 4):
+            pos = pos + rng.choice([0, 1, 7, 150, 2000, 40000])
+            ref = rng.choice(['A', 'C', 'GT', 'TTAGC', 'A' * 60])
+            lines.append('\t'.join([chrom, str(pos), 'rs%d' % i, ref, 'G', '.', 'PASS', 'DB;N=%d' % rng.randint(0, 10**6)]))
+    return lines
+
+""" The records overlapping chrom:start-end (1-based, inclusive), as the query defines them """
+def overlapping(lines, chrom, start, end):
+    found = []
+    for line in lines:
+        fields = line.split('\t')
+        beg = int(fields[1])
+        if fields[0] == chrom and beg <= end and beg + max(len(fields[3]), 1) - 1 >= start:
+            found.append(line)
+    return found
+
+
+class BgzfRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def compress(self, name, lines):
+        infile = os.path.join(self.folder, name)
+        fh = open(infile, 'w')
+        fh.write('\n'.join(HEADER + lines) + '\n')
+        fh.close()
+        return bgzf.compress_vcf(infile, keep=True)
+
+    def reader(self, name, outfile, indexfile):
+        objects = {name: open(outfile, 'rb').read()}
+        if indexfile is not None:
+            objects[name + '.tbi'] = open(indexfile, 'rb').read()
+        return regions.RegionReader(MemoryS3(objects), 'results', name)
+
+    def test_gzip_readable(self):
+        lines = records()
+        outfile, indexfile = self.compress('gzip.vcf', lines)
+        self.assertIsNotNone(indexfile)
+        self.assertEqual(gzip.open(outfile, 'rt').read(), '\n'.join(HEADER + lines) + '\n')
+        self.assertTrue(open(outfile, 'rb').read().endswith(bgzf.EOF_BLOCK))
+
+    def test_region_queries(self):
+        lines = records()
+        outfile, indexfile = self.compress('query.vcf', lines)
+        reader = self.reader('query.vcf.gz', outfile, indexfile)
+        self.assertEqual(reader.header(), HEADER)
+
+        rng = random.Random(2)
+        for i in range(300):
+            chrom = rng.choice(['1', '2', '10', 'X'])
+            start = rng.randint(1, 5 * 10**7)
+            end = start + rng.choice([0, 1, 100, 20000, 10**6, 10**8])
+            found, truncated = reader.query(chrom, start, end)
+            self.assertFalse(truncated)
+            self.assertEqual(found, overlapping(lines, chrom, start, end), (chrom, start, end))
+
+        self.assertEqual(reader.query('22', 1, 10**9), ([], False))
+        found, truncated = reader.query('1', 1, 10**9, limit=10)
+        self.assertEqual((found, truncated), (overlapping(lines, '1', 1, 10**9)[:10], True))
+
+    def test_unsorted_input_not_indexed(self):
+        lines = records(count=400)
+        outfile, indexfile = self.compress('unsorted.vcf', lines[::-1])
+        self.assertIsNone(indexfile)
+        self.assertFalse(os.path.exists(outfile + '.tbi'))
+        reader = self.reader('unsorted.vcf.gz', outfile, indexfile)
+        self.assertRaises(regions.NotIndexed, reader.query, '1', 1, 100)
+
+    def test_bins_agree(self):
+        # the writer and the reader each carry their own copy of the binning scheme
+        rng = random.Random(3)
+        for i in range(2000):
+            beg = rng.randint(0, 2**29 - 2)
+            end = rng.randint(beg + 1, min(2**29, beg + rng.choice([1, 10**3, 10**6, 10**8])))
+            self.assertEqual(sorted(bgzf.reg2bins(beg, end)), sorted(regions.reg2bins(beg, end)))
+            self.assertIn(bgzf.reg2bin(beg, end), regions.reg2bins(beg, end))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import multiprocessing
+from subprocess import Popen
+import time
+import traceback
+
+###############################
+###      AWS FUNCTIONS     ###
+###############################
+
+import aws
+import run
+
+# how a job ended, as reported by completed(): annotated, failed (its request
+# should be retried) or not claimed (the job was not PENDING, see run.run_annotation)
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+NOT_CLAIMED = 'not claimed'
+
+# put the job of a worker or process that died back to PENDING, otherwise it would
+# stay RUNNING and could never be claimed again; the tag of a job is its job id
+# (annotator.run_anntools_in_pool)
+def release(tag):
+  try:
+    table = aws.get_table(aws.DYNAMODB_ANNOTATIONS_TABLE)
+    aws.release_annotation_job(table, tag)
+  except Exception as e:
+    print("There was an error putting job " + str(tag) + " back to PENDING:\n" + str(e))
+
+###############################
+###       WORKER SIDE       ###
+###############################
+
+# open the annotation tables once so the first job does not pay for loading
+# them (memory source, region indexes, gene model, dbSNP store)
+def warm_up():
+  try:
+    import pipeline
+    import sources
+    stages = pipeline.default_stages(format='vcf', index=aws.ANNOTATION_INDEX_REGION_TABLES, sweep=aws.ANNOTATION_SORTED_SWEEP, gene_model=aws.ANNOTATION_GENE_MODEL)
+    tables = sources.openSource(aws.ANNOTATION_SOURCE, sqlite_database=aws.ANNOTATION_SQLITE_DATABASE, dbsnp_store=aws.ANNOTATION_DBSNP_STORE)
+    for stage in stages:
+      stage.open(tables)
+    tables.close()
+  except:
+    print("There was an error loading the annotation tables; they will be loaded by the first job.")
+    traceback.print_exc()
+
+# take jobs off the queue until told to stop (None); every job is reported back
+# as started, claimed (once it is RUNNING) and then done, so the pool knows what
+# each worker is doing
+def worker_loop(jobs, results):
+  warm_up()
+  while True:
+    job = jobs.get()
+    if job is None:
+      break
+    tag, args = job
+    pid = multiprocessing.current_process().pid
+    results.put(('started', tag, pid))
+    try:
+      annotated = run.run_annotation(*args, on_claim=lambda: results.put(('claimed', tag, pid)))
+      results.put(('done', tag, SUCCEEDED if annotated else NOT_CLAIMED))
+    except:
+      print("There was an error annotating job: " + str(tag))
+      traceback.print_exc()
+      results.put(('done', tag, FAILED))
+
+###############################
+###        POOL SIDE        ###
+###############################
+
+# long-lived annotation worker processes fed through an internal queue
+# at most `processes` jobs run at once; a worker that dies is replaced, the job
+# it had claimed is put back to PENDING and it is reported as failed
+class WorkerPool(object):
+  def __init__(self, processes):
+    self.processes = max(1, processes)
+    # fork so the workers start with the modules and config already loaded;
+    # the pool must be created before any boto3 client or database connection
+    self.context = multiprocessing.get_context('fork')
+    self.jobs = self.context.Queue()
+    # results are written straight to the pipe, so nothing is lost when a worker dies
+    self.results = self.context.SimpleQueue()
+    self.workers = []
+    self.pending = {}   # tag -> args of every job submitted and not yet done
+    self.started = {}   # pid -> tag of the job a worker is running
+    self.claimed = set()   # tags of the running jobs that were claimed (RUNNING)
+    self.dead = set()   # pids of the workers that were replaced
+    for i in range(self.processes):
+      self.start_worker()
+
+  def start_worker(self):
+    # not a daemon: workers may start their own pool (parallel.py)
+    worker = self.context.Process(target=worker_loop, args=(self.jobs, self.results))
+    worker.start()
+    self.workers.append(worker)
+    print("Started annotation worker " + str(worker.pid))
+
+  # number of jobs that can be submitted without waiting
+  def free_slots(self):
+    return max(0, self.processes - len(self.pending))
+
+  def submit(self, tag, args):
+    self.jobs.put((tag, args))
+    self.pending[tag] = args
+
+  # collect the results reported so far (waiting up to timeout seconds for the
+  # first one) and replace dead workers; returns [(tag, SUCCEEDED, FAILED or
+  # NOT_CLAIMED)] of finished jobs
+  def completed(self, timeout=0):
+    # look for dead workers first: everything they reported is then in the results
+    dead = [worker for worker in self.workers if not worker.is_alive()]
+    finished = []
+    deadline = time.time() + timeout
+    while True:
+      if self.results.empty():
+        if len(finished) > 0 or time.time() >= deadline:
+          break
+        time.sleep(0.1)
+        continue
+      kind, tag, value = self.results.get()
+      if kind == 'started' and value in self.dead:
+        # the worker died right after taking the job
+        if tag in self.pending:
+          del self.pending[tag]
+          finished.append((tag, FAILED))
+      elif kind == 'started':
+        self.started[value] = tag
+      elif kind == 'claimed':
+        self.claimed.add(tag)
+      elif tag in self.pending:
+        del self.pending[tag]
+        self.claimed.discard(tag)
+        self.started = dict([(pid, t) for pid, t in self.started.items() if t != tag])
+        finished.append((tag, value))
+    return finished + self.supervise(dead)
+
+  # replace the dead workers; the job a dead worker had claimed is put back to PENDING
+  def supervise(self, dead):
+    failed = []
+    for worker in dead:
+      print("Annotation worker " + str(worker.pid) + " exited with code " + str(worker.exitcode) + ", restarting it")
+      self.workers.remove(worker)
+      self.dead.add(worker.pid)
+      tag = self.started.pop(worker.pid, None)
+      if tag is not None and tag in self.pending:
+        del self.pending[tag]
+        if tag in self.claimed:
+          self.claimed.discard(tag)
+          release(tag)
+        failed.append((tag, FAILED))
+      self.start_worker()
+    return failed
+
+  # let the running jobs finish, then stop the workers
+  def close(self):
+    for worker in self.workers:
+      self.jobs.put(None)
+    for worker in self.workers:
+      worker.join()
+    self.workers = []
+
+# the same interface, running each job in a new run.py process (PERSISTENT_WORKER = false)
+# at most `processes` jobs run at once; a job is done when its process exits, and
+# its exit code tells how it ended (run.NOT_CLAIMED_EXIT_CODE when it was not claimed)
+class ProcessPool(object):
+  def __init__(self, processes, run_file='run.py'):
+    self.processes = max(1, processes)
+    self.run_file = run_file
+    self.running = {}   # tag -> Popen of every job submitted and not yet done
+
+  # number of jobs that can be submitted without waiting
+  def free_slots(self):
+    return max(0, self.processes - len(self.running))
+
+  def submit(self, tag, args):
+    self.running[tag] = Popen(['python', self.run_file] + list(args), stdin=None, stdout=None, stderr=None, shell=False)
+
+  # the jobs whose process exited (waiting up to timeout seconds for the
+  # first one); returns [(tag, SUCCEEDED, FAILED or NOT_CLAIMED)]
+  def completed(self, timeout=0):
+    deadline = time.time() + timeout
+    while True:
+      finished = []
+      for tag, process in list(self.running.items()):
+        code = process.poll()
+        if code is None:
+          continue
+        del self.running[tag]
+        if code == 0:
+          finished.append((tag, SUCCEEDED))
+        elif code == run.NOT_CLAIMED_EXIT_CODE:
+          finished.append((tag, NOT_CLAIMED))
+        else:
+          print("Annotation process for job " + str(tag) + " exited with code " + str(code))
+          # killed by a signal: run.py had no chance to put its job back to PENDING
+          if code < 0:
+            release(tag)
+          finished.append((tag, FAILED))
+      if len(finished) > 0 or time.time() >= deadline:
+        return finished
+      time.sleep(0.1)
+
+  # let the running jobs finish
+  def close(self):
+    for process in self.running.values():
+      process.wait()
+    self.running = {}
@@ -1,6 +1,7 @@
 import uuid
+import time
 from flask import (flash, redirect, render_template, url_for,
-  request, session, abort)
+  request, session, abort, has_request_context)
 
 from globus_sdk import RefreshTokenAuthorizer, ConfidentialAppAuthClient
 
@@ -10,6 +11,18 @@ from utils import (load_portal_client, get_portal_tokens,
   get_safe_redirect)
 
 from models import Profile
+from cache import TTLCache
+
+# profiles read by this process: str(identity_id) -> CachedProfile
+profile_cache = TTLCache(app.config['GAS_PROFILE_CACHE_TTL'], max_entries=10000)
+
+"""A read-only copy of a profile row that outlives the database session
+"""
+class CachedProfile(object):
+  def __init__(self, profile):
+    for column in Profile.__table__.columns:
+      setattr(self, column.name, getattr(profile, column.name))
+    self.loaded = time.time()
 
 """Create a new user profile
 This is run automatically the first time we see a (valid) new identity
@@ -23,11 +36,23 @@ def create_profile(identity_id=None, name=None, email=None):
   )
   db.session.add(profile)
   db.session.commit()
+  invalidate_profile(identity_id)
 
 """Gets user profile from RDS database
+Profiles are cached by the process for GAS_PROFILE_CACHE_TTL seconds; a copy
+older than the last change the user made to their profile (in any process) is
+read again.
 """
 def get_profile(identity_id=None):
-  return db.session.query(Profile).filter_by(identity_id=identity_id).first()
+  cached = profile_cache.get(str(identity_id))
+  if cached is not None and cached.loaded > profile_updated_time():
+    return cached
+  profile = db.session.query(Profile).filter_by(identity_id=identity_id).first()
+  if profile is None:
+    return None
+  cached = CachedProfile(profile)
+  profile_cache.set(str(identity_id), cached)
+  return cached
 
 """Update an existing user's profile
 """
@@ -39,6 +64,24 @@ def update_profile(identity_id=None, name=None,
   profile.institution = institution if institution else profile.institution
   profile.role = role if role else profile.role
   db.session.commit()
+  invalidate_profile(identity_id)
+
+"""Drop the cached profile of a user after it changed
+The time of the change is kept in the session too, so the user's next requests
+read the new profile from any web server process, not only from this one.
+"""
+def invalidate_profile(identity_id):
+  profile_cache.delete(str(identity_id))
+  if has_request_context() and str(session.get('primary_identity')) == str(identity_id):
+    session['profile_updated'] = time.time()
+
+"""When the profile of the user of the current request last changed, as far as
+the session knows (0 outside requests)
+"""
+def profile_updated_time():
+  if not has_request_context():
+    return 0
+  return session.get('profile_updated', 0)
 
 """Logout from Globus Auth
 """
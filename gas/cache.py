@@ -0,0 +1,76 @@
+import collections
+import time
+from threading import Lock
+
+"""In-process caches of the web app
+Every web server process keeps its own caches, so an entry can be stale for up
+to its time to live when another process (or the annotator) changes the data;
+the routes invalidate what they change themselves.
+"""
+
+
+"""A thread-safe cache whose entries expire ttl seconds after they were set
+Entries can be tagged with a group (e.g. a user id) to invalidate them together;
+the least recently used entries are dropped beyond max_entries.
+"""
+class TTLCache(object):
+  def __init__(self, ttl, max_entries=1024):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()  # key -> (expires, group, value)
+    self.groups = {}                          # group -> set of keys
+    self.lock = Lock()
+
+  """The value cached for key, or default if there is none or it expired
+  """
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return default
+      if entry[0] < time.time():
+        self.remove(key)
+        return default
+      self.entries.move_to_end(key)
+      return entry[2]
+
+  def set(self, key, value, group=None):
+    with self.lock:
+      self.remove(key)
+      self.entries[key] = (time.time() + self.ttl, group, value)
+      if group is not None:
+        self.groups.setdefault(group, set()).add(key)
+      while len(self.entries) > self.max_entries:
+        self.remove(next(iter(self.entries)))
+
+  def delete(self, key):
+    with self.lock:
+      self.remove(key)
+
+  """Drop every entry of group
+  """
+  def invalidate(self, group):
+    with self.lock:
+      for key in list(self.groups.get(group, ())):
+        self.remove(key)
+
+  """The values of the live entries of group
+  """
+  def values(self, group):
+    now = time.time()
+    with self.lock:
+      return [self.entries[key][2] for key in self.groups.get(group, ()) if self.entries[key][0] >= now]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.groups.clear()
+
+  # callers hold the lock
+  def remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None and entry[1] is not None:
+      keys = self.groups.get(entry[1])
+      keys.discard(key)
+      if len(keys) == 0:
+        del self.groups[entry[1]]
@@ -0,0 +1,69 @@
+import os
+from threading import Lock, local
+
+import boto3
+from botocore.client import Config
+
+from gas import app
+
+"""Shared AWS clients of the web server
+Creating a client resolves credentials, loads the service model and opens new
+connections, so every web server process creates each client once and all the
+requests it serves reuse it (and its pool of open connections). Clients are
+thread-safe; boto3 resources are not, so DynamoDB tables are kept per thread.
+"""
+
+_clients = {}
+_lock = Lock()
+_local = local()
+_pid = None
+
+"""Client settings: a connection pool as large as the threads that may share the
+client, and v4 signatures so S3 presigned URLs and posts work in every region
+"""
+def client_config(service):
+  if service == 's3':
+    return Config(signature_version='s3v4', max_pool_connections=app.config['AWS_MAX_POOL_CONNECTIONS'])
+  return Config(max_pool_connections=app.config['AWS_MAX_POOL_CONNECTIONS'])
+
+"""Forget the clients of the parent process after a fork (e.g. gunicorn --preload);
+connections must not be shared between processes
+"""
+def check_process():
+  global _pid
+  if _pid != os.getpid():
+    with _lock:
+      if _pid != os.getpid():
+        _clients.clear()
+        _pid = os.getpid()
+
+"""The client of an AWS service (s3, sns, ses...) shared by the process
+"""
+def get_client(service):
+  check_process()
+  client = _clients.get(service)
+  if client is None:
+    with _lock:
+      client = _clients.get(service)
+      if client is None:
+        client = boto3.session.Session().client(service,
+          region_name=app.config['AWS_REGION_NAME'],
+          config=client_config(service)
+        )
+        _clients[service] = client
+  return client
+
+"""A DynamoDB table of the thread's DynamoDB resource
+"""
+def get_table(name):
+  check_process()
+  if getattr(_local, 'pid', None) != os.getpid():
+    _local.dynamodb = boto3.session.Session().resource('dynamodb',
+      region_name=app.config['AWS_REGION_NAME'],
+      config=client_config('dynamodb')
+    )
+    _local.tables = {}
+    _local.pid = os.getpid()
+  if name not in _local.tables:
+    _local.tables[name] = _local.dynamodb.Table(name)
+  return _local.tables[name]
@@ -28,6 +28,7 @@ class Config(object):
   AWS_PROFILE_NAME = os.environ['AWS_PROFILE_NAME'] if ('AWS_PROFILE_NAME' in  os.environ) else None
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
   AWS_SIGNED_REQUEST_EXPIRATION = 300  # validity of pre-signed POST requests (in seconds)
+  AWS_MAX_POOL_CONNECTIONS = 50  # open connections kept by each shared AWS client (see clients.py)
 
   AWS_S3_INPUTS_BUCKET = "gas-inputs"
   AWS_S3_RESULTS_BUCKET = "gas-results"
@@ -37,6 +38,9 @@ class Config(object):
 
   AWS_GLACIER_VAULT = "ucmpcs"
 
+  # most records returned by one region query of an annotation result
+  GAS_REGION_MAX_RECORDS = 10000
+
   # Change the ARNs below to reflect your SNS topics
   AWS_SNS_JOB_REQUEST_TOPIC = "arn:aws:sns:us-east-1:127134666975:ramonlrodriguez_job_requests"
   AWS_SNS_JOB_COMPLETE_TOPIC = "arn:aws:sns:us-east-1:127134666975:ramonlrodriguez_job_results"
@@ -44,6 +48,33 @@ class Config(object):
 
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "ramonlrodriguez_annotations"
+  # global secondary index of the table: user_id (hash key), submit_time (range key)
+  AWS_DYNAMODB_USER_SUBMIT_TIME_INDEX = "user_id_submit_time_index"
+
+  # annotations listed per page, and how long (in seconds) a listing page is cached
+  GAS_ANNOTATIONS_PAGE_SIZE = 25
+  GAS_ANNOTATIONS_CACHE_TTL = 30
+
+  # how long (in seconds) a web server process keeps a user profile it has read
+  GAS_PROFILE_CACHE_TTL = 300
+
+  # how long (in seconds) job states of /annotations/<job_id>/status are cached;
+  # notifications of the job results topic update them right away
+  GAS_JOB_STATUS_CACHE_TTL = 10
+  # push status changes to job pages with server-sent events; every open page holds
+  # a connection, so only enable with threaded or asynchronous gunicorn workers
+  GAS_JOB_STATUS_STREAM = (os.environ['GAS_JOB_STATUS_STREAM'] == 'true') if ('GAS_JOB_STATUS_STREAM' in os.environ) else False
+  GAS_JOB_STATUS_STREAM_TIMEOUT = 300  # the page reconnects after this many seconds
+  # how long (in seconds) the public keys of the SNS signing certificates are cached
+  GAS_SNS_CERTIFICATE_CACHE_TTL = 24 * 3600
+
+  # bytes of a log file shown at a time (at most GAS_LOG_MAX_PAGE_BYTES with ?limit=)
+  GAS_LOG_PAGE_BYTES = 1024 * 1024
+  GAS_LOG_MAX_PAGE_BYTES = 8 * 1024 * 1024
+  # logs of completed jobs: ETags and sizes are cached, contents too up to GAS_LOG_CACHE_MAX_BYTES
+  GAS_LOG_CACHE_TTL = 3600
+  GAS_LOG_CACHE_ENTRIES = 256
+  GAS_LOG_CACHE_MAX_BYTES = 128 * 1024
 
   # Stripe API keys
   STRIPE_PUBLIC_KEY = "pk_test_ljmLMTPw34uobzIWme2EXira"
@@ -0,0 +1,24 @@
+import base64
+import json
+
+"""Cursors of the annotations listing
+A page of the listing is read from the submit time index after (or before)
+the key of an annotation; that key travels in the page links as an opaque,
+url safe token.
+"""
+
+"""The cursor of an annotation: its key in the submit time index as a url token
+"""
+def encode_cursor(annotation):
+  key = json.dumps([annotation['job_id'], int(annotation['submit_time'])])
+  return base64.urlsafe_b64encode(key.encode('utf-8')).decode('utf-8').rstrip('=')
+
+"""The index key of a cursor of user_id's listing; raises ValueError for a cursor that was not made by encode_cursor
+"""
+def decode_cursor(cursor, user_id):
+  try:
+    key = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+    job_id, submit_time = json.loads(key.decode('utf-8'))
+    return {'job_id': str(job_id), 'user_id': user_id, 'submit_time': int(submit_time)}
+  except (TypeError, ValueError):
+    raise ValueError("Invalid cursor: " + str(cursor))
@@ -2,9 +2,6 @@
 from flask import redirect, request, session, url_for
 from functools import wraps
 
-from gas import db
-from models import Profile
-
 """Mark a route as requiring authentication
 """
 def authenticated(fn):
@@ -29,8 +26,9 @@ Subscriber must have profile.role = premium_user
 def is_premium(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
-    # Check if user is a subscriber
-    profile = db.session.query(Profile).filter_by(identity_id=session.get('primary_identity')).first()
+    # Check if user is a subscriber (auth imports this module, so import here)
+    from auth import get_profile
+    profile = get_profile(identity_id=session.get('primary_identity'))
     if not profile:
       # Force login
       return redirect(url_for('login', next=request.url))
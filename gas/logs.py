@@ -0,0 +1,87 @@
+import codecs
+
+from botocore.exceptions import ClientError
+
+"""Annotation log files read from S3 by byte range
+A log is shown a part at a time (offset and limit in bytes), read with a ranged
+GET and handed on in chunks as it arrives, so a large log never sits whole in
+the memory of a web server. The log of a completed job does not change: its
+ETag and size are cached, and so is its content if it is small.
+"""
+
+# bytes read from the S3 body at a time
+CHUNK_SIZE = 64 * 1024
+
+
+"""A part of a log: where it is in the log, and its content as an iterator of bytes
+"""
+class LogPart(object):
+  def __init__(self, etag, size, offset, length, chunks):
+    self.etag = etag
+    self.size = size
+    self.offset = offset
+    self.end = offset + length
+    self.chunks = chunks
+
+  """The content as text, decoded chunk by chunk
+  """
+  def text(self):
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    for chunk in self.chunks:
+      text = decoder.decode(chunk)
+      if len(text) > 0:
+        yield text
+    text = decoder.decode(b'', True)
+    if len(text) > 0:
+      yield text
+
+"""Size of the object from the Content-Range of a ranged GET: bytes 0-99/1234
+"""
+def range_size(content_range):
+  return int(content_range.rsplit('/', 1)[1])
+
+"""Reads parts of the logs of one bucket; cache (a cache.TTLCache) keeps what is
+known of immutable logs: (bucket, key) -> {etag, size, data (None if too large)}
+"""
+class LogReader(object):
+  def __init__(self, s3, cache, max_cached_bytes):
+    self.s3 = s3
+    self.cache = cache
+    self.max_cached_bytes = max_cached_bytes
+
+  """ETag of an immutable log read before, or None
+  """
+  def cached_etag(self, bucket, key):
+    cached = self.cache.get((bucket, key))
+    return cached['etag'] if cached is not None else None
+
+  """limit bytes of the log from offset; immutable logs (of completed jobs) are cached
+  """
+  def read(self, bucket, key, offset, limit, immutable=False):
+    cached = self.cache.get((bucket, key)) if immutable else None
+    if cached is not None and cached['data'] is not None:
+      data = cached['data'][offset:offset + limit]
+      return LogPart(cached['etag'], cached['size'], min(offset, cached['size']), len(data), iter([data]))
+    if cached is not None and offset >= cached['size']:
+      return LogPart(cached['etag'], cached['size'], cached['size'], 0, iter([]))
+
+    try:
+      response = self.s3.get_object(Bucket=bucket, Key=key, Range='bytes={0}-{1}'.format(offset, offset + limit - 1))
+    except ClientError as e:
+      # the range starts after the end of the log (or the log is empty)
+      if e.response['Error']['Code'] not in ('InvalidRange', '416'):
+        raise
+      head = self.s3.head_object(Bucket=bucket, Key=key)
+      return LogPart(head['ETag'], head['ContentLength'], head['ContentLength'], 0, iter([]))
+
+    etag = response['ETag']
+    length = response['ContentLength']
+    size = range_size(response['ContentRange']) if 'ContentRange' in response else length
+    body = response['Body']
+    if immutable and size <= self.max_cached_bytes and offset == 0 and length == size:
+      data = body.read()
+      self.cache.set((bucket, key), {'etag': etag, 'size': size, 'data': data})
+      return LogPart(etag, size, offset, len(data), iter([data]))
+    if immutable:
+      self.cache.set((bucket, key), {'etag': etag, 'size': size, 'data': None})
+    return LogPart(etag, size, offset, length, iter(lambda: body.read(CHUNK_SIZE), b''))
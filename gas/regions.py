@@ -0,0 +1,209 @@
+import collections
+import struct
+import zlib
+from threading import Lock
+
+from botocore.exceptions import ClientError
+
+"""Region queries over bgzip compressed annotation results
+The annotator writes results as a bgzip compressed .annot.vcf.gz with a tabix
+index next to it (.annot.vcf.gz.tbi, see anntools/bgzf.py) when the records
+were coordinate sorted, and records its key in the job item. The index gives the
+compressed offsets of the blocks holding the records of a region, so a region
+is read with a few ranged GETs instead of downloading the whole file.
+"""
+
+"""A result file without a tabix index (its records were not coordinate sorted)
+"""
+class NotIndexed(Exception):
+  pass
+
+# tabix linear index windows are 16 kb
+LINEAR_SHIFT = 14
+
+# a bgzip block is at most 64 kb compressed
+MAX_BLOCK_SIZE = 0x10000
+
+# indexes and headers of the most recently queried results; the results of a
+# completed job do not change, so they are fetched once per result file
+CACHE_SIZE = 128
+
+
+"""Bins that may hold records overlapping the 0-based, end exclusive region beg..end
+"""
+def reg2bins(beg, end):
+  end = end - 1
+  bins = [0]
+  for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+    bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+  return bins
+
+"""Decompress a run of bgzip blocks; returns the data and the uncompressed
+offset at which every block starts, keyed by its offset in data
+"""
+def decompress_blocks(data):
+  out = []
+  starts = {}
+  position = 0
+  size = 0
+  while position + 18 <= len(data):
+    block_size = struct.unpack('<H', data[position+16:position+18])[0] + 1
+    if position + block_size > len(data):
+      break
+    starts[position] = size
+    block = zlib.decompress(data[position+18:position+block_size-8], -15)
+    out.append(block)
+    size = size + len(block)
+    position = position + block_size
+  starts[position] = size
+  return b''.join(out), starts
+
+"""A tabix index: chromosome names and, per chromosome, bins with their chunks
+and the linear index
+"""
+class TabixIndex(object):
+  def __init__(self, data):
+    data = decompress_blocks(data)[0]
+    if data[:4] != b'TBI\x01':
+      raise ValueError('Not a tabix index')
+    n_ref, self.format, self.col_seq, self.col_beg, self.col_end, self.meta, self.skip, l_nm = struct.unpack('<8i', data[4:36])
+    self.names = [name.decode('utf-8') for name in data[36:36+l_nm].split(b'\x00')[:n_ref]]
+    position = 36 + l_nm
+    self.bins = []
+    self.linear = []
+    for ref in range(n_ref):
+      n_bin = struct.unpack('<i', data[position:position+4])[0]
+      position = position + 4
+      bins = {}
+      for b in range(n_bin):
+        bin, n_chunk = struct.unpack('<Ii', data[position:position+8])
+        position = position + 8
+        chunks = struct.unpack('<' + str(2 * n_chunk) + 'Q', data[position:position + 16 * n_chunk])
+        bins[bin] = list(zip(chunks[0::2], chunks[1::2]))
+        position = position + 16 * n_chunk
+      n_intv = struct.unpack('<i', data[position:position+4])[0]
+      position = position + 4
+      self.linear.append(struct.unpack('<' + str(n_intv) + 'Q', data[position:position + 8 * n_intv]))
+      position = position + 8 * n_intv
+      self.bins.append(bins)
+
+  """Name of chrom as it appears in the index ('1' and 'chr1' are the same), or None
+  """
+  def name(self, chrom):
+    for candidate in (chrom, chrom[3:] if chrom.lower().startswith('chr') else 'chr' + chrom):
+      if candidate in self.names:
+        return candidate
+    return None
+
+  """Merged (start, end) virtual offsets of the chunks that may hold records of beg..end
+  """
+  def chunks(self, chrom, beg, end):
+    ref = self.names.index(chrom)
+    linear = self.linear[ref]
+    window = beg >> LINEAR_SHIFT
+    min_offset = linear[window] if window < len(linear) else (linear[-1] if len(linear) > 0 else 0)
+    chunks = sorted([chunk for bin in reg2bins(beg, end) for chunk in self.bins[ref].get(bin, []) if chunk[1] > min_offset])
+    merged = []
+    for start, stop in chunks:
+      if len(merged) > 0 and start <= merged[-1][1]:
+        merged[-1][1] = max(merged[-1][1], stop)
+      else:
+        merged.append([start, stop])
+    return merged
+
+
+"""Reads regions of one bgzip compressed VCF in S3
+"""
+class RegionReader(object):
+  _cache = collections.OrderedDict()
+  _lock = Lock()
+
+  def __init__(self, s3, bucket, key, index_key=None):
+    self.s3 = s3
+    self.bucket = bucket
+    self.key = key
+    self.index_key = index_key or key + '.tbi'
+
+  def get_range(self, start, end):
+    response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range='bytes={0}-{1}'.format(start, end))
+    return response['Body'].read()
+
+  """A value of this result file from the cache, or load() it and cache it
+  """
+  def cached(self, name, load):
+    cache_key = (self.bucket, self.key, name)
+    with RegionReader._lock:
+      if cache_key in RegionReader._cache:
+        RegionReader._cache.move_to_end(cache_key)
+        return RegionReader._cache[cache_key]
+    value = load()
+    with RegionReader._lock:
+      RegionReader._cache[cache_key] = value
+      while len(RegionReader._cache) > CACHE_SIZE:
+        RegionReader._cache.popitem(last=False)
+    return value
+
+  """The parsed index; raises NotIndexed if the result file has none
+  """
+  def index(self):
+    return self.cached('index', self.read_index)
+
+  def read_index(self):
+    try:
+      data = self.s3.get_object(Bucket=self.bucket, Key=self.index_key)['Body'].read()
+    except ClientError as e:
+      if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+        raise
+      raise NotIndexed(self.key)
+    return TabixIndex(data)
+
+  """Uncompressed data between two virtual offsets
+  """
+  def read(self, vstart, vend):
+    cstart = vstart >> 16
+    cend = vend >> 16
+    data, starts = decompress_blocks(self.get_range(cstart, cend + MAX_BLOCK_SIZE - 1))
+    stop = starts[cend - cstart] + (vend & 0xffff)
+    return data[vstart & 0xffff:stop]
+
+  """Header lines of the file (the ## meta lines and the #CHROM line)
+  """
+  def header(self):
+    return self.cached('header', self.read_header)
+
+  def read_header(self):
+    length = 4 * MAX_BLOCK_SIZE
+    while True:
+      raw = self.get_range(0, length - 1)
+      # the last line may be cut at the end of the blocks read
+      lines = decompress_blocks(raw)[0].decode('utf-8', 'replace').split('\n')
+      complete = lines if len(raw) < length else lines[:-1]
+      for n in range(len(complete)):
+        if not complete[n].startswith('#'):
+          return complete[:n]
+      if len(raw) < length:
+        return [line for line in complete if line.startswith('#')]
+      length = length * 4
+
+  """VCF lines overlapping chrom:start-end (1-based, inclusive), at most limit of them
+  Returns the lines and whether more were left out.
+  """
+  def query(self, chrom, start, end, limit=None):
+    index = self.index()
+    name = index.name(chrom)
+    if name is None:
+      return [], False
+    beg = max(start - 1, 0)
+    lines = []
+    for vstart, vend in index.chunks(name, beg, end):
+      for line in self.read(vstart, vend).decode('utf-8').split('\n'):
+        fields = line.split('\t', 5)
+        if len(fields) < 5 or line.startswith('#') or fields[0] != name:
+          continue
+        record_beg = int(fields[1]) - 1
+        record_end = record_beg + max(len(fields[3]), 1)
+        if record_beg < end and record_end > beg:
+          if limit is not None and len(lines) >= limit:
+            return lines, True
+          lines.append(line)
+    return lines, False
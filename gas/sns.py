@@ -0,0 +1,94 @@
+import base64
+import requests
+
+try:
+  from urllib.parse import urlparse
+except:
+  from urlparse import urlparse
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from cache import TTLCache
+
+"""Verification of the messages SNS posts to the HTTPS endpoints of the app
+Anyone can post to an endpoint, so a message is only acted on once its signature
+checks out against the certificate of SNS in the region of the topic.
+https://docs.aws.amazon.com/sns/latest/dg/sns-verify-signature-of-message.html
+"""
+
+# the fields signed for each type of message, in the order they are signed;
+# Subject is signed only when the notification has one
+SIGNED_FIELDS = {
+  'Notification': ('Message', 'MessageId', 'Subject', 'Timestamp', 'TopicArn', 'Type'),
+  'SubscriptionConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+  'UnsubscribeConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+}
+
+# SignatureVersion -> hash of the string to sign
+SIGNATURE_HASHES = {'1': hashes.SHA1, '2': hashes.SHA256}
+
+"""The string SNS signed for a message, or None if a signed field is missing
+"""
+def string_to_sign(message):
+  fields = SIGNED_FIELDS.get(message.get('Type'))
+  if fields is None:
+    return None
+  signed = ''
+  for field in fields:
+    if field not in message:
+      if field == 'Subject':
+        continue
+      return None
+    signed += field + '\n' + str(message[field]) + '\n'
+  return signed
+
+"""Whether url is a certificate of SNS in region: https from sns.<region>.amazonaws.com only
+"""
+def is_signing_cert_url(url, region):
+  url = urlparse(url)
+  return url.scheme == 'https' and url.hostname == 'sns.' + region + '.amazonaws.com' and url.path.endswith('.pem')
+
+"""The region of an SNS topic ARN (arn:aws:sns:<region>:<account>:<name>)
+"""
+def topic_region(topic_arn):
+  return topic_arn.split(':')[3]
+
+"""Checks the signatures of the messages of one region
+The public keys of the signing certificates are cached for ttl seconds; SNS
+signs with the same certificate until it is rotated.
+"""
+class MessageVerifier(object):
+  def __init__(self, region, ttl):
+    self.region = region
+    self.keys = TTLCache(ttl, max_entries=16)
+
+  """True if message was signed by SNS, False otherwise (including when it cannot be checked)
+  """
+  def verify(self, message):
+    signed = string_to_sign(message)
+    signature_hash = SIGNATURE_HASHES.get(str(message.get('SignatureVersion')))
+    url = message.get('SigningCertURL', '')
+    if signed is None or signature_hash is None or not is_signing_cert_url(url, self.region):
+      return False
+    try:
+      signature = base64.b64decode(message['Signature'])
+      self.public_key(url).verify(signature, signed.encode('utf-8'), padding.PKCS1v15(), signature_hash())
+      return True
+    except InvalidSignature:
+      return False
+    except Exception as e:
+      print("There was an error checking the signature of an SNS message: \n" + str(e))
+      return False
+
+  def public_key(self, url):
+    key = self.keys.get(url)
+    if key is None:
+      response = requests.get(url, timeout=10)
+      response.raise_for_status()
+      key = x509.load_pem_x509_certificate(response.content, default_backend()).public_key()
+      self.keys.set(url, key)
+    return key
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import queue
+from decimal import Decimal
+from threading import Lock
+
+from cache import TTLCache
+
+"""Job states served to the job pages while the jobs run
+A job page asks /annotations/<job_id>/status for the state of its job (or
+listens to /annotations/<job_id>/status/stream); the states are cached by the
+process so that many pages polling the same jobs cost one DynamoDB read per job
+every few seconds. Notifications of the job results topic update a state right
+away and are pushed to the streams listening to the job.
+"""
+
+# the fields of a job that the status endpoint returns; job_progress is written by
+# the annotator while the job runs (stage, records, percent, eta_seconds...)
+STATUS_FIELDS = ('job_id', 'user_id', 'job_status', 'result_file_location', 'job_progress')
+
+"""The status fields of an annotation item
+"""
+def job_state(item):
+  return dict([(field, plain(item.get(field))) for field in STATUS_FIELDS])
+
+"""A DynamoDB value with its numbers (Decimal) turned into ints, so it can be sent as JSON
+"""
+def plain(value):
+  if isinstance(value, Decimal):
+    return int(value)
+  if isinstance(value, dict):
+    return dict([(name, plain(item)) for name, item in value.items()])
+  return value
+
+"""Entity tag of a state: changes whenever the state does
+"""
+def state_etag(state):
+  return hashlib.md5(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+"""Cached job states and the streams listening to them
+"""
+class StatusFeed(object):
+  def __init__(self, ttl):
+    self.states = TTLCache(ttl, max_entries=10000)
+    self.listeners = {}   # job_id -> queues of the streams of the job
+    self.lock = Lock()
+
+  """The state of job_id: cached, or load()ed (None for no such job) and cached
+  """
+  def get(self, job_id, load):
+    state = self.states.get(job_id)
+    if state is None:
+      state = load()
+      if state is not None:
+        self.states.set(job_id, state)
+    return state
+
+  """Drop the cached state of a job, to read it again
+  """
+  def forget(self, job_id):
+    self.states.delete(job_id)
+
+  """Store the new state of a job and push it to its streams if it changed
+  """
+  def update(self, state):
+    previous = self.states.get(state['job_id'])
+    self.states.set(state['job_id'], state)
+    if previous == state:
+      return
+    with self.lock:
+      listeners = list(self.listeners.get(state['job_id'], ()))
+    for listener in listeners:
+      listener.put(state)
+
+  """A queue receiving the new states of job_id, until unlisten()
+  """
+  def listen(self, job_id):
+    listener = queue.Queue()
+    with self.lock:
+      self.listeners.setdefault(job_id, []).append(listener)
+    return listener
+
+  def unlisten(self, job_id, listener):
+    with self.lock:
+      listeners = self.listeners.get(job_id, [])
+      if listener in listeners:
+        listeners.remove(listener)
+      if len(listeners) == 0:
+        self.listeners.pop(job_id, None)
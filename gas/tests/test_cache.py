@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cache import TTLCache
+
+"""The in-process cache of the web server (cache.py)
+"""
+class TTLCacheTest(unittest.TestCase):
+  def test_get_set_delete(self):
+    cache = TTLCache(60)
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(cache.get('a', 'default'), 'default')
+    cache.set('a', 1)
+    self.assertEqual(cache.get('a'), 1)
+    cache.set('a', 2)
+    self.assertEqual(cache.get('a'), 2)
+    cache.delete('a')
+    self.assertIsNone(cache.get('a'))
+
+  def test_expiry(self):
+    cache = TTLCache(0.05)
+    cache.set('a', 1, group='user')
+    time.sleep(0.1)
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(cache.values('user'), [])
+
+  def test_least_recently_used_dropped(self):
+    cache = TTLCache(60, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    self.assertEqual(cache.get('a'), 1)
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(cache.get('c'), 3)
+
+  def test_groups(self):
+    cache = TTLCache(60)
+    cache.set(('u1', 1), 'p1', group='u1')
+    cache.set(('u1', 2), 'p2', group='u1')
+    cache.set(('u2', 1), 'q1', group='u2')
+    self.assertEqual(sorted(cache.values('u1')), ['p1', 'p2'])
+    cache.invalidate('u1')
+    self.assertEqual(cache.values('u1'), [])
+    self.assertIsNone(cache.get(('u1', 1)))
+    self.assertEqual(cache.get(('u2', 1)), 'q1')
+
+  def test_dropped_entries_leave_their_group(self):
+    cache = TTLCache(60, max_entries=1)
+    cache.set('a', 1, group='g')
+    cache.set('b', 2, group='g')
+    self.assertEqual(cache.values('g'), [2])
+    cache.set('b', 3)
+    self.assertEqual(cache.values('g'), [])
+
+if __name__ == '__main__':
+  unittest.main()
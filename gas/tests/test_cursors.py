@@ -0,0 +1,33 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cursors import encode_cursor, decode_cursor
+
+"""Cursors of the annotations listing (cursors.py)
+"""
+class CursorTest(unittest.TestCase):
+  def test_round_trip(self):
+    for job_id, submit_time in [('0b5e7f28-5c1a-4b6e-9d0e-4f2f5a3c1b2d', 1528917283), ('j', 0), ('é/?&=', 10 ** 12)]:
+      cursor = encode_cursor({'job_id': job_id, 'submit_time': submit_time})
+      self.assertEqual(decode_cursor(cursor, 'user'), {'job_id': job_id, 'user_id': 'user', 'submit_time': submit_time})
+
+  def test_url_safe(self):
+    cursor = encode_cursor({'job_id': '>>>???~~~', 'submit_time': 1})
+    self.assertFalse(set(cursor) - set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'))
+
+  def test_submit_time_from_dynamodb(self):
+    # DynamoDB returns numbers as Decimal
+    from decimal import Decimal
+    cursor = encode_cursor({'job_id': 'j', 'submit_time': Decimal('1528917283')})
+    self.assertEqual(decode_cursor(cursor, 'user')['submit_time'], 1528917283)
+
+  def test_invalid(self):
+    for cursor in ['', 'not a cursor', 'e30', encode_cursor({'job_id': 'j', 'submit_time': 1})[:-3], 'WyJqIiwgIngiXQ']:
+      with self.assertRaises(ValueError):
+        decode_cursor(cursor, 'user')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -75,11 +75,11 @@ get_portal_tokens.access_tokens = None
 
 """Send email via Amazon SES
 """
-import boto3
+from clients import get_client
 def send_email_ses(recipients=None,
   sender=None, subject=None, body=None):
 
-  ses = boto3.client('ses', region_name=app.config['AWS_REGION_NAME'])
+  ses = get_client('ses')
 
   response = ses.send_email(
     Destination = {'ToAddresses': recipients},
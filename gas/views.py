@@ -4,22 +4,45 @@
 import uuid
 import time
 import json
+import queue
 import requests
 from datetime import datetime
 
-import boto3
-from botocore.client import Config
+try:
+  from urllib.parse import urlparse
+except:
+  from urlparse import urlparse
+
 from boto3.dynamodb.conditions import Key
 
-from flask import (abort, flash, redirect, render_template,
-  request, session, url_for)
+from flask import (abort, flash, jsonify, redirect, render_template,
+  request, Response, session, stream_with_context, url_for)
 
 from gas import app, db
 from decorators import authenticated, is_premium
 from auth import get_profile, update_profile
+from regions import NotIndexed, RegionReader
+from logs import LogReader
+from clients import get_client, get_table
+from cache import TTLCache
+from cursors import encode_cursor, decode_cursor
+from status import StatusFeed, job_state, state_etag
+from sns import MessageVerifier, topic_region
 
 import stripe
 
+# pages of the annotations listing: (user_id, after, before) -> page, grouped by user
+annotations_cache = TTLCache(app.config['GAS_ANNOTATIONS_CACHE_TTL'])
+
+# states of the jobs shown by the job pages, and the status streams listening to them
+job_status_feed = StatusFeed(app.config['GAS_JOB_STATUS_CACHE_TTL'])
+
+# ETags, sizes and (small) contents of the logs of completed jobs: (bucket, key) -> log
+log_cache = TTLCache(app.config['GAS_LOG_CACHE_TTL'], max_entries=app.config['GAS_LOG_CACHE_ENTRIES'])
+
+# signatures of the messages posted by the job results topic
+job_results_verifier = MessageVerifier(topic_region(app.config['AWS_SNS_JOB_COMPLETE_TOPIC']), app.config['GAS_SNS_CERTIFICATE_CACHE_TTL'])
+
 ###############################
 ###       HOME & LOGIN      ###
 ###############################
@@ -48,10 +71,7 @@ def login():
 def annotate():
   # connect to s3 - use v4 signature
   try:
-    s3 = boto3.client('s3',
-      region_name=app.config['AWS_REGION_NAME'],
-      config=Config(signature_version='s3v4')
-    )
+    s3 = get_client('s3')
   except Exception as e:
     print("There was error connecting to S3: \n" + str(e))
     return abort(500)
@@ -148,10 +168,7 @@ def create_annotation_job_request():
 
   # connect to DynamoDB
   try:
-    dynamodb = boto3.resource('dynamodb',
-      region_name=app.config['AWS_REGION_NAME']
-    )
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    table = get_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
   except Exception as e:
     print("There was error connecting to dynamodb: \n" + str(e))
     return abort(500)
@@ -163,9 +180,13 @@ def create_annotation_job_request():
     print("There was error putting the item in dynamodb: \n" + str(e))
     return abort(500)
 
+  # the new job goes on top of the user's listing
+  annotations_cache.invalidate(user_id)
+  job_status_feed.update(job_state(data))
+
   # connect to SNS
   try:
-    sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+    sns = get_client('sns')
   except Exception as e:
     print("There was error connecting to SNS: \n" + str(e))
     return abort(500)
@@ -185,36 +206,45 @@ def create_annotation_job_request():
   # confirm success to user
   return render_template('annotate_confirm.html', job_id=job_id)
 
-# List all annotations for the user
+# List the annotations of the user, newest first, one page at a time
+# ?after=<cursor> shows the page of older jobs, ?before=<cursor> the page of newer ones
 @app.route('/annotations', methods=['GET'])
 @authenticated
 def annotations_list():
   # get user id from session
   user_id = session['primary_identity']
+  after = request.args.get('after')
+  before = request.args.get('before')
+
+  # pages are cached for a short while; new jobs and status changes seen by
+  # this server drop the cached pages of the user
+  cache_key = (user_id, after, before)
+  page = annotations_cache.get(cache_key)
+  if page is None:
+    # connect to DynamoDB
+    try:
+      table = get_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    except Exception as e:
+      print("There was error connecting to dynamodb: \n" + str(e))
+      return abort(500)
 
-  # connect to DynamoDB
-  try:
-    dynamodb = boto3.resource('dynamodb',
-      region_name=app.config['AWS_REGION_NAME']
-    )
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-  except Exception as e:
-    print("There was error connecting to dynamodb: \n" + str(e))
-    return abort(500)
-
-  # Get list of annotations to display
-  # https://stackoverflow.com/questions/35758924/how-do-we-query-on-a-secondary-index-of-dynamodb-using-boto3
-  try:
-    response = table.query(
-      IndexName='user_id_index',
-      KeyConditionExpression=Key('user_id').eq(user_id)
-    )
-    annotations = response['Items']
-  except Exception as e:
-    print("There was error querying dynamodb: \n" + str(e))
-    return abort(500)
+    # Get the page of annotations to display
+    # https://stackoverflow.com/questions/35758924/how-do-we-query-on-a-secondary-index-of-dynamodb-using-boto3
+    try:
+      page = query_annotations_page(table, user_id, after=after, before=before)
+    except ValueError:
+      return abort(400)
+    except Exception as e:
+      print("There was error querying dynamodb: \n" + str(e))
+      return abort(500)
+    annotations_cache.set(cache_key, page, group=user_id)
 
-  return render_template('annotations.html', annotations=annotations, time=time)
+  return render_template('annotations.html',
+    annotations=page['annotations'],
+    next_cursor=page['next'],
+    prev_cursor=page['prev'],
+    time=time
+  )
 
 # Display details of a specific annotation job
 @app.route('/annotations/<job_id>', methods=['GET'])
@@ -227,8 +257,7 @@ def annotation_details(job_id):
 
   # connect to DynamoDB
   try:
-    dynamodb = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    table = get_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
   except Exception as e:
     print("There was error connecting to dynamodb: \n" + str(e))
     return abort(500)
@@ -249,13 +278,12 @@ def annotation_details(job_id):
   annotation_user_id = annotation_details['user_id']
   if annotation_user_id != user_id:
     return "You are not authorized to view this job."
+  refresh_annotations_cache(user_id, annotation_details)
+  job_status_feed.update(job_state(annotation_details))
 
   # connect to s3 - use v4 signature
   try:
-    s3 = boto3.client('s3',
-      region_name=app.config['AWS_REGION_NAME'],
-      config=Config(signature_version='s3v4')
-    )
+    s3 = get_client('s3')
   except Exception as e:
     print("There was error connecting to S3: \n" + str(e))
     return abort(500)
@@ -299,22 +327,114 @@ def annotation_details(job_id):
                           annotation_details=annotation_details,
                           time=time,
                           input_file_presigned_download_url=input_file_presigned_download_url,
-                          result_file_presigned_download_url=result_file_presigned_download_url
+                          result_file_presigned_download_url=result_file_presigned_download_url,
+                          status_stream=app.config['GAS_JOB_STATUS_STREAM']
+  )
+
+# Return the status of a job as JSON: job_id, job_status, result_file_location and,
+# while it runs, job_progress (stage, records annotated, percent, eta_seconds)
+# pages poll it with If-None-Match and get 304 Not Modified while the status is unchanged
+@app.route('/annotations/<job_id>/status', methods=['GET'])
+@authenticated
+def annotation_status(job_id):
+  # get user id from session
+  user_id = session['primary_identity']
+
+  # get the state of the job, cached for a few seconds
+  try:
+    state = get_job_state(job_id)
+  except Exception as e:
+    print("There was error getting item from dynamodb: \n" + str(e))
+    return abort(500)
+
+  # confirm that the requested annotation belongs to this user
+  if state is None:
+    return json_error("No such job.", 404)
+  if state['user_id'] != user_id:
+    return json_error("You are not authorized to view this job.", 403)
+
+  response = jsonify(public_job_state(state))
+  response.set_etag(state_etag(state))
+  response.headers['Cache-Control'] = 'no-cache'
+  return response.make_conditional(request)
+
+# Push the status of a job as server-sent events (when GAS_JOB_STATUS_STREAM is set):
+# a 'status' event with the current status, then one whenever it changes, until
+# GAS_JOB_STATUS_STREAM_TIMEOUT; the browser then reconnects
+@app.route('/annotations/<job_id>/status/stream', methods=['GET'])
+@authenticated
+def annotation_status_stream(job_id):
+  if not app.config['GAS_JOB_STATUS_STREAM']:
+    return abort(404)
+
+  # get user id from session
+  user_id = session['primary_identity']
+
+  # get the state of the job, cached for a few seconds
+  try:
+    state = get_job_state(job_id)
+  except Exception as e:
+    print("There was error getting item from dynamodb: \n" + str(e))
+    return abort(500)
+
+  # confirm that the requested annotation belongs to this user
+  if state is None:
+    return json_error("No such job.", 404)
+  if state['user_id'] != user_id:
+    return json_error("You are not authorized to view this job.", 403)
+
+  listener = job_status_feed.listen(job_id)
+  def events(state):
+    deadline = time.time() + app.config['GAS_JOB_STATUS_STREAM_TIMEOUT']
+    try:
+      yield 'retry: 5000\n' + status_event(state)
+      while time.time() < deadline:
+        try:
+          new_state = listener.get(timeout=app.config['GAS_JOB_STATUS_CACHE_TTL'])
+        except queue.Empty:
+          # changes made without a notification to this server (the job started,
+          # was archived...) are seen once the cached state expires
+          new_state = get_job_state(job_id)
+          if new_state is None:
+            return
+        if new_state != state:
+          state = new_state
+          yield status_event(state)
+        else:
+          # keep the connection open through proxies
+          yield ': keep-alive\n\n'
+    except Exception as e:
+      print("There was error streaming the status of job " + job_id + ": \n" + str(e))
+    finally:
+      job_status_feed.unlisten(job_id, listener)
+
+  return Response(stream_with_context(events(state)),
+    mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
   )
 
-# Display the log file for an annotation job
+# Display the log file for an annotation job, GAS_LOG_PAGE_BYTES at a time
+# ?offset=&limit= select the bytes shown; format=text returns them as plain text
 @app.route('/annotations/<job_id>/log', methods=['GET'])
 @authenticated
 def annotation_log(job_id):
   # get user id from session
   user_id = session['primary_identity']
 
+  # check the range
+  try:
+    offset = int(request.args.get('offset', 0))
+    limit = int(request.args.get('limit', app.config['GAS_LOG_PAGE_BYTES']))
+  except ValueError:
+    return abort(400)
+  if offset < 0 or limit < 1:
+    return abort(400)
+  limit = min(limit, app.config['GAS_LOG_MAX_PAGE_BYTES'])
+  output_format = request.args.get('format', 'html')
+
   # connect to DynamoDB
   try:
-    dynamodb = boto3.resource('dynamodb',
-      region_name=app.config['AWS_REGION_NAME']
-    )
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    table = get_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
   except Exception as e:
     print("There was error connecting to dynamodb: \n" + str(e))
     return abort(500)
@@ -334,29 +454,174 @@ def annotation_log(job_id):
   log_file_user_id = annotation_details['user_id']
   if log_file_user_id != user_id:
     return "You are not authorized to view the log file for this job."
+  refresh_annotations_cache(user_id, annotation_details)
 
   # connect to s3 - use v4 signature
   try:
-    s3 = boto3.resource('s3',
-      region_name=app.config['AWS_REGION_NAME'],
-      config=Config(signature_version='s3v4')
-    )
+    s3 = get_client('s3')
   except Exception as e:
     print("There was error connecting to S3: \n" + str(e))
     return abort(500)
 
-  # get the log file
-  # https://stackoverflow.com/questions/31976273/open-s3-object-as-a-string-with-boto3
+  # the log of a completed job does not change: answer 304 Not Modified to a
+  # browser that has this part already, without going to S3
   log_file_bucket = annotation_details['s3_results_bucket']
   log_file_key = annotation_details['s3_key_log_file']
-  raw_log_file = s3.Object(log_file_bucket, log_file_key)
-  log_file = raw_log_file.get()['Body'].read().decode('utf-8')
+  immutable = annotation_details['job_status'] == 'COMPLETE'
+  reader = LogReader(s3, log_cache, app.config['GAS_LOG_CACHE_MAX_BYTES'])
+  if immutable:
+    log_etag = reader.cached_etag(log_file_bucket, log_file_key)
+    if log_etag is not None and request.if_none_match.contains(log_part_etag(log_etag, offset, limit, output_format)):
+      return Response(status=304, headers={'ETag': '"' + log_part_etag(log_etag, offset, limit, output_format) + '"'})
+
+  # get the part of the log file with a ranged read; it is sent on as it arrives
+  try:
+    part = reader.read(log_file_bucket, log_file_key, offset, limit, immutable=immutable)
+  except Exception as e:
+    print("There was error reading the log file from S3: \n" + str(e))
+    return abort(500)
+
+  headers = {'Cache-Control': 'private, no-cache'}
+  if immutable:
+    headers['ETag'] = '"' + log_part_etag(part.etag, offset, limit, output_format) + '"'
+
+  if output_format == 'text':
+    return Response(stream_with_context(part.text()), mimetype='text/plain', headers=headers)
 
-  return render_template('annotation_log_file.html',
+  return Response(stream_with_context(stream_template('annotation_log_file.html',
     annotation_details=annotation_details,
     time=time,
-    log_file=log_file
-  )
+    log_file=part.text(),
+    log_part=part,
+    limit=limit
+  )), headers=headers)
+
+# Return the annotated records of a region of a completed job: /annotations/<job_id>/region?chrom=1&start=100&end=200
+# start and end are 1-based and inclusive; format=vcf returns the header and records as VCF, otherwise JSON
+@app.route('/annotations/<job_id>/region', methods=['GET'])
+@authenticated
+def annotation_region(job_id):
+  # get user id from session
+  user_id = session['primary_identity']
+
+  # check the region
+  chrom = request.args.get('chrom')
+  try:
+    start = int(request.args.get('start', 1))
+    end = int(request.args.get('end'))
+  except (TypeError, ValueError):
+    return json_error("start and end must be integers.", 400)
+  if not chrom or start < 1 or end < start:
+    return json_error("A region needs a chrom and 1 <= start <= end.", 400)
+  output_format = request.args.get('format', 'json')
+
+  # connect to DynamoDB
+  try:
+    table = get_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  except Exception as e:
+    print("There was error connecting to dynamodb: \n" + str(e))
+    return abort(500)
+
+  # Get the annotation details
+  try:
+    response = table.get_item(
+      Key={ 'job_id': job_id
+      }
+    )
+    annotation_details = response.get('Item')
+  except Exception as e:
+    print("There was error getting item from dynamodb: \n" + str(e))
+    return abort(500)
+
+  # confirm that the requested annotation belongs to this user and can be read
+  if annotation_details is None:
+    return json_error("No such job.", 404)
+  if annotation_details['user_id'] != user_id:
+    return json_error("You are not authorized to view this job.", 403)
+  if annotation_details['job_status'] != 'COMPLETE' or annotation_details.get('result_file_location') != 'S3':
+    return json_error("The results of this job are not available in S3.", 409)
+  result_file_key = annotation_details['s3_key_result_file']
+  if not result_file_key.endswith('.gz'):
+    return json_error("The results of this job were not indexed; download the whole file instead.", 409)
+
+  # connect to s3
+  try:
+    s3 = get_client('s3')
+  except Exception as e:
+    print("There was error connecting to S3: \n" + str(e))
+    return abort(500)
+
+  # read the records of the region with ranged reads of the blocks the index points to
+  # (jobs completed before the index key was recorded have it next to the result file)
+  try:
+    reader = RegionReader(s3, annotation_details['s3_results_bucket'], result_file_key, annotation_details.get('s3_key_index_file'))
+    records, truncated = reader.query(chrom, start, end, limit=app.config['GAS_REGION_MAX_RECORDS'])
+    header = reader.header()
+  except NotIndexed:
+    return json_error("The results of this job were not indexed; download the whole file instead.", 409)
+  except Exception as e:
+    print("There was error reading the region from S3: \n" + str(e))
+    return abort(500)
+
+  if output_format == 'vcf':
+    return Response('\n'.join(header + records) + '\n', mimetype='text/plain')
+
+  columns = header[-1].lstrip('#').split('\t') if len(header) > 0 else []
+  return jsonify({
+    'job_id': job_id,
+    'chrom': chrom,
+    'start': start,
+    'end': end,
+    'truncated': truncated,
+    'records': [vcf_record(columns, record) for record in records]
+  })
+
+###############################
+###      NOTIFICATIONS      ###
+###############################
+
+# HTTPS endpoint of the job results topic (subscribe it to AWS_SNS_JOB_COMPLETE_TOPIC)
+# only messages signed by SNS for the topic are acted on (sns.py); a notification
+# only names the job that completed; its state is read again from DynamoDB, then
+# pushed to the status streams of the job and the listing is refreshed
+@app.route('/notifications/job_results', methods=['POST'])
+def job_results_notification():
+  # SNS posts its messages as JSON with a text/plain content type
+  try:
+    message = json.loads(request.get_data().decode('utf-8'))
+  except ValueError:
+    return abort(400)
+  if not isinstance(message, dict) or message.get('TopicArn') != app.config['AWS_SNS_JOB_COMPLETE_TOPIC']:
+    return abort(403)
+  if not job_results_verifier.verify(message):
+    return abort(403)
+
+  # confirm the subscription by visiting the url sent by SNS
+  # https://docs.aws.amazon.com/sns/latest/dg/sns-http-https-endpoint-as-subscriber.html
+  message_type = message['Type']
+  if message_type == 'SubscriptionConfirmation':
+    subscribe_url = urlparse(message.get('SubscribeURL', ''))
+    if subscribe_url.scheme != 'https' or not (subscribe_url.hostname or '').endswith('.amazonaws.com'):
+      return abort(400)
+    try:
+      requests.get(message['SubscribeURL'], timeout=10)
+    except Exception as e:
+      print("There was error confirming the SNS subscription: \n" + str(e))
+      return abort(500)
+    return '', 200
+
+  if message_type == 'Notification':
+    try:
+      job_id = json.loads(message['Message'])
+      job_status_feed.forget(job_id)
+      state = get_job_state(job_id)
+    except Exception as e:
+      print("There was error getting the job of a notification: \n" + str(e))
+      return abort(500)
+    if state is not None:
+      job_status_feed.update(state)
+      refresh_annotations_cache(state['user_id'], state)
+  return '', 200
 
 ###############################
 ###       SUBSCRIPTION      ###
@@ -403,7 +668,7 @@ def subscribe():
 
     # connect to SNS
     try:
-      sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+      sns = get_client('sns')
     except Exception as e:
       print("There was error connecting to SNS: \n" + str(e))
       return abort(500)
@@ -491,3 +756,102 @@ def extract_job_id(key):
 def extract_prefix(key):
   cnet_user_job_id = key[:key.rfind('/')+1]
   return cnet_user_job_id
+
+# helper function to get one page of the annotations of a user, newest first
+# after/before are the cursors of the last/first annotation of the page next to
+# the one wanted; returns the annotations and the cursors of the pages around it
+def query_annotations_page(table, user_id, after=None, before=None):
+  page_size = app.config['GAS_ANNOTATIONS_PAGE_SIZE']
+  params = {
+    'IndexName': app.config['AWS_DYNAMODB_USER_SUBMIT_TIME_INDEX'],
+    'KeyConditionExpression': Key('user_id').eq(user_id),
+    # one more than a page tells whether there is another page
+    'Limit': page_size + 1,
+    # newest first; oldest first when going back up to newer jobs
+    'ScanIndexForward': before is not None
+  }
+  cursor = before or after
+  if cursor is not None:
+    params['ExclusiveStartKey'] = decode_cursor(cursor, user_id)
+  annotations = table.query(**params)['Items']
+  more = len(annotations) > page_size
+  annotations = annotations[:page_size]
+
+  if before is not None:
+    annotations.reverse()
+    newer = more
+    older = len(annotations) > 0
+  else:
+    newer = cursor is not None and len(annotations) > 0
+    older = more
+  return {
+    'annotations': annotations,
+    'prev': encode_cursor(annotations[0]) if newer else None,
+    'next': encode_cursor(annotations[-1]) if older else None
+  }
+
+# helper function to drop the cached listing pages of a user when they show a
+# job with another status than it has now (it completed or was archived since)
+def refresh_annotations_cache(user_id, annotation):
+  for page in annotations_cache.values(user_id):
+    for listed in page['annotations']:
+      if listed['job_id'] == annotation['job_id'] and listed['job_status'] != annotation['job_status']:
+        annotations_cache.invalidate(user_id)
+        return
+
+# helper function to return an error of the JSON API
+def json_error(message, status):
+  return jsonify({'error': message}), status
+
+# helper function to get the status fields of a job from the cached job states,
+# or from DynamoDB when they are not cached; None if there is no such job
+def get_job_state(job_id):
+  def load():
+    table = get_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.get_item(
+      Key={ 'job_id': job_id
+      },
+      ProjectionExpression='job_id, user_id, job_status, result_file_location, job_progress'
+    )
+    item = response.get('Item')
+    return job_state(item) if item is not None else None
+  return job_status_feed.get(job_id, load)
+
+# helper function to render a template as it is generated, e.g. while a log is read
+# http://flask.pocoo.org/docs/0.12/patterns/streaming/
+def stream_template(template_name, **context):
+  app.update_template_context(context)
+  template = app.jinja_env.get_template(template_name)
+  stream = template.stream(context)
+  stream.enable_buffering(5)
+  return stream
+
+# helper function to get the entity tag of a part of a log file
+def log_part_etag(log_etag, offset, limit, output_format):
+  return log_etag.strip('"') + '-' + str(offset) + '-' + str(limit) + '-' + output_format
+
+# helper function to leave the user id out of a job state shown to the user
+def public_job_state(state):
+  return dict([(field, value) for field, value in state.items() if field != 'user_id'])
+
+# helper function to format a job state as a server-sent 'status' event
+def status_event(state):
+  return 'event: status\ndata: ' + json.dumps(public_job_state(state)) + '\n\n'
+
+# helper function to turn a VCF line into a dict keyed by the header columns,
+# with POS as an integer and INFO (where the annotations are) split into its fields
+def vcf_record(columns, line):
+  fields = line.split('\t')
+  record = dict(zip(columns, fields))
+  if 'POS' in record:
+    record['POS'] = int(record['POS'])
+  if 'INFO' in record:
+    info = {}
+    for item in record['INFO'].split(';'):
+      if '=' in item:
+        name, value = item.split('=', 1)
+        info[name] = value
+      elif len(item) > 0:
+        info[item] = True
+    record['INFO'] = info
+  return record
@@ -1,6 +1,7 @@
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
 import botocore
+from concurrent.futures import ThreadPoolExecutor
 import json
 import time
 
@@ -26,6 +27,81 @@ def is_free_user(annotation_details):
   user_role = annotation_details['user_role']
   return user_role == 'free_user'
 
+# archive the result file of the job of a message (if it is time to)
+def archive_message(message):
+  # get job id
+  job_id = json.loads(json.loads(message.body)['Message'])
+  print("Job id: " + str(job_id))
+
+  # connect to the database
+  table_name = aws.DYNAMODB_ANNOTATIONS_TABLE
+  table = aws.get_table(table_name)
+
+  # get annotation details
+  annotation_details = aws.get_annotation_details(table, job_id)
+
+  # make sure user role is still free
+  if not is_free_user(annotation_details):
+    print("User role is no longer free.")
+    # Delete the message from the queue (no need to archive)
+    print ("Deleting message...")
+    message.delete()
+
+  # check if ready to be archived
+  elif not is_time_to_archive(annotation_details):
+    print("Not enough time has elapsed to archive this file.")
+
+  # an empty result file cannot be archived (Glacier archives hold at least one byte):
+  # it is left in S3, costing nothing, and the message is deleted
+  elif aws.get_s3_file_size(aws.get_s3(), annotation_details['s3_results_bucket'], annotation_details['s3_key_result_file']) == 0:
+    print("Result file is empty, nothing to archive.")
+    print ("Deleting message...")
+    message.delete()
+
+  else:
+    # claim the archive job
+    if aws.claim_archive_job(table, job_id):
+      print("Archiving result file...")
+
+      # get s3
+      s3 = aws.get_s3()
+
+      # get Glacier vault
+      glacier_resource = aws.get_glacier_resource()
+      vault = aws.get_vault(glacier_resource)
+
+      # archive the result file (streamed from S3 a part at a time)
+      archive_id = aws.archive_result_file(s3, vault, annotation_details)
+      if archive_id is None:
+        # give the job back: the file is still in S3, the message will be received again
+        aws.set_result_file_location(table, job_id, 'S3')
+        return
+      print("Result file archived")
+
+      # update archive status
+      result_file_location = 'Glacier'
+      aws.set_result_file_location(table, job_id, result_file_location)
+      aws.set_archive_id(table, job_id, archive_id)
+      print("Archive status updated in annotations database.")
+
+      # delete s3 result file
+      bucket = annotation_details['s3_results_bucket']
+      key = annotation_details['s3_key_result_file']
+      aws.delete_s3_file(s3, bucket, key)
+      print("S3 result file deleted")
+
+      # Delete the message from the queue (only if processed)
+      print ("Deleting message...")
+      message.delete()
+
+# archive one message; an error is logged and the message left on the queue
+# so that it is received again, without stopping the other archives
+def process_message(message):
+  try:
+    archive_message(message)
+  except Exception as e:
+    print("There was an error archiving the result file of a message, it will be retried:\n" + str(e))
+
 ###############################
 ###          MAIN          ###
 ###############################
@@ -38,65 +114,16 @@ def main():
 
   # loop for SQS messages
   while True:
-    print("Asking SQS for up to 10 messages...")
+    # one message per archive worker, up to 10 (the most SQS returns at once)
+    max_messages = min(10, aws.GLACIER_ARCHIVE_WORKERS)
+    print("Asking SQS for up to {0} messages...".format(str(max_messages)))
     # Get messages
-    messages = queue.receive_messages(WaitTimeSeconds=10)
+    messages = queue.receive_messages(MaxNumberOfMessages=max_messages, WaitTimeSeconds=10)
 
     if len(messages) > 0:
       print("Received {0} messages...".format(str(len(messages))))
-      # Iterate each message
-      for message in messages:
-        # get job id
-        job_id = json.loads(json.loads(message.body)['Message'])
-        print("Job id: " + str(job_id))
-
-        # connect to the database
-        table_name = aws.DYNAMODB_ANNOTATIONS_TABLE
-        table = aws.get_table(table_name)
-
-        # get annotation details
-        annotation_details = aws.get_annotation_details(table, job_id)
-
-        # make sure user role is still free
-        if not is_free_user(annotation_details):
-          print("User role is no longer free.")
-          # Delete the message from the queue (no need to archive)
-          print ("Deleting message...")
-          message.delete()
-
-        # check if ready to be archived
-        elif not is_time_to_archive(annotation_details):
-          print("Not enough time has elapsed to archive this file.")
-        else:
-          # claim the archive job
-          if aws.claim_archive_job(table, job_id):
-            print("Archiving result file...")
-
-            # get s3
-            s3 = aws.get_s3()
-
-            # get Glacier vault
-            glacier_resource = aws.get_glacier_resource()
-            vault = aws.get_vault(glacier_resource)
-
-            # archive the result file
-            archive_id = aws.archive_result_file(s3, vault, annotation_details)
-            print("Result file archived")
-
-            # update archive status
-            result_file_location = 'Glacier'
-            aws.set_result_file_location(table, job_id, result_file_location)
-            aws.set_archive_id(table, job_id, archive_id)
-            print("Archive status updated in annotations database.")
-
-            # delete s3 result file
-            bucket = annotation_details['s3_results_bucket']
-            key = annotation_details['s3_key_result_file']
-            aws.delete_s3_file(s3, bucket, key)
-            print("S3 result file deleted")
-
-            # Delete the message from the queue (only if processed)
-            print ("Deleting message...")
-            message.delete()
+      # archive the jobs of the messages, aws.GLACIER_ARCHIVE_WORKERS at once
+      with ThreadPoolExecutor(max_workers=aws.GLACIER_ARCHIVE_WORKERS) as executor:
+        list(executor.map(process_message, messages))
 
 main()
@@ -3,7 +3,11 @@ import botocore
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.client import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
+import threading
+import time
 
 import configparser
 
@@ -29,10 +33,17 @@ S3_ACL = config['AWS']['S3_ACL']
 
 # DynamoDB
 DYNAMODB_ANNOTATIONS_TABLE = config['AWS']['DYNAMODB_ANNOTATIONS_TABLE']
+DYNAMODB_UPDATE_WORKERS = config['AWS'].getint('DYNAMODB_UPDATE_WORKERS')
+DYNAMODB_UPDATE_ATTEMPTS = config['AWS'].getint('DYNAMODB_UPDATE_ATTEMPTS')
 
 # Glacier
 GLACIER_VAULT = config['AWS']['GLACIER_VAULT']
 GLACIER_ACCOUNT_ID = config['AWS']['GLACIER_ACCOUNT_ID']
+GLACIER_PART_SIZE = config['AWS'].getint('GLACIER_PART_SIZE')
+GLACIER_ARCHIVE_WORKERS = config['AWS'].getint('GLACIER_ARCHIVE_WORKERS')
+
+# Glacier tree hashes are built from the SHA-256 of every 1 MB of the data
+GLACIER_HASH_CHUNK_SIZE = 1024 * 1024
 
 # SQS
 SQS_JOB_REQUESTS_QUEUE = config['AWS']['SQS_JOB_REQUESTS_QUEUE']
@@ -58,10 +69,10 @@ FREE_USER_DATA_RETENTION = config['ARCHIVE']['FREE_USER_DATA_RETENTION'] # time
 ###            S3           ###
 ###############################
 
-# get an s3 connection
+# get an s3 connection (own session: the workers connect from several threads)
 def get_s3():
   try:
-    s3 = boto3.resource('s3')
+    s3 = boto3.session.Session().resource('s3')
   except Exception as e:
     print("There was an error connecting to S3:\n" + str(e))
   return s3
@@ -94,6 +105,11 @@ def put_data_in_S3(s3, bucket, key, data):
   object.put(Body=data.read())
   print("File placed in S3.")
 
+# size of an s3 file in bytes
+def get_s3_file_size(s3, bucket, key):
+  s3_object = s3.Object(bucket, key)
+  return s3_object.content_length
+
 # delete s3 file
 def delete_s3_file(s3, bucket, key):
   s3_object = s3.Object(bucket, key)
@@ -106,21 +122,35 @@ def delete_s3_file(s3, bucket, key):
 # get table by name
 def get_table(table_name):
   try:
-    aws_db = boto3.resource('dynamodb', region_name=REGION_NAME)
+    aws_db = boto3.session.Session().resource('dynamodb', region_name=REGION_NAME)
     table = aws_db.Table(table_name)
     return table
   except Exception as e:
     print("There was an error coneecting to the annotations database:\n" + str(e))
 
-# get annotations for a user from annotations db
+# table by name for the current thread (boto3 resources must not be shared between threads)
+_local = threading.local()
+def get_thread_table(table_name):
+  if not hasattr(_local, 'tables'):
+    _local.tables = {}
+  if table_name not in _local.tables:
+    _local.tables[table_name] = get_table(table_name)
+  return _local.tables[table_name]
+
+# get annotations for a user from annotations db: every page of the query, not only the first 1MB
 def get_annotations(table, user_id):
   try:
-    response = table.query(
-      IndexName='user_id_index',
-      KeyConditionExpression=Key('user_id').eq(user_id)
-    )
-    annotations = response['Items']
-    return annotations
+    query = {
+      'IndexName': 'user_id_index',
+      'KeyConditionExpression': Key('user_id').eq(user_id)
+    }
+    annotations = []
+    while True:
+      response = table.query(**query)
+      annotations.extend(response['Items'])
+      if 'LastEvaluatedKey' not in response:
+        return annotations
+      query['ExclusiveStartKey'] = response['LastEvaluatedKey']
   except Exception as e:
     print("There was an error getting the annotations for user from the annotations database:\n" + str(e))
 
@@ -218,6 +248,36 @@ def set_user_role(table, job_id, user_role):
     print("There was an error setting the user role in the annotations database for job id: " + str(job_id))
     print(str(e))
 
+# set user role and, if given, result file location of a job in one update,
+# retrying with exponential backoff (e.g. when writes are throttled)
+# returns True if the job was updated
+def set_user_role_and_location(table_name, job_id, user_role, result_file_location=None):
+  update_expression = "set user_role=:user_role"
+  expression_values = {':user_role': user_role}
+  if result_file_location is not None:
+    update_expression += ", result_file_location=:result_file_location"
+    expression_values[':result_file_location'] = result_file_location
+  for attempt in range(DYNAMODB_UPDATE_ATTEMPTS):
+    try:
+      get_thread_table(table_name).update_item(
+        Key={'job_id': job_id},
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_values
+      )
+      return True
+    except Exception as e:
+      print("There was an error updating the annotations database for job id: {0} (attempt {1} of {2}):\n{3}".format(job_id, attempt + 1, DYNAMODB_UPDATE_ATTEMPTS, str(e)))
+      if attempt < DYNAMODB_UPDATE_ATTEMPTS - 1:
+        time.sleep(0.1 * 2 ** attempt)
+  return False
+
+# apply update(annotation) to annotations, DYNAMODB_UPDATE_WORKERS of them at once
+# returns the number of annotations for which update returned True
+def update_annotations(annotations, update):
+  with ThreadPoolExecutor(max_workers=DYNAMODB_UPDATE_WORKERS) as executor:
+    results = list(executor.map(update, annotations))
+  return len([result for result in results if result])
+
 # update result file location in annotations database
 def set_result_file_location(table, job_id, result_file_location):
   try:
@@ -346,7 +406,7 @@ def notify_user(ses, annotation_details):
 # get Glacier resource
 def get_glacier_resource():
   try:
-    glacier_resource = boto3.resource('glacier', region_name=REGION_NAME)
+    glacier_resource = boto3.session.Session().resource('glacier', region_name=REGION_NAME)
     return glacier_resource
   except Exception as e:
     print("There was an error connecting to Glacier:\n" + str(e))
@@ -359,7 +419,28 @@ def get_vault(glacier_resource):
   except Exception as e:
     print("There was an error getting the Glacier vault:\n" + str(e))
 
+# tree hash (hex) from the SHA-256 digests of consecutive 1 MB chunks
+# https://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+def tree_hash(chunk_digests):
+  digests = list(chunk_digests) or [hashlib.sha256(b'').digest()]
+  while len(digests) > 1:
+    pairs = [digests[i:i + 2] for i in range(0, len(digests), 2)]
+    digests = [hashlib.sha256(b''.join(pair)).digest() if len(pair) == 2 else pair[0] for pair in pairs]
+  return digests[0].hex()
+
+# read up to size bytes from a stream (a read may return fewer than asked for)
+def read_part(body, size):
+  data = bytearray()
+  while len(data) < size:
+    chunk = body.read(size - len(data))
+    if not chunk:
+      break
+    data.extend(chunk)
+  return bytes(data)
+
 # archive annotation result file in s3 to glacier vault
+# the file is streamed from S3 into a multipart upload, GLACIER_PART_SIZE bytes at a time,
+# so only one part of it is ever in memory; returns the archive id, or None on error
 def archive_result_file(s3, vault, annotation_details):
   # get s3 object
   s3_key_result_file = annotation_details['s3_key_result_file']
@@ -370,15 +451,43 @@ def archive_result_file(s3, vault, annotation_details):
   archive_description = annotation_details['job_id']
 
   # archive s3 object as it is read
+  multipart_upload = None
   try:
-    archive_object = vault.upload_archive(
+    body = s3_object.get()['Body']
+    multipart_upload = vault.initiate_multipart_upload(
       archiveDescription=archive_description,
-      body=s3_object.get()['Body'].read()
+      partSize=str(GLACIER_PART_SIZE)
+    )
+    chunk_digests = []
+    archive_size = 0
+    parts = 0
+    while True:
+      part = read_part(body, GLACIER_PART_SIZE)
+      if len(part) == 0:
+        break
+      part_digests = [hashlib.sha256(memoryview(part)[i:i + GLACIER_HASH_CHUNK_SIZE]).digest()
+        for i in range(0, len(part), GLACIER_HASH_CHUNK_SIZE)]
+      multipart_upload.upload_part(
+        range='bytes {0}-{1}/*'.format(archive_size, archive_size + len(part) - 1),
+        checksum=tree_hash(part_digests),
+        body=part
+      )
+      chunk_digests.extend(part_digests)
+      archive_size += len(part)
+      parts += 1
+    response = multipart_upload.complete(
+      archiveSize=str(archive_size),
+      checksum=tree_hash(chunk_digests)
     )
-    print('Archive response: ' + str(archive_object))
-    return archive_object.id
+    print("Archived {0} bytes in {1} parts: {2}".format(archive_size, parts, response['archiveId']))
+    return response['archiveId']
   except Exception as e:
     print("There was an error moving result file from S3 to Glacier:\n" + str(e))
+    if multipart_upload is not None:
+      try:
+        multipart_upload.abort()
+      except Exception as e:
+        print("There was an error aborting the Glacier multipart upload:\n" + str(e))
 
 # get Glacier client
 def get_glacier_client():
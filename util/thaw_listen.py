@@ -10,6 +10,35 @@ import time
 
 import aws
 
+###############################
+###     HELPER FUNCTIONS    ###
+###############################
+
+# make one job of a user premium: request a thaw of its results if they are in
+# Glacier, then set user role (and result file location) in a single update
+# returns True if the job is up to date
+def upgrade_annotation(glacier, table_name, annotation):
+  # get the job id
+  job_id = annotation['job_id']
+  user_role = 'premium_user'
+  result_file_location = annotation.get('result_file_location')
+
+  # check if annotation is archived in glacier
+  if result_file_location == 'Glacier':
+    # create a request to thaw
+    print("Data for job {0} is in Glacier.".format(job_id))
+    archive_id = annotation['results_file_archive_id']
+    tier = 'Expedited' # will auto-try Standard if Expeditied fails
+    aws.request_restore(glacier, archive_id, tier)
+
+    # update annotations db - show that file is being restored
+    return aws.set_user_role_and_location(table_name, job_id, user_role, 'restoring from archive...')
+
+  # nothing to write if the job is premium already (e.g. a message received again)
+  if annotation.get('user_role') == user_role:
+    return True
+  return aws.set_user_role_and_location(table_name, job_id, user_role)
+
 ###############################
 ###          MAIN          ###
 ###############################
@@ -37,37 +66,22 @@ def main():
         # get glacier connection
         glacier = aws.get_glacier_client()
 
-        # connect to the database
+        # get annotations for user (every page of them)
         table_name = aws.DYNAMODB_ANNOTATIONS_TABLE
-        table = aws.get_table(table_name)
-
-        # get annotations for user
+        table = aws.get_thread_table(table_name)
         annotations = aws.get_annotations(table, user_id)
-        print("Identified annotations in db for user.")
-
-        # loop through each annotation
-        for annotation in annotations:
-          # get the job id
-          job_id = annotation['job_id']
-          print('Evaluating job id: ' + str(job_id))
-
-          # set user role to premium
-          user_role = 'premium_user'
-          aws.set_user_role(table, job_id, user_role)
-
-          # check if annotation is archived in glacier
-          if annotation['result_file_location'] == 'Glacier':
-            # create a request to thaw
-            print("Data for this job is in Glacier.")
-            archive_id = annotation['results_file_archive_id']
-            tier = 'Expedited' # will auto-try Standard if Expeditied fails
-            aws.request_restore(glacier, archive_id, tier)
-
-            # update annotations db - show that file is being restored
-            result_file_location = 'restoring from archive...'
-            aws.set_result_file_location(table, job_id, result_file_location)
-          else:
-            print("Data for this job is not in Glacier.")
+        if annotations is None:
+          continue
+        print("Identified {0} annotations in db for user.".format(len(annotations)))
+
+        # update the jobs, aws.DYNAMODB_UPDATE_WORKERS at once
+        start = time.time()
+        updated = aws.update_annotations(annotations, lambda annotation: upgrade_annotation(glacier, table_name, annotation))
+        print("Updated {0} of {1} jobs in {2:.2f} seconds.".format(updated, len(annotations), time.time() - start))
+
+        # keep the message to try again later unless every job was updated
+        if updated < len(annotations):
+          continue
 
         # Delete the message from the queue (only if processed)
         print ("Deleting message...")